@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import time
+import typing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COPY_CHUNK_SIZE: int = 1024 * 1024
+GZIP_LEVEL: int = 6
+ZSTD_LEVEL: int = 3
+ARTIFACT_SUFFIXES: typing.Dict[str, str] = {
+    'gz': '.tar.gz',
+    'zst': '.tar.zst',
+    'none': '.tar',
+}
+IGNORED_DIRS: typing.List[str] = ['.ipynb_checkpoints', '__pycache__']
+
+
+def available_compressions() -> typing.List[str]:
+    return [compression for compression in ARTIFACT_SUFFIXES if compression != 'zst' or zstandard is not None]
+
+
+def artifact_compression(artifact_path: str) -> typing.Optional[str]:
+    for compression, suffix in ARTIFACT_SUFFIXES.items():
+        if artifact_path.endswith(suffix):
+            return compression
+
+    return None
+
+
+def _exclude_ignored(tarinfo: tarfile.TarInfo) -> typing.Optional[tarfile.TarInfo]:
+    if any(part in IGNORED_DIRS for part in tarinfo.name.split('/')):
+        return None
+
+    return tarinfo
+
+
+def _write_tar(stream: typing.BinaryIO, source_dir: str, arcname: str, extra_files: typing.Dict[str, bytes]) -> None:
+    # 'w|' writes the archive strictly front to back, streaming every file
+    # from the source tree in bufsize chunks; nothing is staged on disk.
+    with tarfile.open(fileobj=stream, mode='w|', bufsize=COPY_CHUNK_SIZE) as tar:
+        tar.add(source_dir, arcname=arcname, filter=_exclude_ignored)
+        for name, data in sorted(extra_files.items()):
+            tarinfo = tarfile.TarInfo(f'{arcname}/{name}')
+            tarinfo.size = len(data)
+            tarinfo.mode = 0o755
+            tarinfo.mtime = int(time.time())
+            tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def pack_artifact(source_dir: str, arcname: str, artifact_path: str, compression: str = 'gz',
+                  extra_files: typing.Dict[str, bytes] = None) -> None:
+    """
+    Tars source_dir as arcname/, plus extra_files (name -> contents) in the
+    same directory, straight into artifact_path. The archive is written to a
+    .part file and renamed, so a reader never sees a partial artifact.
+    """
+    extra_files = extra_files or {}
+    part_path: str = f'{artifact_path}.part'
+    try:
+        with open(part_path, 'wb') as raw:
+            if compression == 'gz':
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=GZIP_LEVEL) as compressed:
+                    _write_tar(compressed, source_dir, arcname, extra_files)
+
+            elif compression == 'zst':
+                if zstandard is None:
+                    raise RuntimeError('zstd compression requires the zstandard package')
+
+                compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+                with compressor.stream_writer(raw, closefd=False) as compressed:
+                    _write_tar(compressed, source_dir, arcname, extra_files)
+
+            elif compression == 'none':
+                _write_tar(raw, source_dir, arcname, extra_files)
+
+            else:
+                raise ValueError(f'Unknown compression[{compression}]')
+
+        os.replace(part_path, artifact_path)
+
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+        raise
+
+
+def _extract_members(tar: tarfile.TarFile, dest_dir: str) -> typing.List[str]:
+    dest_root: str = os.path.realpath(dest_dir)
+    extracted: typing.List[str] = []
+    for member in tar:
+        target: str = os.path.realpath(os.path.join(dest_root, member.name))
+        if os.path.commonpath([dest_root, target]) != dest_root:
+            raise ValueError(f'Refusing to extract member[{member.name}] outside of [{dest_dir}]')
+
+        if member.isdir():
+            os.makedirs(target, exist_ok=True)
+
+        elif member.isfile():
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            source = tar.extractfile(member)
+            with open(target, 'wb') as stream:
+                shutil.copyfileobj(source, stream, COPY_CHUNK_SIZE)
+
+            os.chmod(target, member.mode & 0o777)
+            extracted.append(target)
+
+        else:
+            raise NotImplementedError
+
+    return extracted
+
+
+def extract_artifact(artifact_path: str, dest_dir: str) -> typing.List[str]:
+    """
+    Extracts artifact_path into dest_dir in one forward pass, copying each
+    member in COPY_CHUNK_SIZE chunks. Returns the paths of extracted files.
+    """
+    compression: str = artifact_compression(artifact_path)
+    with open(artifact_path, 'rb') as raw:
+        if compression == 'zst':
+            if zstandard is None:
+                raise RuntimeError(f'Artifact[{artifact_path}] is zstd compressed; install zstandard to read it')
+
+            with zstandard.ZstdDecompressor().stream_reader(raw) as decompressed:
+                with tarfile.open(fileobj=decompressed, mode='r|', bufsize=COPY_CHUNK_SIZE) as tar:
+                    return _extract_members(tar, dest_dir)
+
+        with tarfile.open(fileobj=raw, mode='r|*', bufsize=COPY_CHUNK_SIZE) as tar:
+            return _extract_members(tar, dest_dir)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Compares the old copy-tar-move artifact round trip with the streaming one in
+artifact_io.py on a synthetic notebook directory holding one large FITS-sized
+file. For each step it reports wall time, bytes moved through read()/write()
+(rchar + wchar from /proc/self/io) and peak Python heap (tracemalloc).
+
+    python .circleci/bench_artifact_io.py --size-mb 256
+"""
+
+import argparse
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from artifact_io import ARTIFACT_SUFFIXES, available_compressions, extract_artifact, pack_artifact
+
+
+def io_counters() -> int:
+    try:
+        with open('/proc/self/io', 'r') as stream:
+            counters: typing.Dict[str, int] = dict(
+                (key, int(value)) for key, value in (line.split(':') for line in stream)
+            )
+
+        return counters['rchar'] + counters['wchar']
+
+    except OSError:
+        return 0
+
+
+def measure(label: str, func: typing.Callable[[], typing.Any]) -> None:
+    tracemalloc.start()
+    io_start: int = io_counters()
+    start: float = time.perf_counter()
+    func()
+    elapsed: float = time.perf_counter() - start
+    copied: int = io_counters() - io_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<28} {elapsed:8.2f} s {copied / 1024 ** 2:10.1f} MiB copied {peak / 1024 ** 2:10.1f} MiB peak')
+
+
+def legacy_pack(notebook_path: str, dest_dir: str) -> str:
+    build_path: str = tempfile.mkdtemp(prefix='bench')
+    shutil.rmtree(build_path)
+    shutil.copytree(notebook_path, build_path)
+    with open(os.path.join(build_path, 'build.sh'), 'w') as stream:
+        stream.write('#!/usr/bin/env bash\n')
+
+    artifact_path: str = os.path.join(tempfile.gettempdir(), 'bench-legacy.tar.gz')
+    with tarfile.open(artifact_path, 'w:gz') as tar:
+        tar.add(build_path, arcname=os.path.basename(build_path))
+
+    artifact_dest: str = os.path.join(dest_dir, 'legacy.tar.gz')
+    shutil.move(artifact_path, artifact_dest)
+    shutil.rmtree(build_path)
+    return artifact_dest
+
+
+def legacy_extract(artifact_path: str, extraction_path: str) -> None:
+    with tarfile.open(artifact_path, 'r:gz') as tar:
+        for member in tar.getmembers():
+            if member.isdir():
+                os.makedirs(os.path.join(extraction_path, member.path))
+
+            elif member.isfile():
+                with open(os.path.join(extraction_path, member.path), 'wb') as stream:
+                    stream.write(tar.extractfile(member).read())
+
+
+def main(args: typing.List[str] = None):
+    parser = argparse.ArgumentParser(description='Benchmark artifact packing and extraction')
+    parser.add_argument('--size-mb', type=int, default=128, help='Size of the synthetic data file')
+    options = parser.parse_args(args)
+
+    work_dir: str = tempfile.mkdtemp(prefix='bench-artifacts')
+    try:
+        notebook_path: str = os.path.join(work_dir, 'notebook')
+        os.makedirs(notebook_path)
+        with open(os.path.join(notebook_path, 'notebook.ipynb'), 'w') as stream:
+            stream.write('{"cells": [], "metadata": {}, "nbformat": 4, "nbformat_minor": 2}')
+
+        # Half random, half zeros, to give the compressors something realistic.
+        with open(os.path.join(notebook_path, 'data.fits'), 'wb') as stream:
+            for _ in range(options.size_mb):
+                stream.write(os.urandom(512 * 1024) + bytes(512 * 1024))
+
+        print(f'{options.size_mb} MiB notebook directory')
+        artifact_path: str = legacy_pack(notebook_path, work_dir)
+        os.remove(artifact_path)
+        measure('legacy pack (gz)', lambda: legacy_pack(notebook_path, work_dir))
+        measure('legacy extract (gz)', lambda: legacy_extract(os.path.join(work_dir, 'legacy.tar.gz'),
+                                                              tempfile.mkdtemp(dir=work_dir)))
+        for compression in available_compressions():
+            artifact_path = os.path.join(work_dir, f'streaming{ARTIFACT_SUFFIXES[compression]}')
+            measure(f'streaming pack ({compression})',
+                    lambda: pack_artifact(notebook_path, 'notebook', artifact_path, compression,
+                                          extra_files={'build.sh': b'#!/usr/bin/env bash\n'}))
+            measure(f'streaming extract ({compression})',
+                    lambda: extract_artifact(artifact_path, tempfile.mkdtemp(dir=work_dir)))
+
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ in ['__main__']:
+    main()
@@ -1,20 +1,29 @@
 #!/usr/bin/env python
 
+import argparse
+import collections
+import concurrent.futures
 import logging
 import json
 import os
+import selectors
+import signal
 import subprocess
 import shutil
 import sys
-import tarfile
 import tempfile
 import time
 import types
 import typing
 
-from datetime import datetime
 
-from junitparser import TestCase, TestSuite, JUnitXml, Skipped, Error
+from junitparser import TestCase, TestSuite, JUnitXml, Skipped, Error, Properties, Property
+
+from artifact_io import artifact_compression, extract_artifact
+from build_cache import BuildCache, CACHE_DIR, CACHE_KEY_FILE, CACHE_MAX_BYTES, ENGINES, cached_result
+from cell_profiler import (BASELINE_REPORT_PATH, PROFILE_REPORT_PATH, REGRESSION_THRESHOLD, find_regressions,
+                           load_report, new_report, notebook_report, summary_properties, write_report)
+from notebook_manifest import MANIFEST_PATH, NotebookEntry, load_manifest
 
 root = logging.getLogger()
 root.setLevel(logging.INFO)
@@ -32,83 +41,422 @@ BUILD_STATE: typing.Dict[str, typing.Any] = {}
 if not os.path.exists(TEST_OUTPUT_DIR):
     os.makedirs(TEST_OUTPUT_DIR)
 TEST_CASES: typing.List[TestCase] = []
+DURATIONS_PATH: str = os.path.join(os.path.expanduser('~'), '.cache', 'notebooks', 'build-durations.json')
+DEFAULT_JOBS: int = os.cpu_count() or 1
+LOG_OUTPUT_DIR: str = '/tmp/build-logs'
+HTML_DEST_DIR: str = '/tmp/html'
+NOTEBOOK_PYTHON_FILE: str = '.notebook-python'
+SLOWEST_CELLS_REPORTED: int = 5
+DEFAULT_TIMEOUT: float = 3600
+READ_CHUNK_SIZE: int = 64 * 1024
+STDERR_TAIL_LINES: int = 200
+# Seconds to keep draining output after a timed out process group is killed
+KILL_GRACE: float = 10
 
-def run_command(cmd: typing.List[str]) -> types.GeneratorType:
-    proc = subprocess.Popen(' '.join(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    while proc.poll() is None:
-        time.sleep(.1)
+class CommandResult(typing.NamedTuple):
+    exit_code: int
+    duration: float
+    peak_rss_kb: int
+    timed_out: bool
+    stderr_tail: typing.List[str]
 
-    if proc.poll() > 0:
-        yield proc.poll(), proc.stderr.read().decode(ENCODING)
+def _exit_code_from_status(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
 
-    elif proc.poll() != None:
-        yield proc.poll(), proc.stdout.read().decode(ENCODING)
+    return os.WEXITSTATUS(status)
 
-    else:
-        # if proc.poll() is None, its still running the subprocess.
-        # block until done
-        pass
+def run_command(cmd: typing.List[str], log_path: str, cwd: str = None, timeout: float = None, log_prefix: str = '',
+                env: typing.Dict[str, str] = None) -> CommandResult:
+    """
+    Runs cmd and streams stdout and stderr, line by line, into log_path and the
+    build log as they are produced. Nothing is buffered beyond the current line
+    and the last STDERR_TAIL_LINES of stderr, so chatty notebooks can neither
+    fill a pipe and deadlock nor hold their whole output in memory.
+
+    The process runs in its own session so a timeout kills the whole process
+    tree (virtualenv, pip, jupyter and the kernel), not only the shell.
+    """
+    start: float = time.monotonic()
+    deadline: float = None if not timeout else start + timeout
+    timed_out: bool = False
+    stderr_tail: typing.Deque[str] = collections.deque(maxlen=STDERR_TAIL_LINES)
+    partial_lines: typing.Dict[str, bytes] = {'stdout': b'', 'stderr': b''}
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env, start_new_session=True)
+
+    def emit(stream_name: str, line: bytes, log: typing.BinaryIO) -> None:
+        log.write(line)
+        text: str = line.decode(ENCODING, errors='replace').rstrip('\n')
+        if stream_name == 'stderr':
+            stderr_tail.append(text)
+
+        logger.info(f'{log_prefix}{text}')
+
+    with open(log_path, 'wb') as log, selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+        while selector.get_map():
+            remaining: float = None if deadline is None else max(deadline - time.monotonic(), 0)
+            events = selector.select(remaining)
+            if deadline is not None and time.monotonic() >= deadline:
+                if timed_out:
+                    # Something outside the killed process group still holds
+                    # the pipes open; stop reading rather than wait for it.
+                    logger.error(f'{log_prefix}Output still open [{KILL_GRACE}] seconds after the kill, closing it')
+                    for key in list(selector.get_map().values()):
+                        selector.unregister(key.fileobj)
+
+                    break
+
+                logger.error(f'{log_prefix}Timed out after [{timeout}] seconds, killing process group[{proc.pid}]')
+                timed_out = True
+                deadline = time.monotonic() + KILL_GRACE
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+
+                except ProcessLookupError:
+                    pass
+
+            for key, _ in events:
+                stream_name: str = key.data
+                chunk: bytes = os.read(key.fd, READ_CHUNK_SIZE)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    if partial_lines[stream_name]:
+                        emit(stream_name, partial_lines[stream_name] + b'\n', log)
+
+                    continue
+
+                lines: typing.List[bytes] = (partial_lines[stream_name] + chunk).split(b'\n')
+                partial_lines[stream_name] = lines.pop()
+                for line in lines:
+                    emit(stream_name, line + b'\n', log)
+
+            log.flush()
+
+    proc.stdout.close()
+    proc.stderr.close()
+    # wait4 rather than Popen.wait, so the resource usage of the whole reaped
+    # process tree comes back with the exit status. ru_maxrss is in KiB on Linux.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = _exit_code_from_status(status)
+    return CommandResult(proc.returncode, time.monotonic() - start, rusage.ru_maxrss, timed_out, list(stderr_tail))
+
+def add_testcase_property(test_case: TestCase, name: str, value: typing.Any) -> None:
+    props = test_case.child(Properties)
+    if props is None:
+        props = Properties()
+        test_case.append(props)
+
+    props.add_property(Property(name, str(value)))
 
 
 def find_artifacts(start_dir: str) -> types.GeneratorType:
     for root, dirnames, filenames in os.walk(start_dir):
         for filename in filenames:
-            if filename.endswith('.tar.gz'):
-                yield os.path.join(start_dir, filename)
-
-def main():
-    for artifact_path in find_artifacts(ARTIFACT_DEST_DIR):
-        logger.info(f'Found Artifact in path[{artifact_path}]. Building Artifact')
-        notebook_name: str = os.path.basename(artifact_path).rsplit('.', 1)[0]
-        extraction_path: str = tempfile.mkdtemp(prefix=notebook_name)
-        build_script_path: str = None
-        with tarfile.open(artifact_path, "r:gz") as tar:
-            for member in tar.getmembers():
-                if member.isdir():
-                    dir_path: str = os.path.join(extraction_path, member.path)
-                    os.makedirs(dir_path)
-    
-                elif member.isfile():
-                    filepath: str = os.path.join(extraction_path, member.path)
-                    with open(filepath, 'wb') as stream:
-                        stream.write(tar.extractfile(member).read())
-    
-                    if os.path.basename(member.path) == 'build.sh':
-                        build_script_path = filepath
-    
-                else:
-                    raise NotImplementedError
-    
-    
-        owd: str = os.getcwd()
-        build_dir: str = os.path.dirname(build_script_path)
-        logger.info(f'Changing to build_dir[{build_dir}]')
-        os.chdir(build_dir)
-        BUILD_STATE[notebook_name] = {'stdout': [], 'stderr': []}
-        start = datetime.utcnow()
-        for return_code, comm, in run_command(['bash', 'build.sh']):
-            if return_code > 0:
-                logger.error(comm)
-                BUILD_STATE[notebook_name]['exit-code'] = return_code
-                BUILD_STATE[notebook_name]['stderr'].append(comm)
-    
-            else:
-                BUILD_STATE[notebook_name]['exit-code'] = return_code
-                BUILD_STATE[notebook_name]['stdout'].append(comm)
-                logger.info(comm)
-    
-        delta = datetime.utcnow() - start
-        logger.info(f'Changing back to old working dir[{owd}]')
-        os.chdir(owd)
-        test_case = TestCase(f'{notebook_name} Test')
-        if BUILD_STATE[notebook_name]['exit-code'] > 0:
-            test_case.result = Error('\n'.join(BUILD_STATE[notebook_name]['stderr']), BUILD_STATE[notebook_name]['exit-code'])
-            TEST_CASES.append(test_case)
-    
+            if artifact_compression(filename) is not None:
+                yield os.path.join(root, filename)
+
+def find_cached_builds(start_dir: str) -> types.GeneratorType:
+    for root, dirnames, filenames in os.walk(start_dir):
+        for filename in filenames:
+            if filename.endswith('.cached.json'):
+                yield os.path.join(root, filename)
+
+def load_durations(durations_path: str) -> typing.Dict[str, float]:
+    if not os.path.exists(durations_path):
+        return {}
+
+    try:
+        with open(durations_path, 'r', encoding=ENCODING) as stream:
+            return json.load(stream)
+
+    except (OSError, ValueError) as err:
+        logger.warning(f'Unable to read durations[{durations_path}]: {err}')
+        return {}
+
+def save_durations(durations_path: str, durations: typing.Dict[str, float]) -> None:
+    durations_dir: str = os.path.dirname(durations_path)
+    if durations_dir and not os.path.exists(durations_dir):
+        os.makedirs(durations_dir)
+
+    tmp_path: str = f'{durations_path}.tmp'
+    with open(tmp_path, 'w', encoding=ENCODING) as stream:
+        json.dump(durations, stream, indent=2, sort_keys=True)
+
+    os.replace(tmp_path, durations_path)
+
+def artifact_notebook_name(artifact_path: str) -> str:
+    return os.path.basename(artifact_path).split('.', 1)[0]
+
+def schedule_artifacts(artifact_paths: typing.List[str], durations: typing.Dict[str, float]) -> typing.List[str]:
+    """
+    Longest-first ordering keeps the slowest notebooks from starting last and
+    holding up the whole pool. Notebooks without a recorded duration go first,
+    since nothing says they are fast.
+    """
+    def sort_key(artifact_path: str) -> typing.Tuple[bool, float, str]:
+        duration: float = durations.get(artifact_notebook_name(artifact_path))
+        return (duration is not None, -(duration or 0), artifact_path)
+
+    return sorted(artifact_paths, key=sort_key)
+
+def unpack_artifact(artifact_path: str, notebook_name: str) -> str:
+    extraction_path: str = tempfile.mkdtemp(prefix=notebook_name)
+    for filepath in extract_artifact(artifact_path, extraction_path):
+        if os.path.basename(filepath) == 'build.sh':
+            return filepath
+
+    raise FileNotFoundError(f'Artifact[{artifact_path}] has no build.sh')
+
+def execute_notebook(engine: typing.Any, build_dir: str, notebook_name: str) -> typing.Any:
+    with open(os.path.join(build_dir, NOTEBOOK_PYTHON_FILE), 'r', encoding=ENCODING) as stream:
+        python: str = stream.read().strip()
+
+    logger.info(f'Executing Notebook[{notebook_name}] on a pooled kernel for python[{python}]')
+    execution = engine.execute(os.path.join(build_dir, f'{notebook_name}.ipynb'), python)
+    with open(os.path.join(build_dir, f'{notebook_name}.html'), 'w', encoding=ENCODING) as stream:
+        stream.write(execution.html)
+
+    slowest = sorted(execution.cell_profiles, key=lambda profile: profile.wall_time, reverse=True)[:SLOWEST_CELLS_REPORTED]
+    for profile in slowest:
+        logger.info(f'[{notebook_name}] cell[{profile.index}] took [{profile.wall_time:.2f}s] wall, '
+                    f'[{profile.cpu_time}s] cpu, peak-rss-kb[{profile.peak_rss_kb}]')
+
+    return execution
+
+def build_artifact(artifact_path: str, timeout: float = None, cache: BuildCache = None,
+                   engine: typing.Any = None) -> typing.Tuple[str, TestCase, float]:
+    logger.info(f'Found Artifact in path[{artifact_path}]. Building Artifact')
+    notebook_name: str = artifact_notebook_name(artifact_path)
+    build_script_path: str = unpack_artifact(artifact_path, notebook_name)
+    # Every build runs inside its own extraction directory, so concurrent
+    # builds never share (or change) the process working directory.
+    build_dir: str = os.path.dirname(build_script_path)
+    log_path: str = os.path.join(LOG_OUTPUT_DIR, f'{notebook_name}.log')
+    # With an execution engine, build.sh only prepares the environment and
+    # the notebook itself is executed on one of the engine's warm kernels.
+    env: typing.Dict[str, str] = None if engine is None else dict(os.environ, NOTEBOOK_SKIP_EXECUTE='1')
+    logger.info(f'Building Notebook[{notebook_name}] in build_dir[{build_dir}], logging to [{log_path}]')
+    result: CommandResult = run_command(['bash', 'build.sh'], log_path, cwd=build_dir, timeout=timeout,
+                                        log_prefix=f'[{notebook_name}] ', env=env)
+    BUILD_STATE[notebook_name] = result._asdict()
+    duration: float = result.duration
+    error: Error = None
+    if result.exit_code != 0:
+        message: str = '\n'.join(result.stderr_tail)
+        if result.timed_out:
+            message = f'Timed out after {timeout} seconds\n{message}'
+
+        error = Error(message, result.exit_code)
+
+    elif engine is not None:
+        try:
+            execution = execute_notebook(engine, build_dir, notebook_name)
+
+        except Exception as err:
+            # i.e. no kernel could be started, the notebook is malformed or
+            # build.sh left no .notebook-python: fail this notebook, not the build.
+            logger.error(f'Unable to execute Notebook[{notebook_name}]: {err}')
+            error = Error(f'{type(err).__name__}: {err}', type(err).__name__)
+
+        else:
+            duration += execution.duration
+            BUILD_STATE[notebook_name]['profile'] = notebook_report(execution.cell_profiles, execution.duration)
+            if execution.error is not None:
+                error = Error(execution.error, 'CellExecutionError')
+
+    logger.info(f'Built Notebook[{notebook_name}] in [{duration:.1f}s] with exit-code[{result.exit_code}]')
+    test_case = TestCase(f'{notebook_name} Test')
+    test_case.time = duration
+    add_testcase_property(test_case, 'exit-code', result.exit_code)
+    add_testcase_property(test_case, 'duration', f'{duration:.3f}')
+    add_testcase_property(test_case, 'peak-rss-kb', result.peak_rss_kb)
+    add_testcase_property(test_case, 'timed-out', result.timed_out)
+    add_testcase_property(test_case, 'engine', 'shell' if engine is None else 'kernel')
+    add_testcase_property(test_case, 'log', log_path)
+    if error is not None:
+        test_case.result = error
+
+    else:
+        html_path: str = os.path.join(build_dir, f'{notebook_name}.html')
+        shutil.copyfile(html_path, os.path.join(HTML_DEST_DIR, os.path.basename(html_path)))
+        cache_key_path: str = os.path.join(build_dir, CACHE_KEY_FILE)
+        if cache is not None and os.path.exists(cache_key_path):
+            with open(cache_key_path, 'r') as stream:
+                cache_key: str = stream.read().strip()
+
+            logger.info(f'Caching Notebook[{notebook_name}] build[{cache_key}]')
+            cache.put(cache_key, cached_result(result.exit_code, duration, result.peak_rss_kb), [html_path])
+
+    return notebook_name, test_case, duration
+
+def add_source_properties(test_case: TestCase, entries: typing.List[NotebookEntry]) -> None:
+    add_testcase_property(test_case, 'notebook-dir', entries[0].directory)
+    add_testcase_property(test_case, 'requirements-hash', entries[0].requirements_hash)
+    for entry in entries:
+        add_testcase_property(test_case, f'content-hash:{os.path.basename(entry.path)}', entry.content_hash)
+
+def restore_cached_build(record_path: str, cache: BuildCache, engine: str) -> typing.Tuple[str, TestCase]:
+    with open(record_path, 'r', encoding=ENCODING) as stream:
+        record: typing.Dict[str, str] = json.load(stream)
+
+    notebook_name: str = record['notebook']
+    cache_key: str = record['cache-key']
+    test_case = TestCase(f'{notebook_name} Test')
+    add_testcase_property(test_case, 'cache-key', cache_key)
+    record_engine: str = record.get('engine', 'shell')
+    if record_engine != engine:
+        # The cache key covers the engine, so this build would not have been
+        # reused had create_artifacts.py been given the same --engine.
+        logger.error(f'Cached build[{cache_key}] of Notebook[{notebook_name}] was made by engine[{record_engine}], not [{engine}]')
+        test_case.result = Error(f'Cached build {cache_key} was made by the {record_engine} engine, '
+                                 f'rerun create_artifacts.py with --engine {engine}', 1)
+        return notebook_name, test_case
+
+    cached: typing.Dict[str, typing.Any] = None if cache is None else cache.get(cache_key)
+    if cached is None:
+        logger.error(f'Cached build[{cache_key}] of Notebook[{notebook_name}] is no longer available')
+        test_case.result = Error(f'Cached build {cache_key} is missing, rerun without the build cache', 1)
+        return notebook_name, test_case
+
+    logger.info(f'Restoring Notebook[{notebook_name}] from cached build[{cache_key}]')
+    cache.restore(cache_key, HTML_DEST_DIR)
+    test_case.time = cached['duration']
+    add_testcase_property(test_case, 'exit-code', cached['exit-code'])
+    add_testcase_property(test_case, 'duration', f"{cached['duration']:.3f}")
+    add_testcase_property(test_case, 'peak-rss-kb', cached['peak-rss-kb'])
+    add_testcase_property(test_case, 'cached', True)
+    return notebook_name, test_case
+
+def report_cell_profiles(test_cases: typing.Dict[str, TestCase], report_path: str, baseline_path: str,
+                         threshold: float) -> int:
+    report: typing.Dict[str, typing.Any] = new_report()
+    for notebook_name, state in BUILD_STATE.items():
+        if 'profile' in state:
+            report['notebooks'][notebook_name] = state['profile']
+
+    if not report['notebooks']:
+        return 0
+
+    baseline: typing.Dict[str, typing.Any] = load_report(baseline_path)
+    regressions = [] if baseline is None else find_regressions(report, baseline, threshold)
+    for regression in regressions:
+        logger.warning(f'Cell regression: {regression}')
+
+    for notebook_name, notebook_profile in report['notebooks'].items():
+        notebook_regressions = [regression for regression in regressions if regression.notebook == notebook_name]
+        for name, value in summary_properties(notebook_profile, notebook_regressions):
+            add_testcase_property(test_cases[notebook_name], name, value)
+
+    logger.info(f'Writing cell profile report[{report_path}] with [{len(regressions)}] regressions')
+    write_report(report_path, report)
+    # Notebooks that were not executed this time (cached or failed early)
+    # keep their previous profile as the baseline for the next build.
+    if baseline is not None:
+        report['notebooks'] = dict(baseline['notebooks'], **report['notebooks'])
+
+    write_report(baseline_path, report)
+    return len(regressions)
+
+def parse_args(args: typing.List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Build notebook artifacts and write JUnit results')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                        help=f'Number of artifacts to build concurrently (default: {DEFAULT_JOBS})')
+    parser.add_argument('--durations', type=str, default=DURATIONS_PATH,
+                        help='JSON file of past build durations, used to schedule the longest builds first')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help=f'Wall-clock limit in seconds for each notebook build, 0 to disable (default: {DEFAULT_TIMEOUT:g})')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR,
+                        help=f'Build cache directory (default: {CACHE_DIR})')
+    parser.add_argument('--cache-max-mb', type=int, default=CACHE_MAX_BYTES // 1024 ** 2,
+                        help='Evict least recently used builds once the cache grows past this size')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Neither read from nor write to the build cache')
+    parser.add_argument('--engine', type=str, choices=ENGINES, default='shell',
+                        help='Execute notebooks with nbconvert inside build.sh (shell) or on pooled warm kernels (kernel)')
+    parser.add_argument('--kernels-per-env', type=int, default=1,
+                        help='Warm kernels kept per build environment by the kernel engine')
+    parser.add_argument('--profile-report', type=str, default=PROFILE_REPORT_PATH,
+                        help='Where the kernel engine writes its per-cell profile report (JSON)')
+    parser.add_argument('--baseline-report', type=str, default=BASELINE_REPORT_PATH,
+                        help='Profile report of the previous build to compare against; replaced by this build\'s')
+    parser.add_argument('--manifest', type=str, default=MANIFEST_PATH,
+                        help=f'Notebook manifest written by create_artifacts.py (default: {MANIFEST_PATH})')
+    parser.add_argument('--regression-threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help=f'Flag cells whose wall or CPU time grew by more than this factor (default: {REGRESSION_THRESHOLD:g})')
+    options = parser.parse_args(args)
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    return options
+
+def main(args: typing.List[str] = None):
+    options = parse_args(args)
+    durations: typing.Dict[str, float] = load_durations(options.durations)
+    artifact_paths: typing.List[str] = schedule_artifacts(list(find_artifacts(ARTIFACT_DEST_DIR)), durations)
+    logger.info(f'Building [{len(artifact_paths)}] Artifacts with [{options.jobs}] jobs')
+    for output_dir in [LOG_OUTPUT_DIR, HTML_DEST_DIR]:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    cache: BuildCache = None if options.no_cache else BuildCache(options.cache_dir, options.cache_max_mb * 1024 ** 2)
+    test_cases: typing.Dict[str, TestCase] = {}
+    for record_path in find_cached_builds(ARTIFACT_DEST_DIR):
+        notebook_name, test_case = restore_cached_build(record_path, cache, options.engine)
+        test_cases[notebook_name] = test_case
         TEST_CASES.append(test_case)
-    
+
+    engine = None
+    if options.engine == 'kernel':
+        from execution_engine import ExecutionEngine
+        engine = ExecutionEngine(kernels_per_env=options.kernels_per_env, cell_timeout=options.timeout or None)
+
+    built: typing.Dict[str, TestCase] = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            futures = {executor.submit(build_artifact, artifact_path, options.timeout, cache, engine): artifact_path
+                       for artifact_path in artifact_paths}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    notebook_name, test_case, duration = future.result()
+
+                except Exception as err:
+                    # i.e. an artifact without build.sh or with a member that
+                    # cannot be extracted: fail this notebook, not the build.
+                    notebook_name = artifact_notebook_name(futures[future])
+                    logger.error(f'Unable to build Artifact[{futures[future]}]: {err}')
+                    test_case = TestCase(f'{notebook_name} Test')
+                    test_case.result = Error(f'{type(err).__name__}: {err}', type(err).__name__)
+
+                else:
+                    durations[notebook_name] = duration
+                    built[notebook_name] = test_case
+
+                test_cases[notebook_name] = test_case
+                TEST_CASES.append(test_case)
+
+    finally:
+        if engine is not None:
+            engine.shutdown()
+
+    save_durations(options.durations, durations)
+    regression_count: int = report_cell_profiles(built, options.profile_report, options.baseline_report,
+                                                 options.regression_threshold)
+    if cache is not None:
+        cache.evict()
+
+    # Artifacts are named after their notebook directory, see create_artifacts.py.
+    manifest = load_manifest(os.getcwd(), [], options.manifest)
+    for directory, entries in manifest.directories().items():
+        test_case: TestCase = test_cases.get(os.path.basename(directory))
+        if test_case is not None:
+            add_source_properties(test_case, entries)
+
     test_suite = TestSuite(f'Notebooks Test Suite')
-    [test_suite.add_testcase(case) for case in TEST_CASES]
+    [test_suite.add_testcase(case) for case in sorted(TEST_CASES, key=lambda case: case.name)]
+    if engine is not None:
+        test_suite.add_property('cell-regressions', str(regression_count))
     test_output_path: str = os.path.join(TEST_OUTPUT_DIR, f'results.xml')
     xml = JUnitXml()
     xml.add_testsuite(test_suite)
@@ -116,4 +464,3 @@ def main():
 
 if __name__ in ['__main__']:
     main()
-
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import typing
+
+logger = logging.getLogger(__file__)
+
+ENCODING: str = 'utf-8'
+CACHE_DIR: str = os.path.join(os.path.expanduser('~'), '.cache', 'notebooks', 'build-cache')
+CACHE_MAX_BYTES: int = 2 * 1024 ** 3
+CACHE_RESULT_FILE: str = 'result.json'
+CACHE_KEY_FILE: str = '.build-cache-key'
+HASH_CHUNK_SIZE: int = 1024 * 1024
+IGNORED_DIRS: typing.List[str] = ['.ipynb_checkpoints', '__pycache__']
+ENGINES: typing.List[str] = ['shell', 'kernel']
+
+
+def hash_file(hasher: typing.Any, path: str) -> None:
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def build_cache_key(notebook_path: str, environment_path: str, build_script: str, engine: str = 'shell') -> str:
+    """
+    Content address of a notebook build: every file in the notebook directory
+    (which covers the notebook JSON and its requirements.txt), the conda
+    environment.yml, the build.sh recipe itself and the engine that executes
+    the notebook (only the kernel engine records a per-cell profile). Any
+    change to one of them produces a different key, so stale entries are
+    never served.
+    """
+    hasher = hashlib.sha256()
+    for root, dirnames, filenames in os.walk(notebook_path):
+        dirnames[:] = sorted(dirname for dirname in dirnames if dirname not in IGNORED_DIRS)
+        for filename in sorted(filenames):
+            filepath: str = os.path.join(root, filename)
+            hasher.update(os.path.relpath(filepath, notebook_path).encode(ENCODING) + b'\0')
+            hash_file(hasher, filepath)
+            hasher.update(b'\0')
+
+    hasher.update(b'environment.yml\0')
+    if os.path.exists(environment_path):
+        hash_file(hasher, environment_path)
+
+    hasher.update(b'\0build.sh\0')
+    hasher.update(build_script.encode(ENCODING))
+    hasher.update(b'\0engine\0')
+    hasher.update(engine.encode(ENCODING))
+    return hasher.hexdigest()
+
+
+class BuildCache:
+    """
+    Local directory of finished notebook builds, one entry per cache key::
+
+        <cache_dir>/<key[:2]>/<key>/result.json
+        <cache_dir>/<key[:2]>/<key>/<notebook>.html
+
+    An entry's mtime is bumped on every hit, and eviction removes the least
+    recently used entries until the cache fits in max_bytes.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        entry_path: str = self.entry_path(key)
+        result_path: str = os.path.join(entry_path, CACHE_RESULT_FILE)
+        if not os.path.exists(result_path):
+            return None
+
+        try:
+            with open(result_path, 'r', encoding=ENCODING) as stream:
+                result: typing.Dict[str, typing.Any] = json.load(stream)
+
+        except (OSError, ValueError) as err:
+            logger.warning(f'Discarding unreadable cache entry[{entry_path}]: {err}')
+            shutil.rmtree(entry_path, ignore_errors=True)
+            return None
+
+        os.utime(entry_path)
+        return result
+
+    def restore(self, key: str, dest_dir: str) -> typing.List[str]:
+        entry_path: str = self.entry_path(key)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+
+        restored: typing.List[str] = []
+        for filename in sorted(os.listdir(entry_path)):
+            if filename == CACHE_RESULT_FILE:
+                continue
+
+            dest_path: str = os.path.join(dest_dir, filename)
+            shutil.copyfile(os.path.join(entry_path, filename), dest_path)
+            restored.append(dest_path)
+
+        return restored
+
+    def put(self, key: str, result: typing.Dict[str, typing.Any], filepaths: typing.List[str]) -> None:
+        entry_path: str = self.entry_path(key)
+        entry_parent: str = os.path.dirname(entry_path)
+        if not os.path.exists(entry_parent):
+            os.makedirs(entry_parent)
+
+        # Assemble the entry next to its final location and rename it into
+        # place, so concurrent builds and readers never see half an entry.
+        staging_path: str = tempfile.mkdtemp(prefix=f'.{key}-', dir=entry_parent)
+        try:
+            for filepath in filepaths:
+                shutil.copyfile(filepath, os.path.join(staging_path, os.path.basename(filepath)))
+
+            with open(os.path.join(staging_path, CACHE_RESULT_FILE), 'w', encoding=ENCODING) as stream:
+                json.dump(result, stream, indent=2, sort_keys=True)
+
+            if os.path.exists(entry_path):
+                shutil.rmtree(entry_path)
+
+            os.rename(staging_path, entry_path)
+
+        except OSError:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise
+
+    def evict(self) -> int:
+        entries: typing.List[typing.Tuple[float, int, str]] = []
+        total_bytes: int = 0
+        if not os.path.exists(self.cache_dir):
+            return 0
+
+        for prefix in os.listdir(self.cache_dir):
+            prefix_path: str = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+
+            for key in os.listdir(prefix_path):
+                entry_path: str = os.path.join(prefix_path, key)
+                entry_bytes: int = sum(entry.stat().st_size for entry in os.scandir(entry_path) if entry.is_file())
+                entries.append((os.stat(entry_path).st_mtime, entry_bytes, entry_path))
+                total_bytes += entry_bytes
+
+        evicted: int = 0
+        for _, entry_bytes, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+
+            logger.info(f'Evicting cache entry[{entry_path}]')
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= entry_bytes
+            evicted += 1
+
+        return evicted
+
+
+def cached_result(exit_code: int, duration: float, peak_rss_kb: int) -> typing.Dict[str, typing.Any]:
+    return {
+        'exit-code': exit_code,
+        'duration': duration,
+        'peak-rss-kb': peak_rss_kb,
+        'created': time.time(),
+    }
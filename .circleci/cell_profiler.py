@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import time
+import typing
+
+logger = logging.getLogger(__file__)
+
+ENCODING: str = 'utf-8'
+PROFILE_REPORT_PATH: str = '/tmp/test-results/cell-profile.json'
+BASELINE_REPORT_PATH: str = os.path.join(os.path.expanduser('~'), '.cache', 'notebooks', 'cell-profile.json')
+REGRESSION_THRESHOLD: float = 2.0
+# Cells faster than this in both builds are noise, whatever their ratio.
+REGRESSION_MIN_SECONDS: float = 1.0
+REPORT_VERSION: int = 1
+CLOCK_TICKS: int = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+class CellProfile(typing.NamedTuple):
+    index: int
+    source_hash: str
+    wall_time: float
+    cpu_time: typing.Optional[float]
+    peak_rss_kb: typing.Optional[int]
+
+
+class Regression(typing.NamedTuple):
+    notebook: str
+    cell_index: int
+    metric: str
+    previous: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.previous if self.previous else float('inf')
+
+    def __str__(self) -> str:
+        return f'{self.notebook} cell[{self.cell_index}] {self.metric} {self.previous:.2f} -> {self.current:.2f} ({self.ratio:.1f}x)'
+
+
+def read_process_usage(pid: int) -> typing.Tuple[typing.Optional[float], typing.Optional[int]]:
+    """
+    CPU seconds used so far and peak resident set size (KiB) of pid, read
+    from /proc. Returns (None, None) where /proc is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as stream:
+            # The command name may contain spaces, so split after its closing paren.
+            fields: typing.List[str] = stream.read().rsplit(')', 1)[1].split()
+
+        cpu_time: float = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        peak_rss_kb: int = None
+        with open(f'/proc/{pid}/status', 'r') as stream:
+            for line in stream:
+                if line.startswith('VmHWM:'):
+                    peak_rss_kb = int(line.split()[1])
+                    break
+
+        return cpu_time, peak_rss_kb
+
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+def reset_peak_rss(pid: int) -> None:
+    """Reset VmHWM to the current RSS, so the next reading covers one cell only."""
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as stream:
+            stream.write('5')
+
+    except OSError:
+        pass
+
+
+def cell_key(profile: typing.Dict[str, typing.Any], seen: typing.Dict[str, int]) -> str:
+    # Cells are matched across builds by their source rather than their
+    # position, so inserting a cell does not compare every later cell with
+    # its predecessor. Repeated identical cells are told apart by occurrence.
+    occurrence: int = seen.get(profile['source_hash'], 0)
+    seen[profile['source_hash']] = occurrence + 1
+    return f"{profile['source_hash']}:{occurrence}"
+
+
+def notebook_report(cell_profiles: typing.List[CellProfile], duration: float) -> typing.Dict[str, typing.Any]:
+    cells: typing.List[typing.Dict[str, typing.Any]] = [profile._asdict() for profile in cell_profiles]
+    return {
+        'duration': duration,
+        'cell-wall-time': sum(cell['wall_time'] for cell in cells),
+        'cell-cpu-time': sum(cell['cpu_time'] or 0 for cell in cells),
+        'peak-rss-kb': max([cell['peak_rss_kb'] or 0 for cell in cells] or [0]),
+        'cells': cells,
+    }
+
+
+def new_report() -> typing.Dict[str, typing.Any]:
+    return {'version': REPORT_VERSION, 'created': time.time(), 'notebooks': {}}
+
+
+def load_report(report_path: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    if not os.path.exists(report_path):
+        return None
+
+    try:
+        with open(report_path, 'r', encoding=ENCODING) as stream:
+            report: typing.Dict[str, typing.Any] = json.load(stream)
+
+    except (OSError, ValueError) as err:
+        logger.warning(f'Unable to read profile report[{report_path}]: {err}')
+        return None
+
+    if report.get('version') != REPORT_VERSION:
+        logger.warning(f'Ignoring profile report[{report_path}] with version[{report.get("version")}]')
+        return None
+
+    return report
+
+
+def write_report(report_path: str, report: typing.Dict[str, typing.Any]) -> None:
+    report_dir: str = os.path.dirname(report_path)
+    if report_dir and not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+
+    tmp_path: str = f'{report_path}.tmp'
+    with open(tmp_path, 'w', encoding=ENCODING) as stream:
+        json.dump(report, stream, indent=2, sort_keys=True)
+
+    os.replace(tmp_path, report_path)
+
+
+def find_regressions(current: typing.Dict[str, typing.Any], previous: typing.Dict[str, typing.Any],
+                     threshold: float = REGRESSION_THRESHOLD,
+                     min_seconds: float = REGRESSION_MIN_SECONDS) -> typing.List[Regression]:
+    regressions: typing.List[Regression] = []
+    for notebook, notebook_profile in sorted(current['notebooks'].items()):
+        previous_profile: typing.Dict[str, typing.Any] = previous['notebooks'].get(notebook)
+        if previous_profile is None:
+            continue
+
+        seen: typing.Dict[str, int] = {}
+        previous_cells: typing.Dict[str, typing.Dict[str, typing.Any]] = {
+            cell_key(cell, seen): cell for cell in previous_profile['cells']
+        }
+        seen = {}
+        for cell in notebook_profile['cells']:
+            previous_cell: typing.Dict[str, typing.Any] = previous_cells.get(cell_key(cell, seen))
+            if previous_cell is None:
+                continue
+
+            for metric in ['wall_time', 'cpu_time']:
+                now, before = cell[metric], previous_cell[metric]
+                if now is None or before is None or max(now, before) < min_seconds:
+                    continue
+
+                if now > before * threshold:
+                    regressions.append(Regression(notebook, cell['index'], metric, before, now))
+
+    return regressions
+
+
+def summary_properties(notebook_profile: typing.Dict[str, typing.Any],
+                       regressions: typing.List[Regression]) -> typing.List[typing.Tuple[str, str]]:
+    """Condensed, per-notebook view of a report for the JUnit test case."""
+    properties: typing.List[typing.Tuple[str, str]] = [
+        ('cell-count', str(len(notebook_profile['cells']))),
+        ('cell-wall-time', f"{notebook_profile['cell-wall-time']:.3f}"),
+        ('cell-cpu-time', f"{notebook_profile['cell-cpu-time']:.3f}"),
+        ('cell-peak-rss-kb', str(notebook_profile['peak-rss-kb'])),
+    ]
+    if notebook_profile['cells']:
+        slowest: typing.Dict[str, typing.Any] = max(notebook_profile['cells'], key=lambda cell: cell['wall_time'])
+        properties.append(('slowest-cell', f"{slowest['index']} ({slowest['wall_time']:.3f}s)"))
+
+    properties.append(('cell-regressions', str(len(regressions))))
+    for regression in regressions:
+        properties.append((f'regression-cell-{regression.cell_index}-{regression.metric}', str(regression)))
+
+    return properties
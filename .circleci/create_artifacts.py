@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
+import argparse
+import json
 import logging
 import os
-import shutil
 import sys
-import tarfile
-import tempfile
 import types
 import typing
 
+from artifact_io import ARTIFACT_SUFFIXES, available_compressions, pack_artifact
+from build_cache import BuildCache, CACHE_DIR, CACHE_KEY_FILE, ENGINES, build_cache_key
+from env_pool import ENV_POOL_DIR, WHEEL_DIR, pooled_env_script
+from notebook_manifest import MANIFEST_PATH, REQUIREMENTS_FILE, Manifest, load_manifest
+
 root = logging.getLogger()
 root.setLevel(logging.INFO)
 handler = logging.StreamHandler(sys.stdout)
@@ -17,65 +21,84 @@ root.addHandler(handler)
 
 logger = logging.getLogger(__file__)
 
-IPYDB_REQUIRED_FILES: typing.List[str] = ['requirements.txt']
 ENCODING: str = 'utf-8'
 ARTIFACT_DEST_DIR: str = '/tmp/artifacts'
+ENVIRONMENT_PATH: str = 'environment.yml'
+
+def find_ipynb_files(manifest: Manifest) -> types.GeneratorType:
+    """Yields (notebook directory, requirements hash) for every directory in the manifest."""
+    for directory, entries in manifest.directories().items():
+        if entries[0].requirements_hash is None:
+            logger.error(f'Missing file[{REQUIREMENTS_FILE}] in dir[{directory}]')
+            continue
 
-def find_ipynb_files(start_path: str) -> types.GeneratorType:
-    for root, dirnames, filenames in os.walk(start_path):
-        is_ipydb_directory: bool = False
-        for filename in filenames:
-            if filename.endswith('.ipynb'):
-                is_ipydb_directory = True
-                break
+        yield manifest.absolute_path(directory), entries[0].requirements_hash
 
-        if is_ipydb_directory:
-            has_error: bool = False
-            for filename in IPYDB_REQUIRED_FILES:
-                if not filename in filenames:
-                    logger.error(f'Missing file[{filename}] in dir[{os.path.relpath(root)}]')
-                    has_error = True
+def parse_args(args: typing.List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Package every notebook directory as a build artifact')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR,
+                        help=f'Build cache directory (default: {CACHE_DIR})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Package every notebook, even if an identical build is cached')
+    parser.add_argument('--env-pool-dir', type=str, default=ENV_POOL_DIR,
+                        help=f'Directory of shared virtualenvs, one per distinct requirements set (default: {ENV_POOL_DIR})')
+    parser.add_argument('--wheel-dir', type=str, default=WHEEL_DIR,
+                        help=f'Local wheel directory pip installs from when it exists (default: {WHEEL_DIR})')
+    parser.add_argument('--offline', action='store_true',
+                        help='Install only from --wheel-dir, never from the package index')
+    parser.add_argument('--manifest', type=str, default=MANIFEST_PATH,
+                        help=f'Notebook manifest to refresh and share with the later build steps (default: {MANIFEST_PATH})')
+    parser.add_argument('--engine', type=str, choices=ENGINES, default='shell',
+                        help='Engine build_artifacts.py will run with; cached builds are only reused for the same one')
+    parser.add_argument('--compression', type=str, choices=available_compressions(), default='gz',
+                        help='Artifact compression; zst needs the zstandard package, none skips compression')
+    return parser.parse_args(args)
 
-            if has_error is False:
-                yield os.path.abspath(root)
+def write_cached_record(notebook_name_plain: str, cache_key: str, engine: str) -> None:
+    record_path: str = os.path.join(ARTIFACT_DEST_DIR, f'{notebook_name_plain}.cached.json')
+    with open(record_path, 'w', encoding=ENCODING) as stream:
+        json.dump({'notebook': notebook_name_plain, 'cache-key': cache_key, 'engine': engine}, stream)
 
-def main():
-    for notebook_path in find_ipynb_files(os.getcwd()):
+def main(args: typing.List[str] = None):
+    options = parse_args(args)
+    cache: BuildCache = None if options.no_cache else BuildCache(options.cache_dir)
+    if not os.path.exists(ARTIFACT_DEST_DIR):
+        os.makedirs(ARTIFACT_DEST_DIR)
+
+    # This is the first step of a build, so it rescans the tree; the build
+    # and convert steps reuse the manifest written here. CI packages every
+    # notebook: exclude_notebooks only applies to convert.py's HTML pages.
+    manifest: Manifest = load_manifest(os.getcwd(), [], options.manifest, rescan=True)
+    for notebook_path, env_hash in find_ipynb_files(manifest):
         logger.info(f'Found notebook in path[{os.path.relpath(notebook_path)}]. Building Artifact')
         notebook_name: str = os.path.basename(notebook_path)
         notebook_name_plain: str = notebook_name.rsplit('.', 1)[0]
-        build_path = tempfile.mkdtemp(prefix=notebook_name)
-        shutil.rmtree(build_path)
-        build_script_path = os.path.join(build_path, 'build.sh')
-        shutil.copytree(notebook_path, build_path)
+        env_script: str = pooled_env_script(env_hash, os.path.abspath(options.env_pool_dir),
+                                            os.path.abspath(options.wheel_dir), options.offline)
         setup_script: str = f"""#!/usr/bin/env bash
 set -e
-cd {build_path}
+cd "$(dirname "$0")"
 source activate notebooks_env
-virtualenv -p $(which python3) env
-conda deactivate
-source env/bin/activate
-pip install -r requirements.txt
-pip install jupyter
+{env_script}conda deactivate
+source "$ENV_DIR/bin/activate"
+echo "$ENV_DIR/bin/python" > .notebook-python
+if [ -n "$NOTEBOOK_SKIP_EXECUTE" ]; then exit 0; fi
 jupyter nbconvert --stdout --to html {notebook_name} > {notebook_name_plain}.html
 cd -
 """
-        with open(build_script_path, 'w') as stream:
-            stream.write(setup_script)
-    
+        cache_key: str = build_cache_key(notebook_path, ENVIRONMENT_PATH, setup_script, options.engine)
+        if cache is not None and cache.get(cache_key) is not None:
+            logger.info(f'Notebook[{notebook_name}] is unchanged since build[{cache_key}]. Reusing cached build')
+            write_cached_record(notebook_name_plain, cache_key, options.engine)
+            continue
+
         logger.info(f'Taring Notebook[{notebook_name}]')
-        artifact_name: str = f'{notebook_name_plain}.tar.gz'
-        artifact_dir_path: str = os.path.dirname(tempfile.NamedTemporaryFile().name)
-        artifact_path: str = os.path.join(artifact_dir_path, artifact_name)
-        with tarfile.open(artifact_path, "w:gz") as tar:
-            tar.add(build_path, arcname=os.path.basename(build_path))
-    
-        if not os.path.exists(ARTIFACT_DEST_DIR):
-            os.makedirs(ARTIFACT_DEST_DIR)
-    
+        artifact_name: str = f'{notebook_name_plain}{ARTIFACT_SUFFIXES[options.compression]}'
         artifact_dest: str = os.path.join(ARTIFACT_DEST_DIR, artifact_name)
-        logger.info(f'Moving Notebook[{notebook_name_plain}]')
-        shutil.move(artifact_path, artifact_dest)
+        pack_artifact(notebook_path, notebook_name, artifact_dest, options.compression, extra_files={
+            'build.sh': setup_script.encode(ENCODING),
+            CACHE_KEY_FILE: cache_key.encode(ENCODING),
+        })
 
 if __name__ in ['__main__']:
     main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import re
+import typing
+
+ENCODING: str = 'utf-8'
+ENV_POOL_DIR: str = '/tmp/env-pool'
+WHEEL_DIR: str = os.path.join(os.path.expanduser('~'), '.cache', 'notebooks', 'wheels')
+# Packages every build installs on top of the notebook's own requirements.
+BASE_REQUIREMENTS: typing.List[str] = ['jupyter']
+# Bump to invalidate every pooled environment, e.g. after changing how they are built.
+ENV_POOL_VERSION: str = '1'
+
+REQUIREMENT_NAME_PATTERN = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$')
+
+
+def normalize_requirement(line: str) -> str:
+    """
+    Reduces one requirements.txt line to a canonical form, so that
+    "Numpy >= 1.21" and "numpy>=1.21  # arrays" hash the same.
+    """
+    requirement: str = line.split('#', 1)[0].strip()
+    requirement = re.sub(r'\s+', '', requirement)
+    match = REQUIREMENT_NAME_PATTERN.match(requirement)
+    if match is None:
+        # URLs, editable installs and options are kept verbatim.
+        return requirement
+
+    name, specifier = match.groups()
+    name = re.sub(r'[-_.]+', '-', name).lower()
+    return f'{name}{specifier}'
+
+
+def normalize_requirements(requirements_path: str) -> typing.List[str]:
+    requirements: typing.Set[str] = set(normalize_requirement(requirement) for requirement in BASE_REQUIREMENTS)
+    with open(requirements_path, 'r', encoding=ENCODING) as stream:
+        for line in stream:
+            requirement: str = normalize_requirement(line)
+            if requirement:
+                requirements.add(requirement)
+
+    return sorted(requirements)
+
+
+def requirements_hash(requirements_path: str) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(f'env-pool-v{ENV_POOL_VERSION}\n'.encode(ENCODING))
+    for requirement in normalize_requirements(requirements_path):
+        hasher.update(requirement.encode(ENCODING) + b'\n')
+
+    return hasher.hexdigest()[:16]
+
+
+def pooled_env_script(env_hash: str, env_pool_dir: str = ENV_POOL_DIR, wheel_dir: str = WHEEL_DIR, offline: bool = False) -> str:
+    """
+    Bash snippet that makes the pooled environment for env_hash available in
+    $ENV_DIR, building it first if no other build has. Creation is serialized
+    per environment with flock, so concurrent builds that share requirements
+    wait for one install instead of racing each other, while builds of
+    different environments still proceed in parallel. The .complete marker is
+    only written after a successful install, so a failed build is retried.
+    """
+    index_option: str = '--no-index' if offline else ''
+    base_requirements: str = ' '.join(BASE_REQUIREMENTS)
+    return f"""ENV_DIR={env_pool_dir}/{env_hash}
+mkdir -p {env_pool_dir}
+(
+    flock 9
+    if [ ! -f "$ENV_DIR/.complete" ]; then
+        rm -rf "$ENV_DIR"
+        virtualenv -p $(which python3) "$ENV_DIR"
+        PIP_OPTIONS="{index_option}"
+        if [ -d "{wheel_dir}" ]; then PIP_OPTIONS="$PIP_OPTIONS --find-links {wheel_dir}"; fi
+        "$ENV_DIR/bin/pip" install $PIP_OPTIONS -r requirements.txt {base_requirements}
+        touch "$ENV_DIR/.complete"
+    fi
+) 9> "$ENV_DIR.lock"
+"""
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+import hashlib
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import typing
+
+import nbformat
+
+from jupyter_client import KernelManager
+from jupyter_client.asynchronous import AsyncKernelClient
+from jupyter_client.kernelspec import KernelSpec, KernelSpecManager
+from nbclient import NotebookClient
+from nbclient.exceptions import CellExecutionError, CellTimeoutError, DeadKernelError
+from nbclient.util import ensure_async, run_sync
+from nbconvert import HTMLExporter
+from traitlets import Unicode
+
+from cell_profiler import CellProfile, read_process_usage, reset_peak_rss
+
+logger = logging.getLogger(__file__)
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_FILE: str = os.path.join(REPO_ROOT, 'nb_html.tpl')
+CELL_TIMEOUT: int = 600
+STARTUP_TIMEOUT: int = 60
+KERNELS_PER_ENV: int = 1
+# A kernel that fails to start is tried this many times before its pool slot is given up
+START_ATTEMPTS: int = 2
+
+
+class ExecutionResult(typing.NamedTuple):
+    notebook_path: str
+    html: str
+    duration: float
+    cell_profiles: typing.List[CellProfile]
+    error: typing.Optional[str]
+
+
+class PythonKernelSpecManager(KernelSpecManager):
+    """
+    Resolves every kernel name to an ipykernel running on one interpreter, so
+    a kernel can be started inside a notebook's own environment without that
+    environment registering a kernelspec.
+    """
+    python = Unicode(sys.executable)
+
+    def get_kernel_spec(self, kernel_name: str) -> KernelSpec:
+        return KernelSpec(argv=[self.python, '-m', 'ipykernel_launcher', '-f', '{connection_file}'],
+                          display_name=f'Python ({self.python})', language='python')
+
+
+def kernel_pid(km: KernelManager) -> typing.Optional[int]:
+    provisioner = getattr(km, 'provisioner', None)
+    if provisioner is not None:
+        return getattr(provisioner, 'pid', None)
+
+    # jupyter_client < 7 keeps the kernel's Popen on the manager.
+    return getattr(getattr(km, 'kernel', None), 'pid', None)
+
+
+class ProfilingNotebookClient(NotebookClient):
+    """
+    Records wall time, CPU time and peak RSS of the kernel process for every
+    code cell. CPU and memory come from /proc and are None elsewhere.
+    """
+
+    def __init__(self, *args, kernel_pid: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kernel_pid = kernel_pid
+        self.cell_profiles: typing.List[CellProfile] = []
+
+    async def async_execute_cell(self, cell, cell_index, *args, **kwargs):
+        if cell.cell_type != 'code':
+            return await super().async_execute_cell(cell, cell_index, *args, **kwargs)
+
+        cpu_start: float = None
+        if self.kernel_pid is not None:
+            reset_peak_rss(self.kernel_pid)
+            cpu_start, _ = read_process_usage(self.kernel_pid)
+
+        start: float = time.perf_counter()
+        try:
+            return await super().async_execute_cell(cell, cell_index, *args, **kwargs)
+
+        finally:
+            wall_time: float = time.perf_counter() - start
+            cpu_time, peak_rss_kb = None, None
+            if self.kernel_pid is not None:
+                cpu_end, peak_rss_kb = read_process_usage(self.kernel_pid)
+                if cpu_start is not None and cpu_end is not None:
+                    cpu_time = cpu_end - cpu_start
+
+            source_hash: str = hashlib.sha1(cell.source.encode('utf-8')).hexdigest()[:12]
+            self.cell_profiles.append(CellProfile(cell_index, source_hash, wall_time, cpu_time, peak_rss_kb))
+
+
+class KernelPool:
+    """
+    Keeps `size` kernels for one interpreter started ahead of time. A kernel
+    handed back with release() has run someone else's notebook, so it is
+    restarted in the background before it is handed out again; the next
+    notebook never waits for a kernel to boot unless the pool is exhausted,
+    and never sees state left behind by the previous one.
+    A slot whose kernel cannot be started is given up; once every slot is
+    given up the pool is broken, and acquire() raises the start failure to
+    every caller instead of waiting for a kernel that will never come.
+    """
+
+    def __init__(self, python: str, size: int = KERNELS_PER_ENV, startup_timeout: int = STARTUP_TIMEOUT):
+        self.python = python
+        self.startup_timeout = startup_timeout
+        self._idle: queue.Queue = queue.Queue()
+        self._managers: typing.List[KernelManager] = []
+        self._threads: typing.List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._failed_slots: int = 0
+        for _ in range(size):
+            km = KernelManager(kernel_spec_manager=PythonKernelSpecManager(python=python))
+            self._managers.append(km)
+            self._in_background(self._start, km)
+
+    def _in_background(self, target: typing.Callable, km: KernelManager) -> None:
+        thread = threading.Thread(target=target, args=(km,), daemon=True)
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+
+        thread.start()
+
+    def _wait_for_ready(self, km: KernelManager) -> None:
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.startup_timeout)
+
+        finally:
+            kc.stop_channels()
+
+    def _start(self, km: KernelManager) -> None:
+        error: Exception = None
+        for attempt in range(1, START_ATTEMPTS + 1):
+            try:
+                km.start_kernel()
+                self._wait_for_ready(km)
+                self._idle.put(km)
+                return
+
+            except Exception as err:
+                logger.error(f'Unable to start kernel for python[{self.python}] '
+                             f'(attempt {attempt} of {START_ATTEMPTS}): {err}')
+                error = err
+                try:
+                    if km.has_kernel:
+                        km.shutdown_kernel(now=True)
+
+                except Exception:
+                    pass
+
+        with self._lock:
+            self._failed_slots += 1
+
+        self._idle.put(error)
+
+    def _recycle(self, km: KernelManager) -> None:
+        try:
+            km.restart_kernel(now=True)
+            self._wait_for_ready(km)
+            self._idle.put(km)
+
+        except Exception as err:
+            logger.warning(f'Restart failed for python[{self.python}], starting a new kernel: {err}')
+            try:
+                km.shutdown_kernel(now=True)
+
+            except Exception:
+                pass
+
+            self._start(km)
+
+    @property
+    def broken(self) -> bool:
+        with self._lock:
+            return self._failed_slots >= len(self._managers)
+
+    def acquire(self) -> KernelManager:
+        while True:
+            item = self._idle.get()
+            if not isinstance(item, Exception):
+                return item
+
+            if self.broken:
+                # Put the failure back for the next caller waiting on this pool.
+                self._idle.put(item)
+                raise item
+
+            # Other slots still have kernels; wait for one of those.
+
+    def release(self, km: KernelManager) -> None:
+        self._in_background(self._recycle, km)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            threads = list(self._threads)
+
+        for thread in threads:
+            thread.join()
+
+        for km in self._managers:
+            if km.has_kernel:
+                km.shutdown_kernel(now=True)
+
+
+class ExecutionEngine:
+    """
+    Executes notebooks on warm kernels and renders them to HTML with one
+    preloaded exporter, replacing a `jupyter nbconvert --execute` process (and
+    its interpreter start-up, kernel spawn and template load) per notebook.
+    Every code cell is profiled, see ProfilingNotebookClient.
+    Kernels are pooled per interpreter, so notebooks built in different
+    environments never share one. Safe to call from several threads.
+    """
+
+    def __init__(self, template_file: str = TEMPLATE_FILE, kernels_per_env: int = KERNELS_PER_ENV,
+                 cell_timeout: int = CELL_TIMEOUT, startup_timeout: int = STARTUP_TIMEOUT):
+        self.kernels_per_env = kernels_per_env
+        self.cell_timeout = cell_timeout
+        self.startup_timeout = startup_timeout
+        self._pools: typing.Dict[str, KernelPool] = {}
+        self._pools_lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self.exporter = HTMLExporter(template_file=os.path.abspath(template_file))
+        # Load and compile the template now rather than on the first notebook.
+        self.exporter.from_notebook_node(nbformat.v4.new_notebook())
+
+    def pool_for(self, python: str) -> KernelPool:
+        with self._pools_lock:
+            if python not in self._pools:
+                logger.info(f'Starting [{self.kernels_per_env}] kernels for python[{python}]')
+                self._pools[python] = KernelPool(python, self.kernels_per_env, self.startup_timeout)
+
+            return self._pools[python]
+
+    async def _async_execute(self, client: ProfilingNotebookClient, km: KernelManager, cwd: str) -> None:
+        kc = AsyncKernelClient()
+        kc.load_connection_info(km.get_connection_info())
+        kc.start_channels()
+        client.kc = kc
+        try:
+            await ensure_async(kc.wait_for_ready(timeout=self.startup_timeout))
+            # Pooled kernels were started before we knew which notebook they
+            # would run, so move them into the notebook's directory first.
+            msg_id: str = kc.execute(f'import os as _os; _os.chdir({cwd!r}); del _os', silent=True, store_history=False)
+            await client.async_wait_for_reply(msg_id)
+            await client.async_execute()
+
+        finally:
+            kc.stop_channels()
+
+    def export(self, nb: nbformat.NotebookNode, resources: typing.Dict[str, typing.Any] = None) -> str:
+        with self._export_lock:
+            html, _ = self.exporter.from_notebook_node(nb, resources=resources)
+
+        return html
+
+    def execute(self, notebook_path: str, python: str = sys.executable,
+                resources: typing.Dict[str, typing.Any] = None) -> ExecutionResult:
+        notebook_path = os.path.abspath(notebook_path)
+        nb: nbformat.NotebookNode = nbformat.read(notebook_path, as_version=4)
+        pool: KernelPool = self.pool_for(python)
+        km: KernelManager = pool.acquire()
+        error: str = None
+        try:
+            client = ProfilingNotebookClient(nb, km=km, timeout=self.cell_timeout,
+                                             startup_timeout=self.startup_timeout, kernel_pid=kernel_pid(km))
+            start: float = time.perf_counter()
+            try:
+                run_sync(self._async_execute)(client, km, os.path.dirname(notebook_path))
+
+            except (CellExecutionError, CellTimeoutError, DeadKernelError) as err:
+                error = f'{type(err).__name__}: {err}'
+
+            duration: float = time.perf_counter() - start
+
+        finally:
+            pool.release(km)
+
+        html: str = self.export(nb, resources)
+        return ExecutionResult(notebook_path, html, duration, client.cell_profiles, error)
+
+    def shutdown(self) -> None:
+        with self._pools_lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+
+        for pool in pools:
+            pool.shutdown()
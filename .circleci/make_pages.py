@@ -2,6 +2,7 @@
 
 import logging
 import os
+import runpy
 import sys
 
 from nbpages import make_parser, run_parsed, make_html_index
@@ -19,8 +20,10 @@ def main():
     repo_path = os.getcwd()
     logger.info(f'Added path[{repo_path}]')
     sys.path.append(repo_path)
-    with open("convert.py") as f:
-        exec(f.read())
+    # run_path gives convert.py a module namespace of its own; exec() inside
+    # main() left its functions unable to see its imports, and unpicklable
+    # for the --workers process pool.
+    runpy.run_path('convert.py', run_name='__main__')
 
 if __name__ in ['__main__']:
     main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import re
+import typing
+
+from build_cache import hash_file
+from env_pool import requirements_hash
+
+logger = logging.getLogger(__file__)
+
+ENCODING: str = 'utf-8'
+MANIFEST_PATH: str = '.notebook-manifest.json'
+MANIFEST_VERSION: int = 1
+REQUIREMENTS_FILE: str = 'requirements.txt'
+
+
+class NotebookEntry(typing.NamedTuple):
+    # Relative to the scanned root and starting with './', like os.walk('.').
+    path: str
+    mtime_ns: int
+    size: int
+    content_hash: str
+    # None when the notebook directory has no requirements.txt.
+    requirements_hash: typing.Optional[str]
+
+    @property
+    def directory(self) -> str:
+        return os.path.dirname(self.path)
+
+
+def split_patterns(value: typing.Optional[str]) -> typing.List[str]:
+    return [pattern for pattern in (value or '').split(',') if pattern]
+
+
+def compile_patterns(patterns: typing.List[str]) -> typing.Optional[typing.Pattern]:
+    """
+    Folds the patterns into one regular expression. Like nbpages, a pattern
+    matches anywhere in the path, so a path matches '*pattern*'.
+    """
+    if not patterns:
+        return None
+
+    return re.compile('|'.join(fnmatch.translate(f'*{pattern}*') for pattern in patterns))
+
+
+def content_hash(path: str) -> str:
+    hasher = hashlib.sha256()
+    hash_file(hasher, path)
+    return hasher.hexdigest()
+
+
+def scan_tree(root: str, exclude: typing.Optional[typing.Pattern] = None) -> typing.Iterator[
+        typing.Tuple[str, os.stat_result, typing.Optional[os.stat_result]]]:
+    """
+    Yields (path, stat, requirements stat) for every notebook below root,
+    listing each directory once with os.scandir. Paths are relative to root
+    and start with './', which is also what the exclude pattern is matched
+    against. Hidden directories are skipped, and so is any directory the
+    exclude pattern matches: the patterns match anywhere in the path, so
+    nothing below an excluded directory could be included anyway.
+    """
+    pending: typing.List[typing.Tuple[str, str]] = [(root, '.')]
+    while pending:
+        directory, relative_dir = pending.pop()
+        notebooks: typing.List[typing.Tuple[str, os.stat_result]] = []
+        subdirs: typing.List[typing.Tuple[str, str]] = []
+        requirements_stat: os.stat_result = None
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    relative_path: str = f'{relative_dir}/{entry.name}'
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name.startswith('.'):
+                            continue
+
+                        if exclude is not None and exclude.match(relative_path):
+                            logger.info(f'Skipping excluded dir[{relative_path}]')
+                            continue
+
+                        subdirs.append((entry.path, relative_path))
+
+                    elif entry.name.endswith('.ipynb') and entry.is_file():
+                        if exclude is None or not exclude.match(relative_path):
+                            notebooks.append((relative_path, entry.stat()))
+
+                    elif entry.name == REQUIREMENTS_FILE and entry.is_file():
+                        requirements_stat = entry.stat()
+
+        except OSError as err:
+            logger.warning(f'Unable to scan dir[{relative_dir}]: {err}')
+            continue
+
+        for path, stat in sorted(notebooks):
+            yield path, stat, requirements_stat
+
+        # Reversed, so directories come off the stack in sorted order.
+        pending.extend(sorted(subdirs, reverse=True))
+
+
+class Manifest:
+    """
+    Every notebook below root with its mtime, size, content hash and the
+    hash of its directory's requirements (see env_pool.requirements_hash),
+    saved as JSON so the create, build and convert steps share one scan of
+    the tree. Hashes are only recomputed for files whose mtime or size
+    changed since the previous manifest.
+    """
+
+    def __init__(self, root: str, excludes: typing.List[str], entries: typing.Dict[str, NotebookEntry] = None,
+                 requirements: typing.Dict[str, typing.List[typing.Any]] = None):
+        self.root = root
+        self.excludes = excludes
+        self.entries = entries or {}
+        # requirements.txt path -> [mtime_ns, size, requirements hash]
+        self.requirements = requirements or {}
+
+    def notebooks(self, include: typing.List[str] = None,
+                  exclude: typing.List[str] = None) -> typing.List[NotebookEntry]:
+        matcher = compile_patterns(include)
+        excluder = compile_patterns(exclude)
+        return [entry for path, entry in sorted(self.entries.items())
+                if (matcher is None or matcher.match(path)) and (excluder is None or not excluder.match(path))]
+
+    def directories(self) -> typing.Dict[str, typing.List[NotebookEntry]]:
+        directories: typing.Dict[str, typing.List[NotebookEntry]] = {}
+        for entry in self.notebooks():
+            directories.setdefault(entry.directory, []).append(entry)
+
+        return directories
+
+    def absolute_path(self, path: str) -> str:
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def is_current(self) -> bool:
+        """True if no listed file changed; costs one stat per file, no directory listing."""
+        tracked: typing.List[typing.Tuple[str, int, int]] = [
+            (entry.path, entry.mtime_ns, entry.size) for entry in self.entries.values()
+        ] + [(path, mtime_ns, size) for path, (mtime_ns, size, _) in self.requirements.items()]
+        for path, mtime_ns, size in tracked:
+            try:
+                stat: os.stat_result = os.stat(self.absolute_path(path))
+
+            except OSError:
+                return False
+
+            if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+                return False
+
+        return True
+
+    def _requirements_hash(self, path: str, stat: os.stat_result,
+                           previous: typing.Optional['Manifest']) -> str:
+        known: typing.List[typing.Any] = None if previous is None else previous.requirements.get(path)
+        if known is not None and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+            env_hash: str = known[2]
+
+        else:
+            env_hash = requirements_hash(self.absolute_path(path))
+
+        self.requirements[path] = [stat.st_mtime_ns, stat.st_size, env_hash]
+        return env_hash
+
+    def scan(self, previous: typing.Optional['Manifest'] = None) -> None:
+        self.entries = {}
+        self.requirements = {}
+        rehashed: int = 0
+        exclude = compile_patterns(self.excludes)
+        for path, stat, requirements_stat in scan_tree(self.root, exclude):
+            env_hash: str = None
+            if requirements_stat is not None:
+                env_hash = self._requirements_hash(os.path.join(os.path.dirname(path), REQUIREMENTS_FILE),
+                                                   requirements_stat, previous)
+
+            known: NotebookEntry = None if previous is None else previous.entries.get(path)
+            if known is not None and (known.mtime_ns, known.size) == (stat.st_mtime_ns, stat.st_size):
+                digest: str = known.content_hash
+
+            else:
+                digest = content_hash(self.absolute_path(path))
+                rehashed += 1
+
+            self.entries[path] = NotebookEntry(path, stat.st_mtime_ns, stat.st_size, digest, env_hash)
+
+        logger.info(f'Found [{len(self.entries)}] notebooks below root[{self.root}], hashed [{rehashed}]')
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'version': MANIFEST_VERSION,
+            'root': self.root,
+            'excludes': self.excludes,
+            'notebooks': [entry._asdict() for entry in self.notebooks()],
+            'requirements': self.requirements,
+        }
+
+    @classmethod
+    def from_json(cls, data: typing.Dict[str, typing.Any]) -> 'Manifest':
+        entries: typing.Dict[str, NotebookEntry] = {
+            notebook['path']: NotebookEntry(**notebook) for notebook in data['notebooks']
+        }
+        return cls(data['root'], data['excludes'], entries, data['requirements'])
+
+
+def read_manifest(manifest_path: str) -> typing.Optional[Manifest]:
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'r', encoding=ENCODING) as stream:
+            data: typing.Dict[str, typing.Any] = json.load(stream)
+
+        if data.get('version') != MANIFEST_VERSION:
+            return None
+
+        return Manifest.from_json(data)
+
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logger.warning(f'Unable to read manifest[{manifest_path}]: {err}')
+        return None
+
+
+def write_manifest(manifest_path: str, manifest: Manifest) -> None:
+    tmp_path: str = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w', encoding=ENCODING) as stream:
+        json.dump(manifest.to_json(), stream, indent=2, sort_keys=True)
+
+    os.replace(tmp_path, manifest_path)
+
+
+def load_manifest(start_path: str = '.', excludes: typing.List[str] = None, manifest_path: str = MANIFEST_PATH,
+                  rescan: bool = False) -> Manifest:
+    """
+    Returns the saved manifest when it covers the same root and excludes and
+    none of its files changed; otherwise scans the tree, reusing the saved
+    hashes of unchanged files, and saves the result. Notebooks added since
+    the last scan are only picked up by a scan, so the first step of a build
+    passes rescan=True and the later ones reuse what it found.
+    """
+    root: str = os.path.abspath(start_path)
+    excludes = list(excludes or [])
+    previous: Manifest = read_manifest(manifest_path)
+    if previous is not None and (previous.root, previous.excludes) != (root, excludes):
+        previous = None
+
+    if not rescan and previous is not None and previous.is_current():
+        logger.info(f'Using manifest[{manifest_path}] of [{len(previous.entries)}] notebooks')
+        return previous
+
+    manifest = Manifest(root, excludes)
+    manifest.scan(previous)
+    write_manifest(manifest_path, manifest)
+    return manifest
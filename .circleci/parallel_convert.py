@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import argparse
+import concurrent.futures
+import copy
+import glob
+import logging
+import multiprocessing.util
+import os
+import typing
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__file__)
+
+# One execution engine per worker process, created by the pool initializer.
+ENGINE = None
+
+
+class ConversionResult(typing.NamedTuple):
+    notebook_path: str
+    converted: typing.List[str]
+    profile: typing.Optional[typing.Dict[str, typing.Any]]
+    error: typing.Optional[str]
+
+
+def html_path_for(notebook_path: str) -> str:
+    return os.path.splitext(notebook_path)[0] + '.html'
+
+
+def is_stale(notebook_path: str) -> bool:
+    html_path: str = html_path_for(notebook_path)
+    if not os.path.exists(html_path):
+        return True
+
+    return os.path.getmtime(notebook_path) > os.path.getmtime(html_path)
+
+
+def start_engine(template_file: str) -> None:
+    global ENGINE
+    from execution_engine import ExecutionEngine
+
+    ENGINE = ExecutionEngine(template_file=template_file)
+    # Pool workers leave through os._exit, which skips atexit; a multiprocessing
+    # finalizer still runs, so the kernels do not outlive their worker.
+    multiprocessing.util.Finalize(None, ENGINE.shutdown, exitpriority=10)
+
+
+def convert_with_engine(notebook_path: str) -> ConversionResult:
+    from cell_profiler import notebook_report
+
+    pages_root: str = os.path.relpath('.', os.path.dirname(notebook_path))
+    html_path: str = html_path_for(notebook_path)
+    try:
+        result = ENGINE.execute(notebook_path, resources={'path_to_pages_root': f'{pages_root}/'})
+        with open(html_path, 'w', encoding='utf-8') as stream:
+            stream.write(result.html)
+
+    except Exception as err:
+        return ConversionResult(notebook_path, [], None, f'{type(err).__name__}: {err}')
+
+    return ConversionResult(notebook_path, [html_path], notebook_report(result.cell_profiles, result.duration),
+                            result.error)
+
+
+def convert_with_nbpages(notebook_path: str, args: argparse.Namespace) -> ConversionResult:
+    from nbpages import run_parsed
+
+    # run_parsed walks a directory, so point it at the notebook's own
+    # directory and include only this notebook (by path or by name); the
+    # notebook list was already filtered, so nothing else is excluded.
+    notebook_dir, notebook_name = os.path.split(notebook_path)
+    notebook_args: argparse.Namespace = copy.copy(args)
+    notebook_args.include = ','.join([glob.escape(notebook_path), glob.escape(notebook_name)])
+    notebook_args.exclude = None
+    try:
+        converted: typing.List[str] = list(run_parsed(notebook_dir or '.', output_type='HTML',
+                                                      args=notebook_args) or [])
+
+    except Exception as err:
+        return ConversionResult(notebook_path, [], None, f'{type(err).__name__}: {err}')
+
+    if not converted:
+        return ConversionResult(notebook_path, [], None, f'nbpages converted nothing for [{notebook_path}]')
+
+    return ConversionResult(notebook_path, converted, None, None)
+
+
+def convert_notebooks(notebook_paths: typing.List[str], args: argparse.Namespace, workers: int = 1,
+                      kernel_engine: bool = False, template_file: str = None,
+                      force: bool = False) -> typing.Iterator[ConversionResult]:
+    """
+    Converts notebook_paths to HTML on `workers` processes and yields each
+    result as soon as it is ready.
+    Notebooks whose HTML is newer than the notebook are not converted again
+    (unless force is set); their existing HTML is yielded straight away.
+    """
+    stale: typing.List[str] = []
+    for notebook_path in notebook_paths:
+        if force or is_stale(notebook_path):
+            stale.append(notebook_path)
+
+        else:
+            yield ConversionResult(notebook_path, [html_path_for(notebook_path)], None, None)
+
+    logger.info(f'Converting [{len(stale)}] of [{len(notebook_paths)}] notebooks with [{workers}] workers')
+    if not stale:
+        return
+
+    if kernel_engine:
+        initializer, initargs = start_engine, (template_file,)
+        convert, convert_args = convert_with_engine, ()
+
+    else:
+        initializer, initargs = None, ()
+        convert, convert_args = convert_with_nbpages, (args,)
+
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+
+        try:
+            for notebook_path in stale:
+                yield convert(notebook_path, *convert_args)
+
+        finally:
+            if ENGINE is not None:
+                ENGINE.shutdown()
+
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                                                initargs=initargs) as executor:
+        futures = {executor.submit(convert, notebook_path, *convert_args): notebook_path for notebook_path in stale}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield future.result()
+
+            except BrokenProcessPool as err:
+                # A worker died; every notebook not yet converted fails with it.
+                yield ConversionResult(futures[future], [], None, f'{type(err).__name__}: {err}')
@@ -2,10 +2,31 @@
 
 import os
 import logging
+import sys
 
 from nbpages import make_parser, run_parsed, make_html_index
 
-args = make_parser().parse_args()
+
+parser = make_parser()
+parser.add_argument('--kernel-engine', action='store_true',
+                    help='Execute and render notebooks on warm in-process kernels '
+                         '(see .circleci/execution_engine.py) instead of through nbpages')
+parser.add_argument('--profile-report', default=None,
+                    help='Write per-cell wall time, CPU time and peak memory to this JSON file, '
+                         'flagging cells that regressed against the report already there. '
+                         'Requires --kernel-engine')
+parser.add_argument('--regression-threshold', type=float, default=2.0,
+                    help='Slowdown factor past which a cell counts as regressed')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Convert notebooks in this many processes. Notebooks whose HTML is newer '
+                         'than the notebook itself are not converted again')
+parser.add_argument('--force', action='store_true',
+                    help='With --workers or --kernel-engine, convert notebooks even if their HTML is up to date')
+args = parser.parse_args()
+if args.profile_report and not args.kernel_engine:
+    parser.error('--profile-report needs --kernel-engine, nbpages does not expose per-cell timings')
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
 
 if args.template_file is None and os.path.exists('nb_html.tpl'):
     args.template_file = 'nb_html.tpl'
@@ -24,7 +45,44 @@ if args.exclude is None and args.include is None:
     if to_exclude:
         args.exclude = ','.join(to_exclude)
 
-converted = run_parsed('.', output_type='HTML', args=args)
+if args.kernel_engine or args.workers > 1:
+    sys.path.insert(0, os.path.abspath('.circleci'))
+    from parallel_convert import convert_notebooks
+    from notebook_manifest import load_manifest, split_patterns
+    import cell_profiler
+
+    # Reuses the manifest create_artifacts.py wrote if nothing changed since.
+    # The manifest lists every notebook, as CI tests them all; the exclude
+    # patterns only apply to which ones are converted here.
+    manifest = load_manifest('.')
+    notebooks = [entry.path for entry in manifest.notebooks(split_patterns(args.include),
+                                                            split_patterns(args.exclude))]
+    template_file = args.template_file or os.path.abspath('nb_html.tpl')
+    report = cell_profiler.new_report()
+    by_notebook = {}
+    for result in convert_notebooks(notebooks, args, args.workers, args.kernel_engine, template_file, args.force):
+        if result.error is not None:
+            logging.getLogger('nbpages').error(f'Failed to convert {result.notebook_path}:\n{result.error}')
+        if result.profile is not None:
+            report['notebooks'][result.notebook_path] = result.profile
+        by_notebook[result.notebook_path] = result.converted
+        logging.getLogger('nbpages').info(f'Converted [{len(by_notebook)}/{len(notebooks)}] {result.notebook_path}')
+    # Results arrive in completion order; the index lists them in tree order.
+    converted = [html_path for nbpath in notebooks for html_path in by_notebook[nbpath]]
+
+    if args.profile_report:
+        previous = cell_profiler.load_report(args.profile_report)
+        if previous is not None:
+            for regression in cell_profiler.find_regressions(report, previous, args.regression_threshold):
+                logging.getLogger('nbpages').warning(f'Cell regression: {regression}')
+        if previous is not None and not args.force:
+            # Notebooks skipped as up to date keep their previous profile.
+            for nbpath, profile in previous['notebooks'].items():
+                if nbpath in by_notebook:
+                    report['notebooks'].setdefault(nbpath, profile)
+        cell_profiler.write_report(args.profile_report, report)
+else:
+    converted = run_parsed('.', output_type='HTML', args=args)
 
 logging.getLogger('nbpages').info('Generating index.html')
 make_html_index(converted, './index.tpl')
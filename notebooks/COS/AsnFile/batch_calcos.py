@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Runs the CalCOS pipeline on many association (asn) files at once, on a pool of processes.
+
+Each association is calibrated into its own directory, <outroot>/<asn rootname>/, so workers never share an outdir.
+All workers read the same reference files from the lref directory, which must already hold every file the exposures need (see the CalCOS Notebook).
+An association is skipped when all of its outputs are newer than the asn file and every raw exposure it lists, unless --force is given.
+
+CalCOS holds the events of an association in memory, so to stay within --memory-gb an association only starts while the estimated memory of the running ones leaves room for it.
+The estimate is MEMORY_PER_INPUT_BYTE times the size of its raw files, plus MEMORY_PER_PROCESS.
+
+For example, to reprocess every association below ./data on 8 processes within 48 GB:
+    python batch_calcos.py "data/**/*_asn.fits" --lref /grp/hst/cdbs/lref/ --outroot output/reprocessed --jobs 8 --memory-gb 48
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+# Rough peak memory of CalCOS per byte of raw input, and of a worker process with CalCOS imported
+MEMORY_PER_INPUT_BYTE = 6
+MEMORY_PER_PROCESS = 500 * 1024 ** 2
+# Share of the physical memory used when no --memory-gb is given
+DEFAULT_MEMORY_FRACTION = 0.75
+LOG_NAME = 'calcos.log'
+# Starts the line written to the log when CalCOS fails
+FAILURE_MARKER = 'CALCOS FAILED:'
+
+
+def asn_members(asn_path):
+    """
+    Reads the members of an association.
+
+    Returns:
+    list of str : MEMNAMEs of the exposures marked present (MEMPRSNT), lower case as in the file names.
+    list of str : MEMNAMEs of the products, lower case.
+    """
+    with fits.open(asn_path) as hdulist:
+        data = hdulist[1].data
+        memnames = np.char.lower(np.char.strip(np.asarray(data['MEMNAME'], dtype=str)))
+        memtypes = np.char.upper(np.char.strip(np.asarray(data['MEMTYPE'], dtype=str)))
+        present = np.asarray(data['MEMPRSNT'], dtype=bool)
+    is_product = np.char.startswith(memtypes, 'PROD')
+    return list(memnames[present & ~is_product]), list(memnames[is_product])
+
+
+class Association:
+    """An asn file with its raw input files and the directory its outputs go to."""
+
+    def __init__(self, asn_path, outroot):
+        self.asn_path = Path(asn_path)
+        self.rootname = self.asn_path.name.split('_asn')[0].lower()
+        self.outdir = Path(outroot) / self.rootname
+        self.exposures, self.products = asn_members(asn_path)
+        # CalCOS looks for the members' raw files next to the asn file.
+        self.inputs = [self.asn_path] + [
+            Path(path) for memname in self.exposures
+            for path in sorted(glob.glob(str(self.asn_path.parent / f'{memname}_raw*.fits*')))
+        ]
+
+    def outputs(self):
+        """The final products expected: an x1dsum per product, or an x1d per exposure for associations without one."""
+        names = [f'{name}_x1dsum.fits' for name in self.products] or [f'{name}_x1d.fits' for name in self.exposures]
+        return [self.outdir / name for name in names]
+
+    def failed_last_time(self):
+        """Whether the log of the last run records a CalCOS failure."""
+        log_path = self.outdir / LOG_NAME
+        if not log_path.exists():
+            return False
+        with open(log_path, errors='replace') as log:
+            return any(line.startswith(FAILURE_MARKER) for line in log)
+
+    def is_current(self):
+        outputs = self.outputs()
+        if not outputs or not all(path.exists() for path in outputs) or self.failed_last_time():
+            return False
+        return min(path.stat().st_mtime for path in outputs) > max(path.stat().st_mtime for path in self.inputs)
+
+    def memory_estimate(self):
+        return MEMORY_PER_PROCESS + MEMORY_PER_INPUT_BYTE * sum(path.stat().st_size for path in self.inputs[1:])
+
+
+def start_worker(lref):
+    os.environ['lref'] = str(lref)
+
+
+def run_calcos(asn_path, outdir, verbosity=0):
+    """
+    Runs CalCOS on one association, writing its console output to outdir/calcos.log. Never raises.
+
+    Returns:
+    str or None : the error, if CalCOS failed.
+    float : seconds taken.
+    """
+    import calcos
+
+    start = time.perf_counter()
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    with open(Path(outdir) / LOG_NAME, 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            calcos.calcos(str(asn_path), verbosity=verbosity, outdir=str(outdir))
+            error = None
+        except (Exception, SystemExit) as err:
+            error = f'{type(err).__name__}: {err}'
+            print(f'{FAILURE_MARKER} {error}')
+    return error, time.perf_counter() - start
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def run_associations(associations, lref, jobs=None, memory_budget=None, verbosity=0, force=False):
+    """
+    Runs CalCOS on the associations on up to `jobs` processes while their estimated memory fits in memory_budget bytes.
+    An association estimated to need more than the whole budget runs on its own.
+
+    Returns:
+    dict : asn path -> error message, or None for success; skipped associations are left out.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    memory_budget = memory_budget or physical_memory() or float('inf')
+    pending = []
+    for association in associations:
+        if not force and association.is_current():
+            print(f'Skipping {association.asn_path}: its outputs in {association.outdir} are up to date')
+        else:
+            pending.append(association)
+    # Largest first, so the small ones fill the gaps left at the end.
+    pending.sort(key=Association.memory_estimate, reverse=True)
+    print(f'Running CalCOS on {len(pending)} of {len(associations)} associations with up to {jobs} processes '
+          f'and {memory_budget / 1024 ** 3:.1f} GB')
+
+    results = {}
+    while pending:
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=start_worker,
+                                                    initargs=(lref,)) as executor:
+            while pending or running:
+                in_use = sum(memory for _, memory in running.values())
+                for association in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    memory = association.memory_estimate()
+                    if running and in_use + memory > memory_budget:
+                        continue
+                    future = executor.submit(run_calcos, association.asn_path, association.outdir, verbosity)
+                    running[future] = (association, memory)
+                    in_use += memory
+                    pending.remove(association)
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    association, _ = running.pop(future)
+                    try:
+                        error, seconds = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        error, seconds = 'A worker process died (out of memory?)', float('nan')
+                    results[str(association.asn_path)] = error
+                    status = f'FAILED ({error})' if error else 'done'
+                    print(f'{association.asn_path}: {status} in {seconds:.0f} s; see {association.outdir / LOG_NAME}')
+                if broken:
+                    # Every association still running on the dead pool is lost with it.
+                    for association, _ in running.values():
+                        results[str(association.asn_path)] = 'A worker process died (out of memory?)'
+                        print(f'{association.asn_path}: FAILED (its pool lost a worker process)')
+                    print(f'Starting a new pool for the {len(pending)} associations left')
+                    break
+    return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Run CalCOS on many association files in parallel')
+    parser.add_argument('asn_files', nargs='+', help='asn files or glob patterns (quote them to let ** recurse)')
+    parser.add_argument('--lref', default=os.environ.get('lref'),
+                        help='directory of COS reference files (default: the lref environment variable)')
+    parser.add_argument('--outroot', default='./output/calcos_batch',
+                        help='each association is calibrated into <outroot>/<asn rootname>/')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--memory-gb', type=float, default=None,
+                        help=f'memory budget (default: {DEFAULT_MEMORY_FRACTION:.0%} of physical memory)')
+    parser.add_argument('--verbosity', type=int, default=0, choices=[0, 1, 2], help='CalCOS verbosity')
+    parser.add_argument('--force', action='store_true', help='rerun associations whose outputs are up to date')
+    options = parser.parse_args(args)
+    if not options.lref or not Path(options.lref).exists():
+        parser.error("Make sure to set --lref or the 'lref' environment variable to a valid path with all of your reference files.")
+    return options
+
+
+def main(args=None):
+    options = parse_args(args)
+    asn_paths = sorted({path for pattern in options.asn_files for path in (glob.glob(pattern, recursive=True) or [pattern])})
+    associations = [Association(asn_path, options.outroot) for asn_path in asn_paths]
+    if options.memory_gb:
+        memory_budget = options.memory_gb * 1024 ** 3
+    else:
+        memory_budget = (physical_memory() or 0) * DEFAULT_MEMORY_FRACTION
+    results = run_associations(associations, options.lref, options.jobs, memory_budget, options.verbosity, options.force)
+    failed = [asn_path for asn_path, error in results.items() if error]
+    print(f'{len(results) - len(failed)} associations calibrated, {len(failed)} failed, '
+          f'{len(associations) - len(results)} up to date')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
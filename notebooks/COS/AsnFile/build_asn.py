@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Builds association (asn) files for many COS exposures at once, grouping them by header keywords as in the AsnFile Notebook.
+
+The exposures below a directory are indexed in a local SQLite database: for each file only the header blocks at the start of the file are read, up to the end of the first extension's header, and never the data.
+The keywords in INDEXED_KEYWORDS are stored with the file's modification time and size, so later runs only read the files that are new or changed since.
+The exposures are then grouped on --group-by with numpy, and an asn file is written for each group, with one EXP-FP (or EXP-SWAVE, for wavecals) row per exposure and a PROD-FP row.
+
+For example, to make one asn file per target, grating and cenwave of the science exposures at FP-POS 1 and 3:
+    python build_asn.py ./data --outdir ./output/asn --fppos 1 3 --group-by TARGNAME OPT_ELEM CENWAVE
+"""
+import argparse
+import gzip
+import os
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+INDEX_NAME = 'exposure_index.sqlite'
+# Keywords indexed for each exposure, from the primary header or, failing that, the first extension's header
+INDEXED_KEYWORDS = ['ROOTNAME', 'ASN_ID', 'DETECTOR', 'OPT_ELEM', 'CENWAVE', 'FPPOS', 'LIFE_ADJ', 'SEGMENT',
+                    'TARGNAME', 'EXPTYPE', 'DATE-OBS', 'TIME-OBS', 'EXPSTART']
+NUMERIC_KEYWORDS = ['CENWAVE', 'FPPOS', 'LIFE_ADJ', 'EXPSTART']
+EXPOSURE_PATTERNS = ['*_rawtag*.fits*', '*_corrtag*.fits*', '*_rawaccum*.fits*']
+# MEMTYPE of the exposures of each EXPTYPE that go into an association
+MEMTYPES = {'EXTERNAL/SCI': 'EXP-FP', 'WAVECAL': 'EXP-SWAVE'}
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+
+def _column(keyword):
+    return keyword.replace('-', '_').lower()
+
+
+def read_headers(path, n_headers=2):
+    """
+    Reads the first n_headers headers of a FITS file (plain or gzipped) block by block, stopping at the last END card needed.
+    Only header-only HDUs are read past, which is how COS exposures start: the primary HDU has no data.
+
+    Returns:
+    list of fits Header
+    """
+    headers = []
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as stream:
+        cards = b''
+        while len(headers) < n_headers:
+            block = stream.read(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE:
+                break
+            cards += block
+            # An END card starts at a card boundary of the block just read.
+            if any(block[start:start + 3] == b'END' and block[start + 3:start + CARD_SIZE].strip() == b''
+                   for start in range(0, BLOCK_SIZE, CARD_SIZE)):
+                header = fits.Header.fromstring(cards.decode('ascii', errors='replace'))
+                headers.append(header)
+                cards = b''
+                if header.get('NAXIS', 0) != 0:
+                    break  # The next header is behind data, which we do not read.
+    return headers
+
+
+def exposure_keywords(path):
+    """The INDEXED_KEYWORDS of an exposure, preferring its primary header; None for those in neither header."""
+    headers = read_headers(path)
+    values = {}
+    for keyword in INDEXED_KEYWORDS:
+        value = next((header[keyword] for header in headers if keyword in header), None)
+        if keyword in NUMERIC_KEYWORDS and value is not None:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                value = None
+        elif value is not None:
+            value = str(value).strip()
+        values[keyword] = value
+    return values
+
+
+class ExposureIndex:
+    """The SQLite index of the exposures' header keywords, by path."""
+
+    def __init__(self, index_path):
+        self.connection = sqlite3.connect(str(index_path))
+        columns = ', '.join(
+            f"{_column(keyword)} {'REAL' if keyword in NUMERIC_KEYWORDS else 'TEXT'}" for keyword in INDEXED_KEYWORDS
+        )
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS exposures (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, {columns})'
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, directory, patterns=EXPOSURE_PATTERNS):
+        """
+        Indexes the exposures below directory that are new or changed since the last update, and forgets the ones that are gone.
+
+        Returns:
+        int : number of files read.
+        """
+        known = {path: (mtime_ns, size) for path, mtime_ns, size in
+                 self.connection.execute('SELECT path, mtime_ns, size FROM exposures')}
+        found = {str(path.resolve()) for pattern in patterns for path in Path(directory).rglob(pattern)}
+        rows = []
+        for path in sorted(found):
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            try:
+                values = exposure_keywords(path)
+            except (OSError, ValueError) as err:
+                print(f'Skipping {path}: {err}')
+                continue
+            rows.append([path, stat.st_mtime_ns, stat.st_size] + [values[keyword] for keyword in INDEXED_KEYWORDS])
+
+        directory_prefix = str(Path(directory).resolve()) + os.sep
+        gone = [(path,) for path in known if path.startswith(directory_prefix) and path not in found]
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO exposures VALUES ({', '.join('?' * (3 + len(INDEXED_KEYWORDS)))})", rows
+            )
+            self.connection.executemany('DELETE FROM exposures WHERE path = ?', gone)
+        return len(rows)
+
+    def table(self, directory=None):
+        """The indexed keywords as a dict of numpy arrays, one per column, optionally only for the files below directory."""
+        query = 'SELECT * FROM exposures'
+        params = ()
+        if directory is not None:
+            # An exact prefix match: LIKE would treat the _ and % common in data paths as wildcards.
+            prefix = str(Path(directory).resolve()) + os.sep
+            query += ' WHERE substr(path, 1, length(?)) = ?'
+            params = (prefix, prefix)
+        cursor = self.connection.execute(query, params)
+        names = [description[0] for description in cursor.description]
+        rows = cursor.fetchall()
+        return {name: np.array([row[i] for row in rows], dtype=object) for i, name in enumerate(names)}
+
+
+def group_exposures(table, group_by, fppos=None, exptypes=tuple(MEMTYPES)):
+    """
+    Groups the exposures of an index table on the group_by keywords.
+    Exposures are first filtered on FPPOS and EXPTYPE, and the files of one exposure (i.e. rawtag_a and rawtag_b) count once.
+
+    Returns:
+    list of (dict, numpy array) : the group_by values and the row numbers of the exposures, sorted by EXPSTART, of each group.
+    """
+    rootnames = np.char.upper(table['rootname'].astype(str))
+    selected = np.isin(table['exptype'].astype(str), list(exptypes)) & (table['rootname'] != None)
+    if fppos is not None:
+        selected &= np.isin(table['fppos'].astype(float), fppos)
+    # One row per exposure: the first of its files
+    _, first_rows = np.unique(rootnames, return_index=True)
+    selected &= np.isin(np.arange(len(rootnames)), first_rows)
+    rows = np.nonzero(selected)[0]
+    if len(rows) == 0:
+        return []
+
+    keys = np.column_stack([table[_column(keyword)][rows].astype(str) for keyword in group_by])
+    unique_keys, group_of = np.unique(keys, axis=0, return_inverse=True)
+    group_of = np.asarray(group_of).reshape(-1)
+    expstarts = np.array([np.inf if value is None else value for value in table['expstart'][rows]], dtype=float)
+    order = np.lexsort((expstarts, group_of))
+    bounds = np.searchsorted(group_of[order], np.arange(len(unique_keys) + 1))
+    return [
+        (dict(zip(group_by, unique_key)), rows[order[bounds[i]:bounds[i + 1]]])
+        for i, unique_key in enumerate(unique_keys)
+    ]
+
+
+def write_asn(path, product, memnames, memtypes, keywords=None):
+    """Writes an asn file of the exposures and one PROD-FP row for the product, as in the AsnFile Notebook."""
+    c1 = fits.Column(name='MEMNAME', array=np.array(list(memnames) + [product.upper()]), format='40A')
+    c2 = fits.Column(name='MEMTYPE', array=np.array(list(memtypes) + ['PROD-FP']), format='14A')
+    c3 = fits.Column(name='MEMPRSNT', format='L', array=[True] * (len(memnames) + 1))
+    primary = fits.PrimaryHDU()
+    primary.header['ASN_ID'] = product.upper()
+    primary.header['ASN_TAB'] = Path(path).name
+    for keyword, value in (keywords or {}).items():
+        primary.header[keyword] = value
+    fits.HDUList([primary, fits.BinTableHDU.from_columns([c1, c2, c3])]).writeto(path, overwrite=True)
+
+
+def build_asn_files(table, outdir, group_by, fppos=None, exptypes=tuple(MEMTYPES), product_prefix='combo'):
+    """
+    Writes <outdir>/<product>_asn.fits for each group of exposures, with products named <product_prefix><group number>.
+
+    Returns:
+    list of str : the asn files written.
+    """
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    written = []
+    for number, (keywords, rows) in enumerate(group_exposures(table, group_by, fppos, exptypes)):
+        product = f'{product_prefix}{number:03d}'
+        memnames = np.char.upper(table['rootname'][rows].astype(str))
+        memtypes = [MEMTYPES[exptype] for exptype in table['exptype'][rows]]
+        asn_path = str(Path(outdir) / f'{product}_asn.fits')
+        header_keywords = {}
+        for keyword, value in keywords.items():
+            if keyword in NUMERIC_KEYWORDS and value != 'None':
+                value = int(float(value)) if float(value).is_integer() else float(value)
+            header_keywords[keyword] = value
+        write_asn(asn_path, product, memnames, memtypes, header_keywords)
+        written.append(asn_path)
+        print(f"Saved {asn_path}: {len(rows)} exposures with {', '.join(f'{k}={v}' for k, v in keywords.items())}")
+    return written
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Build COS association files by grouping many exposures')
+    parser.add_argument('directory', help='directory searched (recursively) for rawtag, corrtag and rawaccum files')
+    parser.add_argument('--outdir', default='./output/asn', help='where to write the asn files')
+    parser.add_argument('--index', default=None, help=f'SQLite index of the headers (default: <directory>/{INDEX_NAME})')
+    parser.add_argument('--group-by', nargs='+', default=['TARGNAME', 'OPT_ELEM', 'CENWAVE'],
+                        choices=INDEXED_KEYWORDS, help='keywords whose values define a group')
+    parser.add_argument('--fppos', nargs='+', type=float, default=None, help='only use exposures at these FP-POS')
+    parser.add_argument('--wavecals', action='store_true', help='include WAVECAL exposures as EXP-SWAVE members')
+    parser.add_argument('--product-prefix', default='combo', help='products are named <prefix><group number>')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    index = ExposureIndex(options.index or Path(options.directory) / INDEX_NAME)
+    try:
+        print(f'Read the headers of {index.update(options.directory)} new or changed files')
+        table = index.table(options.directory)
+    finally:
+        index.close()
+    exptypes = ('EXTERNAL/SCI', 'WAVECAL') if options.wavecals else ('EXTERNAL/SCI',)
+    build_asn_files(table, options.outdir, options.group_by, options.fppos, exptypes, options.product_prefix)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,277 @@
+"""
+DESCRIPTION:
+    Scores many COS x1d/x1dsum files with the Poisson SNR estimate of `estimate_snr` in cos_functions.py, across a pool of processes.
+    Each file is opened memory-mapped and only the WAVELENGTH, GROSS and GCOUNTS columns are read from it.
+    One row per (file, wavelength window) is streamed to the output as results arrive: Parquet if the output ends in .parquet (this needs pyarrow), CSV otherwise.
+    A file that cannot be read or scored gets a row with its error message rather than stopping the run.
+    If a worker process dies (i.e. runs out of memory), the files it left unfinished are scored again on a new pool; a file caught in POOL_CRASH_RETRIES crashes is then scored in a process of its own, so only the file that kills its worker gets an error row.
+
+    For example, to score every x1dsum in a directory tree over two windows on 8 processes:
+        python batch_snr.py "data/**/*_x1dsum.fits*" --window 1565 1575 --window 1670 1690 --jobs 8 --output snr.parquet
+"""
+import argparse
+import concurrent.futures
+import csv
+import glob
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from cos_functions import estimate_snr
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+SNR_COLUMNS = ["WAVELENGTH", "GROSS", "GCOUNTS"]
+HEADER_KEYWORDS = ["ROOTNAME", "TARGNAME", "DETECTOR", "OPT_ELEM", "CENWAVE"]
+OUTPUT_FIELDS = ["PATH"] + HEADER_KEYWORDS + ["WINDOW_START", "WINDOW_END", "SNR", "SEGMENTS", "ERROR"]
+# Futures kept in flight per worker; enough to keep the pool busy without queueing every file up front.
+TASKS_PER_WORKER = 4
+# Pool crashes a file may be caught in before it is scored in a process of its own.
+POOL_CRASH_RETRIES = 2
+# Rows per Parquet row group.
+PARQUET_BATCH_ROWS = 1024
+
+
+def find_spectra(patterns, file_list=None):
+    """
+    Expands glob patterns (recursive, so "**" works) and the paths listed one per line in file_list into a sorted list of unique paths.
+    """
+    paths = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True)
+        paths.update(matches if matches else [pattern])
+    if file_list is not None:
+        with open(file_list) as f:
+            paths.update(line.strip() for line in f if line.strip())
+    return sorted(paths)
+
+
+def read_snr_table(path):
+    """
+    Reads the columns estimate_snr needs from the first extension of a COS x1d/x1dsum file, plus a few primary header keywords.
+
+    Returns:
+    Table : WAVELENGTH, GROSS and GCOUNTS, one row per segment.
+    dict : the HEADER_KEYWORDS found in the primary header.
+    """
+    with fits.open(path, memmap=True) as hdul:
+        header = {keyword: hdul[0].header.get(keyword) for keyword in HEADER_KEYWORDS}
+        data = hdul[1].data
+        # With memmap=True only these columns are read from disk; they are
+        # copied out because the mapping closes with the file.
+        table = Table([np.array(data[name]) for name in SNR_COLUMNS], names=SNR_COLUMNS, copy=False)
+    return table, header
+
+
+def score_file(path, windows, weighted=False):
+    """
+    Estimates the SNR of one file over each window. Never raises: a failure is reported in the ERROR field of the rows.
+
+    Returns:
+    list of dict : one row (see OUTPUT_FIELDS) per window.
+    """
+    try:
+        table, header = read_snr_table(path)
+    except Exception as err:
+        return [_row(path, {}, window, error=f"{type(err).__name__}: {err}") for window in windows]
+
+    try:
+        # All windows in one call, which indexes each segment's wavelengths once.
+        snrs, snr_matrix = estimate_snr(table, snr_range=np.asarray(windows, dtype=float), weighted=weighted, verbose=False)
+    except Exception as err:
+        return [_row(path, header, window, error=f"{type(err).__name__}: {err}") for window in windows]
+
+    rows = []
+    for window, snr, segment_snrs in zip(windows, snrs, snr_matrix):
+        segments = np.nonzero(np.isfinite(segment_snrs))[0]
+        rows.append(_row(path, header, window, snr=float(snr), segments=" ".join(map(str, segments))))
+    return rows
+
+
+def _row(path, header, window, snr=np.nan, segments="", error=""):
+    row = {"PATH": path, "WINDOW_START": float(window[0]), "WINDOW_END": float(window[1])}
+    for keyword in HEADER_KEYWORDS:
+        value = header.get(keyword)
+        row[keyword] = "" if value is None else str(value)
+    row.update({"SNR": snr, "SEGMENTS": segments, "ERROR": error})
+    return row
+
+
+class CsvRowWriter:
+    def __init__(self, output):
+        self._file = open(output, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=OUTPUT_FIELDS)
+        self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetRowWriter:
+    """Buffers rows and writes them as Parquet row groups of PARQUET_BATCH_ROWS."""
+
+    def __init__(self, output):
+        if pyarrow is None:
+            raise RuntimeError("Writing Parquet requires the pyarrow package; use a .csv output instead")
+        self._schema = pyarrow.schema(
+            [(field, pyarrow.float64() if field in ["WINDOW_START", "WINDOW_END", "SNR"] else pyarrow.string())
+             for field in OUTPUT_FIELDS]
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(output, self._schema)
+        self._rows = []
+
+    def _flush(self):
+        if self._rows:
+            columns = {field: [row[field] for row in self._rows] for field in OUTPUT_FIELDS}
+            self._writer.write_table(pyarrow.Table.from_pydict(columns, schema=self._schema))
+            self._rows = []
+
+    def write(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= PARQUET_BATCH_ROWS:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def open_writer(output):
+    if output.endswith(".parquet"):
+        return ParquetRowWriter(output)
+    return CsvRowWriter(output)
+
+
+def _score_isolated(path, windows, weighted=False):
+    """score_file in a process of its own, so that if it dies only this file fails."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(score_file, path, windows, weighted).result()
+        except BrokenProcessPool as err:
+            return [_row(path, {}, window, error=f"Worker process died: {err}") for window in windows]
+
+
+def _score_on_pool(paths, windows, jobs, weighted, record):
+    """
+    Scores paths on one pool of `jobs` processes, passing the rows of each file to record as it completes.
+
+    Returns:
+    list of str : the files left unfinished when a worker process died; empty if none did.
+    list of str : the files not yet submitted when it died.
+    """
+    pending = {}
+    remaining = iter(paths)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            for path in remaining:
+                pending[executor.submit(score_file, path, windows, weighted)] = path
+                if len(pending) >= jobs * TASKS_PER_WORKER:
+                    break
+            if not pending:
+                return [], []
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            unfinished = []
+            for future in finished:
+                path = pending.pop(future)
+                try:
+                    record(future.result())
+                except BrokenProcessPool:
+                    unfinished.append(path)
+            if unfinished:
+                # The pool is unusable: keep what completed, hand back the rest.
+                for future, path in pending.items():
+                    if future.done() and not future.cancelled() and future.exception() is None:
+                        record(future.result())
+                    else:
+                        unfinished.append(path)
+                return unfinished, list(remaining)
+
+
+def score_files(paths, windows, output, jobs=None, weighted=False, verbose=True):
+    """
+    Scores every path over every window on a pool of `jobs` processes and streams the rows to output as they complete.
+
+    Parameters:
+    paths (list of str) : COS x1d/x1dsum FITS files.
+    windows (list) : [wvln_range_start, wvln_range_end] pairs.
+    output (str) : .parquet or .csv file to write.
+    jobs (int) : number of worker processes; Default is one per CPU.
+    weighted (bool) : exposure time weighted average SNR rather than the mean, as in estimate_snr; Default is False.
+    verbose (bool) : whether to print progress and failures; Default is True.
+
+    Returns:
+    int : number of files with at least one failed window.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    writer = open_writer(output)
+    counts = {"done": 0, "failed": 0}
+
+    def record(rows):
+        writer.write(rows)
+        counts["done"] += 1
+        errors = [row["ERROR"] for row in rows if row["ERROR"]]
+        if errors:
+            counts["failed"] += 1
+            if verbose:
+                print(f"Failed on {rows[0]['PATH']}: {errors[0]}")
+        if verbose and counts["done"] % 100 == 0:
+            print(f"Scored {counts['done']} of {len(paths)} files")
+
+    crashes = {}
+    queue = list(paths)
+    try:
+        while queue:
+            unfinished, not_submitted = _score_on_pool(queue, windows, jobs, weighted, record)
+            if not unfinished:
+                break
+            if verbose:
+                print(f"A worker process died; scoring its {len(unfinished)} unfinished files again: {', '.join(unfinished)}")
+            for path in unfinished:
+                crashes[path] = crashes.get(path, 0) + 1
+            for path in unfinished:
+                if crashes[path] >= POOL_CRASH_RETRIES:
+                    record(_score_isolated(path, windows, weighted))
+            queue = [path for path in unfinished if crashes[path] < POOL_CRASH_RETRIES] + not_submitted
+    finally:
+        writer.close()
+    if verbose:
+        print(f"Scored {counts['done']} files ({counts['failed']} with failures) into {output}")
+    return counts["failed"]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Estimate the SNR of many COS x1d/x1dsum files in parallel")
+    parser.add_argument("paths", nargs="*", help="FITS files or glob patterns (quote them to let ** recurse)")
+    parser.add_argument("--file-list", default=None, help="text file listing one FITS path per line")
+    parser.add_argument("--window", nargs=2, type=float, action="append", metavar=("START", "END"), required=True,
+                        help="wavelength window to estimate the SNR over; may be repeated")
+    parser.add_argument("--output", default="snr.csv", help="output file, .parquet or .csv (default: snr.csv)")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--weighted", action="store_true", help="exposure time weighted average SNR")
+    options = parser.parse_args(args)
+    if not options.paths and options.file_list is None:
+        parser.error("give FITS paths, glob patterns or --file-list")
+    return options
+
+
+def main(args=None):
+    options = parse_args(args)
+    paths = find_spectra(options.paths, options.file_list)
+    print(f"Scoring {len(paths)} files over {len(options.window)} windows")
+    failed = score_files(paths, options.window, options.output, options.jobs, options.weighted)
+    return 1 if failed == len(paths) and paths else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
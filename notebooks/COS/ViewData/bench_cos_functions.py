@@ -0,0 +1,130 @@
+"""
+DESCRIPTION:
+    Benchmarks the downsampling functions in cos_functions.py against the previous implementation, which stacked *factor* strided slices with np.concatenate.
+    Each function is run on a stack of 16384-pixel COS FUV rows at binning factors from 2 to 100; we report throughput in millions of input pixels per second and the peak memory allocated during one call (tracemalloc, which numpy reports to).
+    It then times snr_sweep over binsizes 2-99 against the loop it replaces, which called estimate_snr and bin_by_resel for every binsize.
+
+    Run from this directory:
+        python bench_cos_functions.py --rows 64
+"""
+import argparse
+import contextlib
+import io
+import time
+import tracemalloc
+
+import numpy as np
+
+from astropy.table import Table
+
+from cos_functions import BINNED_COLUMNS, bin_by_resel, downsample_1d, downsample_sum, estimate_snr, snr_sweep
+
+FUV_ROW_PIXELS = 16384
+FACTORS = [2, 3, 6, 10, 25, 50, 100]
+SWEEP_BINSIZES = list(range(2, 100))
+SWEEP_RANGE = [1565, 1575]
+
+
+def legacy_downsample_sum(myarr, factor):
+    xs = myarr.shape[0]
+    crop_arr = myarr[: xs - (xs % int(factor))]
+    return np.sum(np.concatenate([[crop_arr[i::factor] for i in range(factor)]]), axis=0)
+
+
+def legacy_downsample_1d(myarr, factor, weightsarr):
+    xs = myarr.shape[0]
+    crop_arr = myarr[: xs - (xs % int(factor))]
+    crop_weights = weightsarr[: xs - (xs % int(factor))]
+    return np.average(
+        np.concatenate([[crop_arr[i::factor] for i in range(factor)]]),
+        weights=np.concatenate([[crop_weights[i::factor] for i in range(factor)]]),
+        axis=0,
+    )
+
+
+def synthetic_x1dsum(rng, n_segments=2):
+    """An x1dsum-like table: n_segments FUV segments with overlapping wavelength ranges around SWEEP_RANGE."""
+    starts = np.linspace(1400, 1550, n_segments)
+    wavelength = np.stack([np.linspace(start, start + 200, FUV_ROW_PIXELS) for start in starts])
+    gross = (rng.random(wavelength.shape) * 5).astype(np.float32)
+    gcounts = (gross * rng.uniform(900, 1100, wavelength.shape)).astype(np.float32)
+    flux = (rng.random(wavelength.shape) * 1e-14).astype(np.float32)
+    error = (rng.random(wavelength.shape) * 1e-15 + 1e-16).astype(np.float32)
+    return Table(
+        [np.full(n_segments, 1000.0), wavelength, flux, error, error * 0.9, gross, gcounts],
+        names=BINNED_COLUMNS,
+    )
+
+
+def sweep_loop(table):
+    """The per-binsize loop snr_sweep replaces."""
+    curves = []
+    for binsize in SWEEP_BINSIZES:
+        snr = estimate_snr(table, snr_range=SWEEP_RANGE, bin_data_first=True, binsize_=binsize, weighted=True, verbose=False)[0]
+        bin_tab = bin_by_resel(table, binsize=binsize, verbose=False)
+        in_range = (bin_tab["WAVELENGTH"] > SWEEP_RANGE[0]) & (bin_tab["WAVELENGTH"] < SWEEP_RANGE[1])
+        curves.append((snr, np.nanmean(bin_tab["FLUX"][in_range] / bin_tab["ERROR"][in_range])))
+    return curves
+
+
+def measure(func, n_pixels, repeats):
+    """Returns (million pixels per second, peak MiB of one call)."""
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    elapsed = (time.perf_counter() - start) / repeats
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return n_pixels / elapsed / 1e6, peak / 1024 ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2].strip())
+    parser.add_argument("--rows", type=int, default=64, help="number of 16384-pixel rows")
+    parser.add_argument("--repeats", type=int, default=5, help="timed calls per measurement")
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    rows = rng.random((options.rows, FUV_ROW_PIXELS))
+    weights = rng.random((options.rows, FUV_ROW_PIXELS))
+    n_pixels = rows.size
+
+    cases = {
+        "sum": (
+            lambda f: lambda: [legacy_downsample_sum(row, f) for row in rows],
+            lambda f: lambda: downsample_sum(rows, f, axis=1),
+        ),
+        "weighted mean": (
+            lambda f: lambda: [legacy_downsample_1d(row, f, w) for row, w in zip(rows, weights)],
+            lambda f: lambda: downsample_1d(rows, f, weights, axis=1),
+        ),
+    }
+    print(f"{options.rows} rows x {FUV_ROW_PIXELS} pixels")
+    print(f"{'function':<14} {'factor':>6} {'legacy Mpix/s':>14} {'new Mpix/s':>11} {'legacy MiB':>11} {'new MiB':>8}")
+    for name, (legacy, new) in cases.items():
+        for factor in FACTORS:
+            legacy_rate, legacy_peak = measure(legacy(factor), n_pixels, options.repeats)
+            new_rate, new_peak = measure(new(factor), n_pixels, options.repeats)
+            print(
+                f"{name:<14} {factor:>6} {legacy_rate:>14.1f} {new_rate:>11.1f} {legacy_peak:>11.2f} {new_peak:>8.2f}"
+            )
+
+    table = synthetic_x1dsum(rng)
+    print(f"\nSNR sweep over binsizes {SWEEP_BINSIZES[0]}-{SWEEP_BINSIZES[-1]}, {len(table)} segments")
+    with contextlib.redirect_stdout(io.StringIO()):  # estimate_snr prints as it bins
+        start = time.perf_counter()
+        sweep_loop(table)
+        loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    snr_sweep(table, SWEEP_BINSIZES, SWEEP_RANGE)
+    sweep_time = time.perf_counter() - start
+    print(f"estimate_snr + bin_by_resel loop {loop_time:8.3f} s")
+    print(f"snr_sweep                        {sweep_time:8.3f} s ({loop_time / sweep_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
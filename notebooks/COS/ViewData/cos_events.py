@@ -0,0 +1,152 @@
+"""
+DESCRIPTION:
+    Functions for binning COS TIME-TAG event lists (rawtag and corrtag files) into detector images and profiles, such as:
+    * makeims: the image of an (x, y) event list, as made by the helper of the same name in the COS Extract.ipynb Notebook
+    * tagfile_image: the summed image of many tagfiles
+    * collapsey_profiles: each tagfile's events collapsed onto the y axis, as plotted by collapsey in Extract.ipynb
+
+    Events are counted with np.bincount on flattened pixel indices rather than one at a time in Python.
+    Tagfiles are opened memory-mapped and read CHUNK_EVENTS rows at a time, so a multi-GB corrtag is never held in memory at once, and all the tagfiles are accumulated in one pass.
+"""
+# %%
+import numpy as np
+from astropy.io import fits
+
+# (x, y) columns of corrtag and rawtag files
+EVENT_COLUMNS = {False: ("XCORR", "YCORR"), True: ("RAWX", "RAWY")}
+# (ny, nx) of the images made by makeims in Extract.ipynb
+IMAGE_SHAPE = (1024, 1024)
+# Events read from a tagfile at once; two float32 columns of this many events take 32 MB.
+CHUNK_EVENTS = 4_000_000
+
+
+# %%
+def _pixel_indices(coords, size):
+    """
+    Rounds event coordinates to the nearest pixel, as floor(coord + 0.5).
+
+    Returns:
+    numpy array of ints : the pixel of each event.
+    numpy array of bools : whether that pixel is on the image, 0 <= pixel < size.
+    """
+    pixels = np.floor(np.asarray(coords, dtype=np.float64) + 0.5)
+    on_image = (pixels >= 0) & (pixels < size)
+    return pixels.astype(np.intp), on_image
+
+
+def accumulate_image(xarr, yarr, image):
+    """
+    Adds a count to image[y, x] for every (x, y) event, in place. Events falling off the image are ignored.
+
+    Parameters:
+    xarr, yarr (numpy arrays) : event coordinates, in pixels.
+    image (2D numpy array) : image to add the counts to.
+
+    Returns:
+    2D numpy array : image, for convenience.
+    """
+    ny, nx = image.shape
+    xbin, x_on = _pixel_indices(xarr, nx)
+    ybin, y_on = _pixel_indices(yarr, ny)
+    on_image = x_on & y_on
+    counts = np.bincount(ybin[on_image] * nx + xbin[on_image], minlength=nx * ny)
+    image += counts.reshape(ny, nx)
+    return image
+
+
+def accumulate_profile(xarr, yarr, profile, nx=IMAGE_SHAPE[1]):
+    """
+    Adds the events to profile, an image of nx columns collapsed onto the y axis, without making the image. Events falling off the image are ignored.
+
+    Parameters:
+    xarr, yarr (numpy arrays) : event coordinates, in pixels.
+    profile (1D numpy array) : counts per row to add to.
+    nx (int) : number of columns of the image; Default is 1024.
+
+    Returns:
+    1D numpy array : profile, for convenience.
+    """
+    _, x_on = _pixel_indices(xarr, nx)
+    ybin, y_on = _pixel_indices(yarr, len(profile))
+    profile += np.bincount(ybin[x_on & y_on], minlength=len(profile))
+    return profile
+
+
+# %%
+def makeims(xarr, yarr, shape=IMAGE_SHAPE):
+    """
+    Converts a list of counts to an image, with one count per (x, y) event.
+    Unlike the loop in Extract.ipynb, events at negative pixels are dropped rather than wrapped around to the far edge of the image.
+
+    Parameters:
+    xarr, yarr (numpy arrays) : event coordinates, in pixels.
+    shape (tuple of ints) : (ny, nx) of the image; Default is (1024, 1024).
+
+    Returns:
+    2D numpy array of floats : the image.
+    """
+    return accumulate_image(xarr, yarr, np.zeros(shape))
+
+
+def iter_events(tagfile, raw=False, chunk_events=CHUNK_EVENTS):
+    """
+    Reads the event coordinates of a tagfile in chunks of chunk_events rows, from a memory-mapped file.
+
+    Parameters:
+    tagfile (str) : path to a rawtag or corrtag file.
+    raw (bool) : read RAWX, RAWY rather than XCORR, YCORR; Default is False.
+    chunk_events (int) : events per chunk; Default is CHUNK_EVENTS.
+
+    Yields:
+    tuple of numpy arrays : x and y of the next chunk of events.
+    """
+    xcol, ycol = EVENT_COLUMNS[raw]
+    with fits.open(tagfile, memmap=True) as hdul:
+        data = hdul[1].data
+        n_events = 0 if data is None else len(data)
+        for start in range(0, n_events, chunk_events):
+            # Slicing the rows first means only this chunk is read from disk and converted.
+            chunk = data[start : start + chunk_events]
+            yield np.array(chunk[xcol]), np.array(chunk[ycol])
+
+
+def tagfile_image(tagfiles, raw=False, shape=IMAGE_SHAPE, chunk_events=CHUNK_EVENTS):
+    """
+    Sums the events of all the tagfiles into a single image, reading each file in chunks.
+
+    Parameters:
+    tagfiles (list of str) : rawtag or corrtag file paths.
+    raw (bool) : use RAWX, RAWY rather than XCORR, YCORR; Default is False.
+    shape (tuple of ints) : (ny, nx) of the image; Default is (1024, 1024).
+    chunk_events (int) : events read at once; Default is CHUNK_EVENTS.
+
+    Returns:
+    2D numpy array of ints : the summed image.
+    """
+    image = np.zeros(shape, dtype=np.int64)
+    for tagfile in tagfiles:
+        for xarr, yarr in iter_events(tagfile, raw=raw, chunk_events=chunk_events):
+            accumulate_image(xarr, yarr, image)
+    return image
+
+
+def collapsey_profiles(tagfiles, raw=False, shape=IMAGE_SHAPE, chunk_events=CHUNK_EVENTS):
+    """
+    Collapses the 2D spectrum of each tagfile onto the y axis, i.e. sums its image over the pixels of each row, as collapsey in Extract.ipynb does before plotting.
+    Only the row of each event is counted, so no image is made.
+
+    Parameters:
+    tagfiles (list of str) : rawtag or corrtag file paths.
+    raw (bool) : use RAWX, RAWY rather than XCORR, YCORR; Default is False.
+    shape (tuple of ints) : (ny, nx) of the image the events fall on; Default is (1024, 1024).
+    chunk_events (int) : events read at once; Default is CHUNK_EVENTS.
+
+    Returns:
+    2D numpy array of ints : shape (len(tagfiles), ny), the y profile of each tagfile.
+    """
+    ny, nx = shape
+    profiles = np.zeros((len(tagfiles), ny), dtype=np.int64)
+    for profile, tagfile in zip(profiles, tagfiles):
+        for xarr, yarr in iter_events(tagfile, raw=raw, chunk_events=chunk_events):
+            accumulate_profile(xarr, yarr, profile, nx=nx)
+    return profiles
@@ -15,32 +15,71 @@ import numpy as np
 from astropy.table import Table
 
 
-def downsample_sum(myarr, factor):
-    """Downsamples a 1D array by summing over *factor* pixels; Crops right side if the shape is not a multiple of factor.
+def _block_view(myarr, factor, axis=0):
+    """
+    Returns a view of myarr, cropped on the right side to a multiple of factor along axis, with that axis split into blocks of *factor* pixels.
+    The block axis is moved last, so reducing over axis -1 downsamples. No data is copied.
+
+    Parameters:
+    myarr (numpy array) : array to be viewed in blocks; astropy Columns are viewed as plain numpy arrays.
+    factor (int) : number of pixels in each block.
+    axis (int) : axis to be downsampled; Default is 0.
+
+    Returns:
+    (numpy array) view of shape myarr.shape with axis replaced by (n // factor) and an extra last axis of length factor.
+    """
+    factor = int(factor)
+    arr = np.asarray(myarr)
+    if not -arr.ndim <= axis < arr.ndim:
+        raise ValueError(f"axis {axis} is out of bounds for array of dimension {arr.ndim}")
+    axis = axis % arr.ndim
+    xs = arr.shape[axis]
+    crop_arr = arr[(slice(None),) * axis + (slice(0, xs - (xs % factor)),)]
+    # Splitting one axis in two never needs a copy, even for a strided crop.
+    blocks = crop_arr.reshape(
+        arr.shape[:axis] + (xs // factor, factor) + arr.shape[axis + 1 :]
+    )
+    return np.moveaxis(blocks, axis + 1, -1)
+
+
+def _block_sum(blocks, out=None):
+    """
+    Sums a block view from _block_view over its last (block) axis.
+    For floats this is a matrix-vector product with ones, which is much faster than np.sum when the blocks are short: np.sum runs its inner loop over the few pixels of each block.
+    """
+    if blocks.dtype.kind == "f":
+        return np.matmul(blocks, np.ones(blocks.shape[-1], dtype=blocks.dtype), out=out)
+    return np.sum(blocks, axis=-1, out=out)
+
+
+def downsample_sum(myarr, factor, axis=0, out=None):
+    """Downsamples an array by summing over *factor* pixels along axis; Crops right side if the shape is not a multiple of factor.
 
     Args:
         myarr (numpy array): numpy array to be downsampled/binned.
         factor (int) : how much you want to rebin the array by.
+        axis (int) : which axis to downsample; Default is 0.
+        out (numpy array) : optional array to write the result into.
     """
-    xs = myarr.shape[0]
-    crop_arr = myarr[: xs - (xs % int(factor))]
-    dsarr = np.sum(
-        np.concatenate([[crop_arr[i::factor] for i in range(factor)]]), axis=0
-    )
-    return dsarr
+    return _block_sum(_block_view(myarr, factor, axis), out=out)
 
 
 # %%
-def downsample_1d(myarr, factor, weightsarr=[-1], weighted=True, in_quad=False):
+def downsample_1d(
+    myarr, factor, weightsarr=[-1], weighted=True, in_quad=False, axis=0, out=None
+):
     """
-    Downsamples a 1D array by averaging over *factor* pixels; Crops right side if the shape is not a multiple of factor; Can do in quadrature, and weighted.
+    Downsamples an array by averaging over *factor* pixels along axis; Crops right side if the shape is not a multiple of factor; Can do in quadrature, and weighted.
+    Works on a reshaped view of the input, so apart from the result no full-size arrays are allocated.
 
     Parameters:
     myarr (numpy array): numpy array to be downsampled/binned.
     factor (int) : how much you want to rebin the array by.
-    weightsarr (numpy array) : numpy array by which to weight the average; Unnecessary if weighted == False.
+    weightsarr (numpy array) : numpy array by which to weight the average, broadcastable to myarr; Unnecessary if weighted == False.
     weighted (bool) : Default True. Is this an unweighted mean or a weighted average
     in_quad (bool) : Default False. Do you want to average/sum in quadrature?
+    axis (int) : Default 0. Which axis to downsample.
+    out (numpy array) : Default None. Optional array to write the result into.
 
     Returns:
     (numpy array) downsampled myarr binned by factor, cropped to an integer multiple of factor.
@@ -48,42 +87,100 @@ def downsample_1d(myarr, factor, weightsarr=[-1], weighted=True, in_quad=False):
     Citation:
     Credit to Rachel Plesha for the initial inspiration on this. Rachel cited "Adam Ginsburg's python codes".
     """
-    if in_quad:
-        myarr = np.power(myarr, 2)
-
-    xs = myarr.shape[0]
-    crop_arr = myarr[: xs - (xs % int(factor))]
-    crop_weights = weightsarr[: xs - (xs % int(factor))]
+    blocks = _block_view(myarr, factor, axis)
 
     if weighted == True:
         if np.mean(weightsarr) == -1:
             print("CAUTION!!!! You didn't specify what to weight by!")
-            dsarr = -1
-        else:
-            dsarr = np.average(
-                np.concatenate([[crop_arr[i::factor] for i in range(factor)]]),
-                weights=np.concatenate(
-                    [[crop_weights[i::factor] for i in range(factor)]]
-                ),
-                axis=0,
+            return -1
+        weight_blocks = _block_view(
+            np.broadcast_to(weightsarr, np.shape(myarr)), factor, axis
+        )
+        weight_sums = _block_sum(weight_blocks)
+        if np.any(weight_sums == 0):
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+        if out is None:
+            out = np.empty(
+                blocks.shape[:-1], dtype=np.result_type(blocks, weight_blocks, 1.0)
             )
+        # einsum forms the weighted sums block by block, without the
+        # full-size product array that np.average would allocate.
+        if in_quad:
+            dsarr = np.einsum("...i,...i,...i->...", blocks, blocks, weight_blocks, out=out)
+        else:
+            dsarr = np.einsum("...i,...i->...", blocks, weight_blocks, out=out)
+        dsarr = np.divide(dsarr, weight_sums, out=dsarr)
 
     else:  # when weighted == False:
-        dsarr = np.mean(
-            np.concatenate([[crop_arr[i::factor] for i in range(factor)]]), axis=0
-        )
+        if in_quad:
+            if out is None:
+                out = np.empty(blocks.shape[:-1], dtype=np.result_type(blocks, 1.0))
+            dsarr = np.einsum("...i,...i->...", blocks, blocks, out=out)
+            dsarr = np.divide(dsarr, blocks.shape[-1], out=dsarr)
+        else:
+            dsarr = _block_sum(blocks, out=out)
+            dsarr = np.true_divide(dsarr, blocks.shape[-1], out=out)
     if in_quad:
-        dsarr = np.sqrt(dsarr)
+        dsarr = np.sqrt(dsarr, out=dsarr)
     return dsarr
 
 
 # %%
+BINNED_COLUMNS = [
+    "EXPTIME",
+    "WAVELENGTH",
+    "FLUX",
+    "ERROR",
+    "ERROR_LOWER",
+    "GROSS",
+    "GCOUNTS",
+]
+
+
+def _check_binsize(binsize):
+    assert binsize != 0, "Impossible binsize of 0."
+    assert binsize != 1, "Binning by 1 means doing nothing."
+    assert (
+        binsize > 1 and type(binsize) == int
+    ), "Binsize must be an integer greater than 1."
+
+
+def _resel_columns(data_table, weighted):
+    """
+    Pulls the columns binned by bin_by_resel out of data_table once, as (n_segments, n_pixels) arrays viewing the table's data.
+
+    Returns:
+    dict : column name -> numpy array, plus "WEIGHTS" : the exposure time of each pixel if weighted, else None.
+    """
+    columns = {name: np.asarray(data_table[name]) for name in BINNED_COLUMNS}
+    columns["WEIGHTS"] = None
+    if weighted == True:
+        with np.errstate(invalid="ignore", divide="ignore"):  # We want to silence warnings from dividing 0/0
+            # Exposure time can be calculated by gross counts divided by gross counts/second
+            # Dividing this way results in NaNs which are messy. replace nans with a value << exptime
+            # This way, weight is ~0 unless all values in a chunk are NaN
+            columns["WEIGHTS"] = np.nan_to_num(
+                columns["GCOUNTS"] / columns["GROSS"], nan=1e-30
+            )
+    return columns
+
+
+def _binned_table(exptimes, binned):
+    # copy=False: the Table's columns are views on the binned arrays.
+    return Table(
+        [exptimes] + [binned[name] for name in BINNED_COLUMNS[1:]],
+        names=BINNED_COLUMNS,
+        copy=False,
+    )
+
+
 def bin_by_resel(data_table, binsize=6, weighted=True, verbose=True):
     """
     Bins an entire COS dataset (in astropy Table form)
         * Wavelength and flux are combined by taking an exposure-time weighted mean of all the pixels in a bin.
         * Errors are combined as above and divided by the square root of the number of pixels in a bin
         * Counts and count rate are summed over all the pixels in a bin.
+    All segments (rows) are binned at once, as one (n_segments, n_pixels) array per column.
 
     Parameters:
     data_table (Table) : Astropy Table of COS spectral data.
@@ -94,93 +191,251 @@ def bin_by_resel(data_table, binsize=6, weighted=True, verbose=True):
     Returns:
     Table : New binned table of values
     """
-    assert binsize != 0, "Impossible binsize of 0."
-    assert binsize != 1, "Binning by 1 means doing nothing."
-    assert (
-        binsize > 1 and type(binsize) == int
-    ), "Binsize must be an integer greater than 1."
-    exptimes_ = []
-    wvlns_, fluxs_, fluxErrs_, fluxErr_lowers_, gross_s_, gcount_s_ = (
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-    )
+    _check_binsize(binsize)
+    if verbose:
+        print(f"function `bin_by_resel` is binning by {binsize}")
+    columns = _resel_columns(data_table, weighted)
+    binned = {}
 
-    print(f"function `bin_by_resel` is binning by {binsize}")
-    for i in range(len(data_table)):
-        exptimes_.append(data_table[i]["EXPTIME"])
-        wvln_, flux_, fluxErr_, fluxErr_lower_, gross_, gcount_ = data_table[i][
-            "WAVELENGTH", "FLUX", "ERROR", "ERROR_LOWER", "GROSS", "GCOUNTS"
-        ]
-        if weighted == True:
-            np.seterr(
-                invalid="ignore"
-            )  # We want to silence warnings from  dividing 0/0
-            weightsarr_ = np.nan_to_num(
-                gcount_ / gross_, nan=1e-30
-            )  # Exposure time can be calculated by gross counts divided by gross counts/second
-            # Dividing this way results in NaNs which are messy. replace nans with a value << exptime
-            # This way, weight is ~0 unless all values in a chunk are NaN
-            np.seterr(invalid="warn")  # Turn the warnings back on
-            wvln_ = downsample_1d(myarr=wvln_, weightsarr=weightsarr_, factor=binsize)
-            flux_ = downsample_1d(myarr=flux_, weightsarr=weightsarr_, factor=binsize)
-            fluxErr_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_, weighted=False, factor=binsize, in_quad=False
-                ),
-                np.sqrt(binsize),
-            )  # Errors are divided by the square root of the number of (identical) observations they represent - this is idealized and simplified. It is good for an estimation.
-            fluxErr_lower_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_lower_, weighted=False, factor=binsize, in_quad=False
-                ),
-                np.sqrt(binsize),
+    if weighted == True:
+        # The weights, and their sum over each bin, are shared by wavelength and flux.
+        weight_blocks = _block_view(columns["WEIGHTS"], binsize, axis=1)
+        weight_sums = _block_sum(weight_blocks)
+        if np.any(weight_sums == 0):
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+        for name in ["WAVELENGTH", "FLUX"]:
+            weighted_sums = np.einsum(
+                "...i,...i->...", _block_view(columns[name], binsize, axis=1), weight_blocks
             )
-            gross_ = downsample_sum(myarr=gross_, factor=binsize)
-            gcount_ = downsample_sum(myarr=gcount_, factor=binsize)
-
-        elif weighted == False:
-            weightsarr_ = -1
-
-            wvln_ = downsample_1d(myarr=wvln_, weighted=False, factor=binsize)
-            flux_ = downsample_1d(myarr=flux_, weighted=False, factor=binsize)
-            fluxErr_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_, weighted=False, factor=binsize, in_quad=False
-                ),
-                np.sqrt(binsize),
+            binned[name] = np.divide(weighted_sums, weight_sums, out=weighted_sums)
+
+    else:  # when weighted == False:
+        for name in ["WAVELENGTH", "FLUX"]:
+            binned[name] = downsample_1d(columns[name], binsize, weighted=False, axis=1)
+
+    for name in ["ERROR", "ERROR_LOWER"]:
+        # Errors are divided by the square root of the number of (identical) observations they represent - this is idealized and simplified. It is good for an estimation.
+        binned[name] = downsample_1d(columns[name], binsize, weighted=False, axis=1)
+        binned[name] /= np.sqrt(binsize)
+
+    for name in ["GROSS", "GCOUNTS"]:
+        binned[name] = downsample_sum(columns[name], binsize, axis=1)
+
+    return _binned_table(columns["EXPTIME"], binned)
+
+
+def _prefix_sum(arr):
+    """
+    Cumulative sum along the pixel axis with a leading 0, in float64, so that the sum of pixels [a, b) is prefix[..., b] - prefix[..., a].
+    Returns None if arr has non-finite values or overflows, which would spread to every later bin.
+    """
+    prefix = np.zeros(arr.shape[:-1] + (arr.shape[-1] + 1,))
+    with np.errstate(invalid="ignore", over="ignore"):
+        np.cumsum(arr, axis=-1, out=prefix[..., 1:])
+    # A NaN or an overflow anywhere in a segment shows up in its total.
+    if not np.all(np.isfinite(prefix[..., -1])):
+        return None
+    return prefix
+
+
+class _PrefixSums:
+    """
+    Cumulative sums of the columns bin_by_resel bins, computed once (and only when first needed), from which the binned value of any bin at any binsize is a difference of two entries.
+
+    Bins are chosen by arrays of segment (row) and bin indices, so callers can ask for every bin or only the few they need.
+    Where the cumulative sums cannot be trusted - a column with non-finite values, or a bin whose weights are so small compared with the whole segment that the difference of cumulative sums loses them (i.e. bins made only of NaN pixels) - the bin is summed directly instead, so the results match bin_by_resel.
+    """
+
+    def __init__(self, data_table, weighted=True):
+        self.weighted = weighted
+        self.columns = _resel_columns(data_table, weighted)
+        self.n_segments, self.n_pixels = self.columns["WAVELENGTH"].shape
+        self._prefixes = {}
+
+    def _prefix(self, name, weighted=False):
+        key = (name, weighted)
+        if key not in self._prefixes:
+            values = self.columns[name]
+            if weighted:
+                with np.errstate(invalid="ignore", over="ignore"):
+                    values = values * self.columns["WEIGHTS"]
+            self._prefixes[key] = _prefix_sum(values)
+        return self._prefixes[key]
+
+    def n_bins(self, binsize):
+        return self.n_pixels // binsize
+
+    def all_bins(self, binsize):
+        return np.indices((self.n_segments, self.n_bins(binsize)))
+
+    def sums(self, name, binsize, segments, bins, weighted=False):
+        """Sums of column name (times the weights, if weighted) over the given bins."""
+        prefix = self._prefix(name, weighted)
+        if prefix is None:
+            blocks = _block_view(self.columns[name], binsize, axis=1)[segments, bins]
+            if weighted:
+                weight_blocks = _block_view(self.columns["WEIGHTS"], binsize, axis=1)[segments, bins]
+                return np.einsum("...i,...i->...", blocks, weight_blocks)
+            return _block_sum(blocks)
+        starts = bins * binsize
+        return prefix[segments, starts + binsize] - prefix[segments, starts]
+
+    def means(self, name, binsize, segments, bins):
+        """Means of column name over the given bins, exposure-time weighted if self.weighted, in float64."""
+        if binsize == 1:
+            return self.columns[name][segments, bins].astype(np.float64)
+        if not self.weighted:
+            return self.sums(name, binsize, segments, bins) / binsize
+
+        weight_sums = self.sums("WEIGHTS", binsize, segments, bins)
+        weighted_sums = self.sums(name, binsize, segments, bins, weighted=True)
+        weight_prefix = self._prefix("WEIGHTS")
+        if weight_prefix is not None:
+            # A bin weighing less than this is within rounding error of the
+            # segment total, so its sums are recomputed directly.
+            lost = weight_sums <= weight_prefix[segments, -1] * 1e-9
+            if np.any(lost):
+                lost_segments, lost_bins = segments[lost], bins[lost]
+                weight_blocks = _block_view(self.columns["WEIGHTS"], binsize, axis=1)[lost_segments, lost_bins]
+                blocks = _block_view(self.columns[name], binsize, axis=1)[lost_segments, lost_bins]
+                weight_sums[lost] = _block_sum(weight_blocks)
+                weighted_sums[lost] = np.einsum("...i,...i->...", blocks, weight_blocks)
+        if np.any(weight_sums == 0):
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+        return weighted_sums / weight_sums
+
+
+def bin_by_resel_multi(data_table, binsizes, weighted=True, verbose=True):
+    """
+    Bins an entire COS dataset by each of several binsizes, as bin_by_resel would.
+    Cumulative sums of every column are computed once; each binsize then costs only a difference of those sums at the bin edges, rather than a pass over every pixel.
+
+    Parameters:
+    data_table (Table) : Astropy Table of COS spectral data.
+    binsizes (list of int) : What to bin by; each must be an integer greater than 1.
+    weighted (bool) : Whether to weight the averages by exposure time of a pixel; Default is True.
+    verbose (bool) : Whether to print major steps the function is taking; Default is True.
+
+    Returns:
+    dict : binsize -> Table of binned values
+    """
+    for binsize in binsizes:
+        _check_binsize(binsize)
+    if verbose:
+        print(f"function `bin_by_resel_multi` is binning by {len(binsizes)} binsizes")
+    prefix_sums = _PrefixSums(data_table, weighted)
+    columns = prefix_sums.columns
+
+    tables = {}
+    for binsize in binsizes:
+        segments, bins = prefix_sums.all_bins(binsize)
+        binned = {}
+        for name in ["WAVELENGTH", "FLUX"]:
+            # Same dtype as bin_by_resel, which only promotes when weighting.
+            dtype = (
+                np.result_type(columns[name], columns["WEIGHTS"], 1.0)
+                if weighted == True
+                else columns[name].dtype
             )
-            fluxErr_lower_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_lower_, weighted=False, factor=binsize, in_quad=False
-                ),
-                np.sqrt(binsize),
+            binned[name] = prefix_sums.means(name, binsize, segments, bins).astype(dtype, copy=False)
+        for name in ["ERROR", "ERROR_LOWER"]:
+            binned[name] = (
+                prefix_sums.sums(name, binsize, segments, bins) / binsize
+            ).astype(columns[name].dtype, copy=False)
+            binned[name] /= np.sqrt(binsize)
+        for name in ["GROSS", "GCOUNTS"]:
+            binned[name] = prefix_sums.sums(name, binsize, segments, bins).astype(
+                columns[name].dtype, copy=False
             )
-            gross_ = downsample_sum(myarr=gross_, factor=binsize)
-            gcount_ = downsample_sum(myarr=gcount_, factor=binsize)
+        tables[binsize] = _binned_table(columns["EXPTIME"], binned)
+    return tables
 
-        wvlns_.append(wvln_)
-        fluxs_.append(flux_)
-        fluxErrs_.append(fluxErr_)
-        fluxErr_lowers_.append(fluxErr_lower_)
-        gross_s_.append(gross_)
-        gcount_s_.append(gcount_)
 
-    return Table(
-        [exptimes_, wvlns_, fluxs_, fluxErrs_, fluxErr_lowers_, gross_s_, gcount_s_],
-        names=[
-            "EXPTIME",
-            "WAVELENGTH",
-            "FLUX",
-            "ERROR",
-            "ERROR_LOWER",
-            "GROSS",
-            "GCOUNTS",
-        ],
-    )
+# %%
+class _WavelengthIndex:
+    """
+    Finds the pixels of wavelength windows in each segment of one table.
+    It is built from the table's current values on every call, so is never stale after the columns are edited in place.
+    COS wavelengths increase along a segment, so the pixels strictly inside a window are a slice found by two binary searches, and the extent of the segment is known once for all windows.
+    Cumulative sums of sqrt(GCOUNTS), and of the exposure weights when asked for, then give the mean SNR over any window in constant time.
+    Segments whose wavelengths do not increase are handled with boolean masks.
+    """
+
+    def __init__(self, data_table):
+        self.wavelengths = np.atleast_2d(np.asarray(data_table["WAVELENGTH"]))
+        self.gross = np.atleast_2d(np.asarray(data_table["GROSS"]))
+        self.gcounts = np.atleast_2d(np.asarray(data_table["GCOUNTS"]))
+        self.increasing = np.all(self.wavelengths[:, 1:] >= self.wavelengths[:, :-1], axis=1)
+        self.lows = np.min(self.wavelengths, axis=1)
+        self.highs = np.max(self.wavelengths, axis=1)
+        self._prefixes = {}
+
+    def window(self, segment, start, end):
+        """Index (a slice, or a mask if the segment's wavelengths do not increase) of the pixels with start < wavelength < end."""
+        wavelengths = self.wavelengths[segment]
+        if not self.increasing[segment]:
+            return (wavelengths > start) & (wavelengths < end)
+        return slice(
+            np.searchsorted(wavelengths, start, side="right"),
+            np.searchsorted(wavelengths, end, side="left"),
+        )
+
+    def weights(self, segment=slice(None)):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.nan_to_num(self.gcounts[segment] / self.gross[segment], nan=1e-30)
+
+    def _prefix(self, name):
+        if name not in self._prefixes:
+            snr = np.sqrt(self.gcounts)
+            values = {"SNR": lambda: snr, "WEIGHTS": self.weights, "WEIGHTED_SNR": lambda: snr * self.weights()}[name]
+            with np.errstate(invalid="ignore", over="ignore"):
+                self._prefixes[name] = _prefix_sum(values())
+        return self._prefixes[name]
+
+    def window_snr(self, segment, starts, ends, weighted=False):
+        """
+        Mean (exposure time weighted if weighted) sqrt(GCOUNTS) of one segment over each window (starts[k], ends[k]); NaN for windows with no pixels.
+        """
+        n_windows = len(starts)
+        snr = np.full(n_windows, np.nan)
+        if self.increasing[segment]:
+            firsts = np.searchsorted(self.wavelengths[segment], starts, side="right")
+            lasts = np.searchsorted(self.wavelengths[segment], ends, side="left")
+        else:
+            firsts = lasts = None
+        direct = np.ones(n_windows, dtype=bool) if firsts is None else lasts <= firsts
+
+        if firsts is not None:
+            nonempty = ~direct
+            if not weighted and self._prefix("SNR") is not None:
+                prefix = self._prefix("SNR")[segment]
+                snr[nonempty] = (prefix[lasts] - prefix[firsts])[nonempty] / (lasts - firsts)[nonempty]
+            elif weighted and self._prefix("WEIGHTS") is not None and self._prefix("WEIGHTED_SNR") is not None:
+                weight_prefix = self._prefix("WEIGHTS")[segment]
+                weighted_prefix = self._prefix("WEIGHTED_SNR")[segment]
+                weight_sums = weight_prefix[lasts] - weight_prefix[firsts]
+                # A window weighing less than this is within rounding error of the segment total.
+                lost = nonempty & (weight_sums <= weight_prefix[-1] * 1e-9)
+                usable = nonempty & ~lost
+                snr[usable] = (weighted_prefix[lasts] - weighted_prefix[firsts])[usable] / weight_sums[usable]
+                direct = direct | lost
+            else:
+                direct = np.ones(n_windows, dtype=bool)
+            # Empty windows stay NaN.
+            direct &= lasts > firsts
+
+        for k in np.nonzero(direct)[0]:
+            window = self.window(segment, starts[k], ends[k])
+            gcount_range = self.gcounts[segment][window]
+            if len(gcount_range) == 0:
+                continue
+            if weighted:
+                weights = self.weights(segment)[window]
+                if np.sum(weights) != 0:
+                    snr[k] = np.average(np.sqrt(gcount_range), weights=weights)
+            else:
+                snr[k] = np.mean(np.sqrt(gcount_range))
+        return snr
 
 
 # %%
@@ -199,6 +454,7 @@ def estimate_snr(
     Parameters:
     data_table (Astropy Table) : astropy table of COS data.
     snr_range (list) : list of two values - [wvln_range_start , wvln_range_end]; Default is [-1,-1], indicating that we will take over all values.
+        May also be an array of shape (n_windows, 2) holding many ranges, which are all evaluated in one call (see Returns).
     bin_data_first (bool) : Should we begin by binning the data by the binsize_? Default is False.
     binsize_ (int) : If bin_data_first == True, what to bin by; Default is 6 for fuv resel.
     weighted (bool) : Do you want the average to be an exposure time weighted average rather than the default unweighted mean; Default is False.
@@ -207,6 +463,12 @@ def estimate_snr(
     Returns:
     float : A single value for the exptime-weighted average or mean SNR over the specified snr_range; -1 if no specified range.
     nested list : 1st level of list corresponds to the segments/rows of the input data_table, 2nd level holds wvln, snr, segmentnumber over snr_range -\n\t\t ie [[-1,-1,-1],[wvln over range array, wvln over range array, row in input data_table int][-1,-1,-1]].
+
+    With an (n_windows, 2) array of ranges, instead:
+    numpy array : shape (n_windows,), the value above for each range.
+    numpy array : shape (n_windows, n_segments), the SNR of every segment over every range; NaN where the segment does not cover the range.
+
+    Windows are found by binary search on each segment's wavelengths, which are indexed once per call for all of its ranges.
     """
     snr_array = []  # Initialize to empty array
     weight_avg_snr = -1  # Will return -1 UNLESS changed
@@ -219,23 +481,28 @@ def estimate_snr(
         data_table = bin_by_resel(data_table, binsize=binsize_)
 
     # STEP TWO - ESTIMATE SNR
-    for i in range(len(data_table)):
-        wvln_, gross_, gcount_ = data_table[i]["WAVELENGTH", "GROSS", "GCOUNTS"]
+    windows = np.asarray(snr_range, dtype=float)
+    if windows.ndim == 2:
+        return _estimate_snr_windows(data_table, windows, weighted, verbose)
 
+    index = None if snr_range == [-1, -1] else _WavelengthIndex(data_table)
+    for i in range(len(data_table)):
         if snr_range == [-1, -1]:  # No range specified - estimates over the whole range
+            wvln_, gcount_ = data_table[i]["WAVELENGTH", "GCOUNTS"]
             snr_array.append([wvln_, np.sqrt(gcount_), i])
             if verbose:
                 print("No range specified.")
 
         else:
-            if (min(snr_range) > min(wvln_)) & (max(snr_range) < max(wvln_)):
+            seg_min, seg_max = index.lows[i], index.highs[i]
+            if (min(snr_range) > seg_min) & (max(snr_range) < seg_max):
                 segsFound += 1
-                wvln_range_mask = (wvln_ > snr_range[0]) & (wvln_ < snr_range[1])
+                window = index.window(i, snr_range[0], snr_range[1])
 
                 wvln_range, gcount_range, gross_range = (
-                    wvln_[wvln_range_mask],
-                    gcount_[wvln_range_mask],
-                    gross_[wvln_range_mask],
+                    index.wavelengths[i][window],
+                    index.gcounts[i][window],
+                    index.gross[i][window],
                 )
 
                 snr_array.append([wvln_range, np.sqrt(gcount_range), i])
@@ -245,8 +512,8 @@ def estimate_snr(
                     if verbose:
                         print(
                             f"In range on {i}-th segment with limits:",
-                            min(wvln_),
-                            max(wvln_),
+                            seg_min,
+                            seg_max,
                             f"\nUnweighted mean SNR over the range {snr_range} is: {weight_avg_snr}",
                         )
 
@@ -258,8 +525,8 @@ def estimate_snr(
                     if verbose:
                         print(
                             f"In range on {i}-th segment with limits:",
-                            min(wvln_),
-                            max(wvln_),
+                            seg_min,
+                            seg_max,
                             f"\nEXPTIME weighted average SNR over the range {snr_range} is: {weight_avg_snr}",
                         )
             else:
@@ -267,11 +534,11 @@ def estimate_snr(
                 if verbose:
                     print(
                         f"Out of range on {i}-th segment with limits:",
-                        min(wvln_),
-                        max(wvln_),
+                        seg_min,
+                        seg_max,
                     )
     if (  # Check whether the code has found any specified wavelength ranges
-        all([elem == -1 for elem in (snr_array[0][2], snr_array[1][2])])
+        all([elem[2] == -1 for elem in snr_array])
     ) & (  # Check that the user specified wavelength ranges
         snr_range != [-1, -1]
     ):
@@ -285,6 +552,130 @@ def estimate_snr(
     return weight_avg_snr, snr_array
 
 
+# %%
+def _estimate_snr_windows(data_table, windows, weighted=False, verbose=True):
+    """
+    estimate_snr over an (n_windows, 2) array of [wvln_range_start, wvln_range_end] rows; see estimate_snr for the returned arrays.
+    """
+    index = _WavelengthIndex(data_table)
+    n_segments = len(index.wavelengths)
+    snr_matrix = np.full((len(windows), n_segments), np.nan)
+    # As in estimate_snr, a segment covers a window if the window lies strictly inside it.
+    covered = (windows.min(axis=1)[:, None] > index.lows[None, :]) & (
+        windows.max(axis=1)[:, None] < index.highs[None, :]
+    )
+    for segment in range(n_segments):
+        rows = np.nonzero(covered[:, segment])[0]
+        if len(rows):
+            snr_matrix[rows, segment] = index.window_snr(
+                segment, windows[rows, 0], windows[rows, 1], weighted=weighted == True
+            )
+
+    # The single value of estimate_snr comes from the last segment covering the range.
+    weight_avg_snr = np.full(len(windows), -1.0)
+    found = covered.any(axis=1)
+    last_segment = n_segments - 1 - np.argmax(covered[:, ::-1], axis=1)
+    weight_avg_snr[found] = snr_matrix[found, last_segment[found]]
+    if verbose:
+        print(f"Estimated the SNR over {len(windows)} ranges; {np.count_nonzero(~found)} were not found in any segment.")
+        if np.any(covered.sum(axis=1) > 1):
+            print(
+                "\nSome ranges were found on multiple segments, (grating = G230L?) ,which at present is not fully supported. The returned matrix should be accurate, but the single value is that of the last segment."
+            )
+    return weight_avg_snr, snr_matrix
+
+
+# %%
+def _range_pixels(wavelengths, snr_range):
+    """
+    The pixels [first, last) of one segment with wavelengths within snr_range, or None if its wavelengths are not increasing.
+    """
+    if not np.all(wavelengths[1:] >= wavelengths[:-1]):
+        return None
+    return (
+        np.searchsorted(wavelengths, snr_range[0], side="left"),
+        np.searchsorted(wavelengths, snr_range[1], side="right"),
+    )
+
+
+def _range_candidate_bins(range_pixels, binsize, n_bins):
+    """
+    Indices of the bins of one segment that can have a binned wavelength inside the range found by _range_pixels, plus its first and last bins.
+    A binned wavelength lies between the wavelengths of the bin's first and last pixels, so for increasing wavelengths only the bins around the pixels in the range qualify; otherwise every bin is a candidate.
+    """
+    if n_bins == 0 or range_pixels is None:
+        return np.arange(n_bins)
+    first, last = range_pixels[0] // binsize, range_pixels[1] // binsize
+    candidates = np.arange(max(first - 1, 0), min(last, n_bins - 1) + 1)
+    return np.unique(np.concatenate([[0], candidates, [n_bins - 1]]))
+
+
+def snr_sweep(data_table, binsizes, snr_range, weighted=True):
+    """
+    Estimates the SNR over snr_range for many binsizes at once, as the bottom of this file used to by calling estimate_snr and bin_by_resel for every binsize.
+    Cumulative sums of the columns (see bin_by_resel_multi) are computed once; for each binsize only the few bins around snr_range are then evaluated, so the cost is one pass over the pixels plus a small, fixed amount per binsize.
+
+    Parameters:
+    data_table (Table) : Astropy Table of COS spectral data, unbinned.
+    binsizes (list of int) : What to bin by; 1 means the unbinned data.
+    snr_range (list) : list of two values - [wvln_range_start , wvln_range_end].
+    weighted (bool) : Whether the counts-based SNR is an exposure time weighted average rather than a mean, as in estimate_snr; Default is True.
+
+    Returns:
+    Table : One row per binsize, with columns
+        BINSIZE,
+        SNR_COUNTS : sqrt(GCOUNTS) estimate of estimate_snr(..., bin_data_first=True, weighted=weighted); -1 where no segment covers snr_range (if several do, the last one counts, as in estimate_snr),
+        SNR_FLUX, SNR_FLUX_LOWER : nanmean of binned FLUX / ERROR and FLUX / ERROR_LOWER over snr_range, across all segments.
+    """
+    for binsize in binsizes:
+        if binsize != 1:
+            _check_binsize(binsize)
+    prefix_sums = _PrefixSums(data_table, weighted=True)
+    range_pixels = [_range_pixels(wavelengths, snr_range) for wavelengths in prefix_sums.columns["WAVELENGTH"]]
+    snr_counts, snr_flux, snr_flux_lower = [], [], []
+
+    for binsize in binsizes:
+        n_bins = prefix_sums.n_bins(binsize)
+        counts_snr = -1
+        ratios, ratios_lower = [], []
+        for segment in range(prefix_sums.n_segments):
+            bins = _range_candidate_bins(range_pixels[segment], binsize, n_bins)
+            if len(bins) == 0:
+                continue
+            segments = np.full_like(bins, segment)
+            wvln_ = prefix_sums.means("WAVELENGTH", binsize, segments, bins)
+            in_range = (wvln_ > snr_range[0]) & (wvln_ < snr_range[1])
+            segments, bins = segments[in_range], bins[in_range]
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                flux_ = prefix_sums.means("FLUX", binsize, segments, bins)
+                # Binned errors are the mean error divided by sqrt(binsize), as in bin_by_resel.
+                scale = binsize * np.sqrt(binsize)
+                ratios.append(flux_ / (prefix_sums.sums("ERROR", binsize, segments, bins) / scale))
+                ratios_lower.append(flux_ / (prefix_sums.sums("ERROR_LOWER", binsize, segments, bins) / scale))
+
+            if (min(snr_range) > np.min(wvln_)) & (max(snr_range) < np.max(wvln_)):
+                gcount_range = prefix_sums.sums("GCOUNTS", binsize, segments, bins)
+                if weighted == True:
+                    gross_range = prefix_sums.sums("GROSS", binsize, segments, bins)
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        weights = np.nan_to_num(gcount_range / gross_range, nan=1e-30)
+                    counts_snr = np.average(np.sqrt(gcount_range), weights=weights)
+                else:
+                    counts_snr = np.mean(np.sqrt(gcount_range))
+
+        snr_counts.append(counts_snr)
+        ratios = np.concatenate(ratios) if ratios else np.array([])
+        ratios_lower = np.concatenate(ratios_lower) if ratios_lower else np.array([])
+        snr_flux.append(np.nan if np.all(np.isnan(ratios)) else np.nanmean(ratios))
+        snr_flux_lower.append(np.nan if np.all(np.isnan(ratios_lower)) else np.nanmean(ratios_lower))
+
+    return Table(
+        [list(binsizes), snr_counts, snr_flux, snr_flux_lower],
+        names=["BINSIZE", "SNR_COUNTS", "SNR_FLUX", "SNR_FLUX_LOWER"],
+    )
+
+
 # %%
 def withinPercent(val1, val2, percent=1.0):
     """
@@ -324,73 +715,14 @@ if __name__ == "__main__":
         import matplotlib.pyplot as plt
 
         unbin_tab = Table.read(filepath)
-        X = [1]
-        snr_counts_approach = [
-            estimate_snr(
-                unbin_tab,
-                snr_range=[1565, 1575],
-                bin_data_first=False,
-            )[0]
-        ]
-
-        snr_flux_approach = [
-            np.nanmean(
-                unbin_tab["FLUX"][
-                    (unbin_tab["WAVELENGTH"] > 1565) & (unbin_tab["WAVELENGTH"] < 1575)
-                ]
-                / unbin_tab["ERROR"][
-                    (unbin_tab["WAVELENGTH"] > 1565) & (unbin_tab["WAVELENGTH"] < 1575)
-                ]
-            )
-        ]
-        snr_flux_approach_low = [
-            np.nanmean(
-                unbin_tab["FLUX"][
-                    (unbin_tab["WAVELENGTH"] > 1565) & (unbin_tab["WAVELENGTH"] < 1575)
-                ]
-                / unbin_tab["ERROR_LOWER"][
-                    (unbin_tab["WAVELENGTH"] > 1565) & (unbin_tab["WAVELENGTH"] < 1575)
-                ]
-            )
-        ]
-        for bs_ in range(1, 100):
-            try:
-                a, b = estimate_snr(
-                    unbin_tab,
-                    snr_range=[1565, 1575],
-                    bin_data_first=True,
-                    binsize_=bs_,
-                    weighted=True,
-                    verbose=False,
-                )
-                X.append(bs_)
-                snr_counts_approach.append(a)
-                # flux/error approach:
-                bin_tab = bin_by_resel(unbin_tab, binsize=bs_)
-                x1d_error_range = (
-                    bin_tab["FLUX"][
-                        (bin_tab["WAVELENGTH"] > 1565) & (bin_tab["WAVELENGTH"] < 1575)
-                    ]
-                    / bin_tab["ERROR"][
-                        (bin_tab["WAVELENGTH"] > 1565) & (bin_tab["WAVELENGTH"] < 1575)
-                    ]
-                )
-                x1d_error_range_low = (
-                    bin_tab["FLUX"][
-                        (bin_tab["WAVELENGTH"] > 1565) & (bin_tab["WAVELENGTH"] < 1575)
-                    ]
-                    / bin_tab["ERROR_LOWER"][
-                        (bin_tab["WAVELENGTH"] > 1565) & (bin_tab["WAVELENGTH"] < 1575)
-                    ]
-                )
-                snr_flux_approach_val = np.nanmean(x1d_error_range)
-                snr_flux_approach_val_low = np.nanmean(x1d_error_range_low)
-                snr_flux_approach.append(snr_flux_approach_val)
-                snr_flux_approach_low.append(snr_flux_approach_val_low)
-
-            except Exception as ex:
-                print("failed for", bs_)
-                print(ex)
+        # snr_sweep computes every binsize from one pass over the table, rather than rebinning it twice per binsize.
+        # Binsize 1 is the unbinned data, whose counts-based SNR has always been the unweighted mean.
+        unbinned = snr_sweep(unbin_tab, [1], snr_range=[1565, 1575], weighted=False)
+        binned = snr_sweep(unbin_tab, list(range(2, 100)), snr_range=[1565, 1575], weighted=True)
+        X = [1] + list(binned["BINSIZE"])
+        snr_counts_approach = list(unbinned["SNR_COUNTS"]) + list(binned["SNR_COUNTS"])
+        snr_flux_approach = list(unbinned["SNR_FLUX"]) + list(binned["SNR_FLUX"])
+        snr_flux_approach_low = list(unbinned["SNR_FLUX_LOWER"]) + list(binned["SNR_FLUX_LOWER"])
         plt.figure(figsize=(8, 6), dpi=200)
         # plt.scatter(X[1:],limfluxerrs, label = "From my binning algorithm")
         plt.scatter(X, snr_counts_approach, label="From my binning algorithm")
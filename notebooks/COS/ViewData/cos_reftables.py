@@ -0,0 +1,194 @@
+"""
+DESCRIPTION:
+    A cache of parsed COS reference files, shared by the helpers of the COS Notebooks, with:
+    * get_reference_table: a FITS reference table (i.e. XTRACTAB, DISPTAB) read once, with its rows indexed by (OPT_ELEM, CENWAVE, SEGMENT, APERTURE)
+    * get_lsf: an LSF kernel file, as read_lsf in LSF.ipynb
+    * readxtractab and get_disp_params: the functions of the same names in Extract.ipynb and LSF.ipynb, answered from the cache
+
+    Each file is parsed on first use and kept until its modification time or size changes, so looking up extraction boxes or dispersion relations for many exposures costs a dict lookup rather than re-reading FITS each time.
+    Columns are kept as numpy arrays, and the rows of a mode are returned as views of them where the rows are contiguous.
+"""
+# %%
+import os
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+# Columns identifying the mode a row of a reference table applies to; tables lacking one are indexed without it.
+KEY_COLUMNS = ("OPT_ELEM", "CENWAVE", "SEGMENT", "APERTURE")
+
+# (kind, absolute path) -> ((mtime_ns, size), parsed file)
+_CACHE = {}
+
+
+# %%
+def _cached(kind, path, loader):
+    """Returns loader(path), parsing the file again only if it changed since it was last parsed."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    entry = _CACHE.get((kind, path))
+    if entry is None or entry[0] != stamp:
+        entry = (stamp, loader(path))
+        _CACHE[(kind, path)] = entry
+    return entry[1]
+
+
+def clear_cache():
+    """Forgets every parsed file."""
+    _CACHE.clear()
+
+
+def _key_value(value):
+    """Normalizes a key so that i.e. b"PSA ", "psa" and "PSA", or 1291, 1291.0 and "1291", are the same key."""
+    if isinstance(value, (str, bytes, np.str_, np.bytes_)):
+        value = value.decode() if isinstance(value, bytes) else str(value)
+        try:
+            value = float(value)
+        except ValueError:
+            return value.strip().upper()
+    return int(value) if float(value).is_integer() else float(value)
+
+
+# %%
+class ReferenceTable:
+    """
+    One table extension of a COS reference file: its columns as numpy arrays and an index of the rows of each mode.
+
+    Attributes:
+    path (str) : the file.
+    header (fits Header) : the primary header, i.e. for the DETECTOR.
+    columns (dict) : column name (upper case) -> numpy array.
+    key_columns (tuple of str) : the KEY_COLUMNS present in the table, in the order of the index keys.
+    index (dict) : tuple of key values -> rows, as a slice if they are contiguous and an array of row numbers otherwise.
+    """
+
+    def __init__(self, path, ext=1):
+        self.path = path
+        with fits.open(path) as hdul:
+            self.header = hdul[0].header.copy()
+            data = hdul[ext].data
+            self.columns = {name.upper(): np.array(data[name]) for name in data.names}
+        self.key_columns = tuple(name for name in KEY_COLUMNS if name in self.columns)
+        self.index = self._build_index()
+        # Rows of the lookups that left some key columns as None
+        self._partial = {}
+
+    @property
+    def n_rows(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def _build_index(self):
+        keys = list(zip(*[[_key_value(value) for value in self.columns[name]] for name in self.key_columns]))
+        rows_of = {}
+        for row, key in enumerate(keys if self.key_columns else [()] * self.n_rows):
+            rows_of.setdefault(key, []).append(row)
+        index = {}
+        for key, rows in rows_of.items():
+            contiguous = rows[-1] - rows[0] == len(rows) - 1
+            index[key] = slice(rows[0], rows[-1] + 1) if contiguous else np.array(rows)
+        return index
+
+    def rows(self, opt_elem=None, cenwave=None, segment=None, aperture=None):
+        """
+        The rows of a mode: a slice or array of row numbers, to index the columns with.
+        Arguments left as None match any value; if all the key columns of the table are given this is a single dict lookup.
+        """
+        wanted = dict(zip(KEY_COLUMNS, (opt_elem, cenwave, segment, aperture)))
+        key = tuple(None if wanted[name] is None else _key_value(wanted[name]) for name in self.key_columns)
+        if None not in key:
+            return self.index.get(key, slice(0, 0))
+
+        if key not in self._partial:
+            matches = [
+                np.arange(self.n_rows)[rows] if isinstance(rows, slice) else rows
+                for table_key, rows in self.index.items()
+                if all(value is None or value == table_value for value, table_value in zip(key, table_key))
+            ]
+            self._partial[key] = np.sort(np.concatenate(matches)) if matches else slice(0, 0)
+        return self._partial[key]
+
+    def select(self, name, opt_elem=None, cenwave=None, segment=None, aperture=None):
+        """The values of column name in the rows of a mode; a view of the column where the rows are contiguous."""
+        return self.columns[name.upper()][self.rows(opt_elem, cenwave, segment, aperture)]
+
+
+def get_reference_table(path, ext=1):
+    """The ReferenceTable of a reference file, parsed only if it is new or changed since it was last parsed."""
+    return _cached(("table", ext), path, lambda abspath: ReferenceTable(abspath, ext=ext))
+
+
+def _read_lsf(filename):
+    lsf = Table.read(filename, format="ascii", header_start=0)
+    pix = np.arange(len(lsf)) - len(lsf) // 2
+    lsf_wvlns = np.array([int(float(k)) for k in lsf.keys()])
+    return lsf, pix, lsf_wvlns
+
+
+def get_lsf(filename):
+    """
+    Reads an LSF file once, as read_lsf in LSF.ipynb. The returned table is shared between callers, so should not be modified.
+
+    Returns:
+    Astropy Table : the table of LSF kernels, one column per wavelength.
+    numpy array : pixel offset of each kernel row from the kernel center.
+    numpy array : wavelength of each kernel, from the column names.
+    """
+    return _cached("lsf", filename, _read_lsf)
+
+
+# %%
+def readxtractab(xtractab, grat, cw, aper):
+    """
+    Reads in an XTRACTAB row of a particular COS mode and returns extraction box sizes and locations, as readxtractab in Extract.ipynb.
+    Inputs:
+    xtractab (str) : path to xtractab file.
+    grat (string) : grating of relavent row (i.e. "G185M")
+    cw (int or numerical) : cenwave of relavent row (i.e. (1786))
+    aper (str) : aperture of relavent row (i.e. "PSA")
+    Returns:
+    y locations of bottoms/tops of extraction boxes
+        if NUV: stripe NUVA/B/C, and 2 background boxes
+        elif FUV: FUVA/B, and 2 background boxes for each FUVA/B.
+    """
+    table = get_reference_table(xtractab)
+
+    def column(name, segment):
+        return table.select(name, opt_elem=grat, cenwave=cw, segment=segment, aperture=aper)
+
+    def bounds(center, height):
+        return [center - height / 2, center + height / 2]
+
+    if table.header["DETECTOR"] != "FUV":  # Then NUV data:
+        spec_bounds = [bounds(column("B_SPEC", seg)[0], column("HEIGHT", seg)[0]) for seg in ["NUVA", "NUVB", "NUVC"]]
+        # The background locations are by default the same for all stripes
+        bhgta = column("BHEIGHT", "NUVA")
+        return (*spec_bounds, bounds(column("B_BKG1", "NUVA"), bhgta), bounds(column("B_BKG2", "NUVA"), bhgta))
+
+    spec_bounds = [bounds(column("B_SPEC", seg)[0], column("HEIGHT", seg)[0]) for seg in ["FUVA", "FUVB"]]
+    bkg_bounds = []
+    for seg in ["FUVA", "FUVB"]:
+        bkg_bounds.append(bounds(column("B_BKG1", seg), column("B_HGT1", seg)))
+        bkg_bounds.append(bounds(column("B_BKG2", seg), column("B_HGT2", seg)))
+    return (*spec_bounds, *bkg_bounds)
+
+
+def get_disp_params(disptab, cenwave, segment, x=[]):
+    """
+    Gives the dispersion relationship/wavelength solution of the PSA on a segment, as get_disp_params in LSF.ipynb.
+    Parameters:
+    disptab (str): Path to your DISPTAB file.
+    cenwave (str): Cenwave for calculation of dispersion relationship.
+    segment (str): FUVA or FUVB?
+    x (list): Range in pixels over which to calculate wvln with dispersion relationship (optional).
+    Returns:
+    disp_coeff (list): Coefficients of the relevant polynomial dispersion relationship
+    wavelength (list; if applicable): Wavelengths corresponding to input x pixels
+    """
+    table = get_reference_table(disptab)
+    disp_coeff = table.select("COEFF", cenwave=cenwave, segment=segment, aperture="PSA")[0]
+    if len(x):  # If given a pixel range, build up a polynomial wvln solution pix -> λ
+        wavelength = np.polyval(p=disp_coeff[::-1], x=np.arange(16384))
+        return disp_coeff, wavelength
+    return disp_coeff
@@ -0,0 +1,270 @@
+"""
+DESCRIPTION:
+    Convolves spectra with the wavelength-dependent COS Line Spread Function (LSF), as `convolve_lsf` in the COS LSF.ipynb Notebook does, for many spectra at once.
+
+    The Notebook re-reads the LSF file and DISPTAB and remaps the kernels onto the COS wavelength scale every time it convolves a spectrum.
+    Here that setup is done once per (LSF file, DISPTAB, cenwave, detector) and kept in an in-process LRU cache and as a .npz file in LSF_CACHE_DIR, both keyed on the modification times of the two files.
+
+    The convolution itself is the same piecewise one as in the Notebook: each kernel applies to the stretch of the spectrum closest to its wavelength (its "jurisdiction"), which is extended by its edge values at both ends.
+    All the stretches are convolved together with FFTs of one common length, and the stretch bounds, interpolation weights and kernel FFTs are kept for each wavelength grid, so convolving hundreds of model spectra on the same grid only repeats the FFTs.
+
+    For example:
+        engine = get_lsf_engine("data/aa_LSFTable_G130M_1291_LP4_cn.dat", "data/05i1639ml_disp.fits", 1291)
+        wave_cos, convolved = engine.convolve(wavelength, model_fluxes)  # model_fluxes of shape (n_models, len(wavelength))
+"""
+# %%
+import collections
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from cos_reftables import get_lsf, get_reference_table
+
+# Where the remapped kernels are saved; set COS_LSF_CACHE to use another directory.
+LSF_CACHE_DIR = os.environ.get("COS_LSF_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "cos_lsf"))
+# Engines kept in memory, and convolution plans (one per wavelength grid) kept by each engine.
+LSF_CACHE_SIZE = 16
+PLAN_CACHE_SIZE = 8
+# Bumped whenever the remapping changes, so older .npz files are not used.
+CACHE_VERSION = 1
+# Reach of the first and last kernels beyond their wavelength, in Angstroms, as in LSF.ipynb
+EDGE_JURISDICTION = 500
+
+
+# %%
+def read_lsf(filename):
+    """
+    Reads an LSF file, as read_lsf in LSF.ipynb, through the reference file cache.
+
+    Returns:
+    numpy array : shape (n_pixels, n_kernels), the kernels as columns.
+    numpy array : pixel offset of each kernel row from the kernel center.
+    numpy array : wavelength of each kernel, from the column names.
+    """
+    lsf, pix, lsf_wvlns = get_lsf(filename)
+    kernels = np.column_stack([np.asarray(lsf[key], dtype=float) for key in lsf.colnames])
+    return kernels, pix, lsf_wvlns
+
+
+def dispersion_step(disptab, cenwave, detector="FUV"):
+    """
+    First order coefficient of the PSA dispersion relation; a proxy for the Angstroms per pixel.
+    As in LSF.ipynb, this is taken from FUVA for the FUV and from NUVB for the NUV.
+    """
+    segment = {"FUV": "FUVA", "NUV": "NUVB"}[detector]
+    coeffs = get_reference_table(disptab).select("COEFF", cenwave=cenwave, segment=segment, aperture="PSA")
+    if len(coeffs) == 0:
+        raise ValueError(f"No PSA dispersion relation for cenwave {cenwave} on {segment} in {disptab}")
+    return float(coeffs[0][1])
+
+
+def remap_lsf(lsf_file, cenwave, disptab, detector="FUV"):
+    """
+    Resamples the LSF kernels to a spacing of about twice their width, as redefine_lsf in LSF.ipynb: each new kernel is the original kernel of the closest wavelength.
+    FUV kernels are only resampled if they are more closely spaced than that; NUV kernels always are.
+
+    Returns:
+    numpy array : shape (n_pixels, n_kernels), remapped LSF kernels.
+    numpy array : the remapped kernels' wavelengths.
+    float : the dispersion step, in Angstroms per pixel.
+    """
+    step = dispersion_step(disptab, cenwave, detector)
+    kernels, pix, w = read_lsf(lsf_file)
+    deltaw = np.median(np.diff(w))
+    if detector == "NUV" or deltaw < len(pix) * step * 2:
+        new_deltaw = round(len(pix) * step * 2.0)
+        new_nw = int(round((max(w) - min(w)) / new_deltaw)) + 1
+        new_w = min(w) + np.arange(new_nw) * new_deltaw
+        closest = np.argmin(np.abs(new_w[:, None] - w[None, :]), axis=1)
+        return kernels[:, closest], new_w, step
+    return kernels, w.astype(float), step
+
+
+# %%
+def _file_stamp(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _cache_path(cache_dir, lsf_stamp, disptab_stamp, cenwave, detector):
+    key = json.dumps([CACHE_VERSION, lsf_stamp, disptab_stamp, float(cenwave), detector])
+    return os.path.join(cache_dir, f"lsf_{hashlib.sha256(key.encode()).hexdigest()[:24]}.npz")
+
+
+class LSFEngine:
+    """
+    The remapped LSF kernels of one COS setting, and the plans for applying them to spectra on given wavelength grids.
+    Made by get_lsf_engine, which caches them.
+    """
+
+    def __init__(self, kernels, kernel_wavelengths, step):
+        self.kernels = np.asarray(kernels, dtype=float)
+        self.kernel_wavelengths = np.asarray(kernel_wavelengths, dtype=float)
+        self.step = float(step)
+        self._plans = collections.OrderedDict()
+        self._kernel_ffts = {}
+
+    @classmethod
+    def from_files(cls, lsf_file, disptab, cenwave, detector="FUV"):
+        return cls(*remap_lsf(lsf_file, cenwave, disptab, detector=detector))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, kernels=self.kernels, kernel_wavelengths=self.kernel_wavelengths, step=self.step)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls(saved["kernels"], saved["kernel_wavelengths"], float(saved["step"]))
+
+    def wavelength_grid(self, wavelength):
+        """The COS wavelength scale, spaced by the dispersion step, that convolve resamples spectra onto; as in LSF.ipynb."""
+        nstep = round((np.max(wavelength) - np.min(wavelength)) / self.step) - 1
+        return np.min(wavelength) + np.arange(nstep) * self.step
+
+    def _jurisdictions(self, wave_cos):
+        """First and last+1 pixel of wave_cos to which each kernel applies."""
+        w = self.kernel_wavelengths
+        left = np.empty(len(w))
+        right = np.empty(len(w))
+        left[0], right[-1] = EDGE_JURISDICTION, EDGE_JURISDICTION
+        left[1:] = (w[1:] - w[:-1]) / 2.0
+        right[:-1] = (w[1:] - w[:-1]) / 2.0
+        starts = np.searchsorted(wave_cos, w - left, side="left")
+        stops = np.searchsorted(wave_cos, w + right, side="left")
+        return starts, stops
+
+    def _kernel_fft(self, n_fft):
+        if n_fft not in self._kernel_ffts:
+            normalized = self.kernels / self.kernels.sum(axis=0)
+            self._kernel_ffts[n_fft] = np.fft.rfft(normalized.T, n=n_fft, axis=1)
+        return self._kernel_ffts[n_fft]
+
+    def _plan(self, wavelength):
+        """Everything convolve needs that depends only on the input wavelengths, kept for the last PLAN_CACHE_SIZE grids."""
+        wavelength = np.asarray(wavelength, dtype=float)
+        key = hashlib.sha1(np.ascontiguousarray(wavelength).view(np.uint8)).hexdigest()
+        if key in self._plans:
+            self._plans.move_to_end(key)
+            return self._plans[key]
+
+        order = None if np.all(np.diff(wavelength) > 0) else np.argsort(wavelength, kind="stable")
+        sorted_wavelength = wavelength if order is None else wavelength[order]
+        wave_cos = self.wavelength_grid(sorted_wavelength)
+        # Linear interpolation onto wave_cos, as scipy's interp1d in LSF.ipynb
+        upper = np.clip(np.searchsorted(sorted_wavelength, wave_cos, side="right"), 1, len(sorted_wavelength) - 1)
+        lower = upper - 1
+        fraction = (wave_cos - sorted_wavelength[lower]) / (sorted_wavelength[upper] - sorted_wavelength[lower])
+
+        # As in LSF.ipynb, a kernel only applies where its jurisdiction is at least as long as the kernel.
+        starts, stops = self._jurisdictions(wave_cos)
+        n_pixels = self.kernels.shape[0]
+        used = np.nonzero(stops - starts >= n_pixels)[0]
+        half = n_pixels // 2
+        lengths = stops[used] - starts[used]
+        longest = int(lengths.max()) if len(used) else 0
+        # Each stretch with `half` pixels of its edge values on either side, gathered in one index array.
+        offsets = np.arange(longest + 2 * half) - half
+        gather = np.clip(starts[used, None] + offsets[None, :], starts[used, None], stops[used, None] - 1)
+        n_fft = 1 << (longest + 2 * half + n_pixels - 2).bit_length()
+        valid = np.arange(longest)[None, :] < lengths[:, None]
+        plan = {
+            "order": order,
+            "wave_cos": wave_cos,
+            "lower": lower,
+            "upper": upper,
+            "fraction": fraction,
+            "used": used,
+            "gather": gather,
+            "n_fft": n_fft,
+            "valid": valid,
+            "targets": (starts[used, None] + np.arange(longest)[None, :])[valid],
+        }
+        self._plans[key] = plan
+        if len(self._plans) > PLAN_CACHE_SIZE:
+            self._plans.popitem(last=False)
+        return plan
+
+    def convolve(self, wavelength, spec):
+        """
+        Convolves one or many spectra sharing the same wavelengths with the COS LSF.
+
+        Parameters:
+        wavelength (list or array): Wavelengths of the spectra to convolve.
+        spec (list or array): Fluxes or intensities of the spectrum to convolve, or an array of shape (n_spectra, len(wavelength)) of many spectra.
+
+        Returns:
+        wave_cos (numpy.ndarray): Wavelengths of convolved spectrum.!Different length from input wvln
+        final_spec (numpy.ndarray): The convolved spectrum, or array of spectra.!Different length from input spec
+        """
+        plan = self._plan(wavelength)
+        spec = np.asarray(spec, dtype=float)
+        if plan["order"] is not None:
+            spec = spec[..., plan["order"]]
+        fraction = plan["fraction"]
+        spec_cos = spec[..., plan["lower"]] * (1 - fraction) + spec[..., plan["upper"]] * fraction
+        final_spec = spec_cos.copy()
+        if len(plan["used"]) == 0:
+            return plan["wave_cos"], final_spec
+
+        n_fft = plan["n_fft"]
+        half = self.kernels.shape[0] // 2
+        stretches = np.fft.rfft(spec_cos[..., plan["gather"]], n=n_fft, axis=-1)
+        convolved = np.fft.irfft(stretches * self._kernel_fft(n_fft)[plan["used"]], n=n_fft, axis=-1)
+        # Keep the part of each full convolution centred on the stretch itself.
+        longest = plan["valid"].shape[1]
+        final_spec[..., plan["targets"]] = convolved[..., 2 * half : 2 * half + longest][..., plan["valid"]]
+        return plan["wave_cos"], final_spec
+
+
+# %%
+@functools.lru_cache(maxsize=LSF_CACHE_SIZE)
+def _cached_engine(lsf_stamp, disptab_stamp, cenwave, detector, cache_dir):
+    cache_path = None if cache_dir is None else _cache_path(cache_dir, lsf_stamp, disptab_stamp, cenwave, detector)
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            return LSFEngine.load(cache_path)
+        except (OSError, ValueError, KeyError):
+            pass  # An unreadable cache file is remade below.
+    engine = LSFEngine.from_files(lsf_stamp[0], disptab_stamp[0], cenwave, detector=detector)
+    if cache_path is not None:
+        try:
+            engine.save(cache_path)
+        except OSError as err:
+            print(f"Could not save the remapped LSF to {cache_path}: {err}")
+    return engine
+
+
+def get_lsf_engine(lsf_file, disptab, cenwave, detector="FUV", cache_dir=LSF_CACHE_DIR):
+    """
+    The LSFEngine of a COS setting, remapping its kernels only if neither the in-process nor the on-disk cache has them.
+    Editing or replacing either file invalidates both caches, as they are keyed on the files' modification times and sizes.
+
+    Parameters:
+    lsf_file (str): Path to your LSF file
+    disptab (str): Path to your DISPTAB file
+    cenwave (int): Cenwave for calculation of dispersion relationship
+    detector (str) : Assumes an FUV detector, but you may specify 'NUV'.
+    cache_dir (str or None) : Directory of the .npz cache, or None to not use one; Default is LSF_CACHE_DIR.
+
+    Returns:
+    LSFEngine : the engine, shared with other callers asking for the same setting.
+    """
+    return _cached_engine(_file_stamp(lsf_file), _file_stamp(disptab), cenwave, detector, cache_dir)
+
+
+def convolve_lsf(wavelength, spec, cenwave, lsf_file, disptab, detector="FUV"):
+    """
+    Convolves an input spectrum - i.e. template or STIS spectrum - with the COS LSF; a drop-in replacement for convolve_lsf in LSF.ipynb that reuses the setup of earlier calls.
+    spec may also be an array of shape (n_spectra, len(wavelength)), to convolve many spectra at once.
+
+    Returns:
+    wave_cos (numpy.ndarray): Wavelengths of convolved spectrum.!Different length from input wvln
+    final_spec (numpy.ndarray): The convolved spectrum.!Different length from input spec
+    """
+    return get_lsf_engine(lsf_file, disptab, cenwave, detector=detector).convolve(wavelength, spec)
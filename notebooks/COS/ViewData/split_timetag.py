@@ -0,0 +1,186 @@
+"""
+DESCRIPTION:
+    Splits a COS TIME-TAG (corrtag or rawtag) file into sub-exposures, one per time interval, like `costools.splittag` and the SUN_ALT filtering of `costools.timefilter` in the SplitTag and DayNight Notebooks.
+    The intervals are either given directly, in seconds from the exposure start, or found from the TIMELINE extension as the stretches of orbital night (or day) on either side of a SUN_ALT threshold.
+
+    Events are sorted by TIME, so a single np.searchsorted over the TIME column finds the first and last event of every interval.
+    The file is opened memory-mapped and each sub-exposure is written from a slice of the events, so splitting into many pieces costs about as much as reading the file once.
+    Each sub-exposure keeps the headers of the input, with its GTI and TIMELINE cut to the interval and EXPTIME, EXPSTART and EXPEND updated.
+
+    For example, to split the transit exposure of the SplitTag Notebook around the transit, or into its night-time stretches:
+        python split_timetag.py lc1va0zgq_corrtag_a.fits --split 0 550 850 1337 --outroot output/lc1va0zgq
+        python split_timetag.py lc1va0zgq_corrtag_a.fits --night --outroot output/lc1va0zgq
+"""
+# %%
+import argparse
+import os
+
+import numpy as np
+from astropy.io import fits
+
+SECONDS_PER_DAY = 86400.0
+
+
+# %%
+def intervals_from_splits(time_list):
+    """
+    Turns a list of split times, as given to costools.splittag, into (start, stop) intervals: [t0, t1, t2] -> [(t0, t1), (t1, t2)].
+    """
+    times = np.asarray(time_list, dtype=float)
+    return np.column_stack([times[:-1], times[1:]])
+
+
+def sun_alt_intervals(timeline, max_sun_alt=0.0, day=False):
+    """
+    Finds the stretches of an exposure during orbital night (SUN_ALT < max_sun_alt) or, if day, during orbital day (SUN_ALT >= max_sun_alt).
+
+    Parameters:
+    timeline (FITS_rec or Table) : TIMELINE extension of a corrtag, with TIME and SUN_ALT columns.
+    max_sun_alt (float) : altitude of the Sun above the Earth's limb, in degrees, dividing night from day; Default is 0.
+    day (bool) : find the day rather than the night; Default is False.
+
+    Returns:
+    numpy array : shape (n_intervals, 2), (start, stop) of each stretch, in seconds from the exposure start.
+    """
+    times = np.asarray(timeline["TIME"], dtype=float)
+    selected = np.asarray(timeline["SUN_ALT"]) < max_sun_alt
+    if day:
+        selected = ~selected
+    if len(times) == 0:
+        return np.empty((0, 2))
+    # Each TIMELINE row stands for the time up to the next row; the last for one more step.
+    step = np.median(np.diff(times)) if len(times) > 1 else 1.0
+    ends = np.append(times[1:], times[-1] + step)
+    edges = np.diff(np.concatenate([[0], selected.astype(np.int8), [0]]))
+    first_rows = np.nonzero(edges == 1)[0]
+    last_rows = np.nonzero(edges == -1)[0] - 1
+    return np.column_stack([times[first_rows], ends[last_rows]])
+
+
+def _clip_gti(gti_start, gti_stop, start, stop):
+    """Good time intervals cut to [start, stop)."""
+    starts = np.maximum(gti_start, start)
+    stops = np.minimum(gti_stop, stop)
+    keep = stops > starts
+    return starts[keep], stops[keep]
+
+
+def _output_path(path, outroot, number):
+    """As costools.splittag names its outputs: <outroot>_<number>_<suffix of the input>, e.g. root_1_corrtag_a.fits."""
+    name = os.path.basename(path)
+    suffix = name.split("_", 1)[1] if "_" in name else name
+    return f"{outroot}_{number}_{suffix}"
+
+
+# %%
+def split_timetag(path, intervals, outroot, overwrite=False, verbose=True):
+    """
+    Writes one sub-exposure of a TIME-TAG file per time interval in a single pass over the memory-mapped events.
+
+    Parameters:
+    path (str) : corrtag or rawtag file path.
+    intervals (array-like) : (start, stop) pairs, in seconds from the exposure start; an event is in an interval if start <= TIME < stop.
+    outroot (str) : path and root name of the outputs, which are named <outroot>_<n>_<suffix of path>, with n counting the intervals from 1.
+    overwrite (bool) : replace existing outputs; Default is False.
+    verbose (bool) : whether to print what is written; Default is True.
+
+    Returns:
+    list of str : the path written for each interval; None for intervals with no good time, for which nothing is written.
+    """
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+    outputs = []
+    with fits.open(path, memmap=True) as hdul:
+        events = hdul["EVENTS"].data
+        times = events["TIME"]
+        if np.any(times[1:] < times[:-1]):
+            raise ValueError(f"The events of {path} are not sorted by TIME")
+        # Row bounds of every interval, from one search of the TIME column.
+        bounds = np.searchsorted(times, intervals, side="left")
+
+        gti = hdul["GTI"].data
+        gti_start, gti_stop = np.asarray(gti["START"], dtype=float), np.asarray(gti["STOP"], dtype=float)
+        timeline = hdul["TIMELINE"].data if "TIMELINE" in hdul else None
+        expstart = hdul["EVENTS"].header.get("EXPSTART", hdul[0].header.get("EXPSTART"))
+
+        for number, ((start, stop), (first, last)) in enumerate(zip(intervals, bounds), start=1):
+            starts, stops = _clip_gti(gti_start, gti_stop, start, stop)
+            if len(starts) == 0:
+                outputs.append(None)
+                if verbose:
+                    print(f"Interval {number}, {start} - {stop} s, holds no good time; skipping it.")
+                continue
+
+            sub_hdul = fits.HDUList([fits.PrimaryHDU(header=hdul[0].header)])
+            for hdu in hdul[1:]:
+                if hdu.name == "EVENTS":
+                    data = events[first:last]
+                elif hdu.name == "GTI":
+                    data = fits.BinTableHDU.from_columns(
+                        [
+                            fits.Column(name="START", format="D", unit="s", array=starts),
+                            fits.Column(name="STOP", format="D", unit="s", array=stops),
+                        ]
+                    ).data
+                elif hdu.name == "TIMELINE" and timeline is not None:
+                    data = timeline[(timeline["TIME"] >= start) & (timeline["TIME"] < stop)]
+                else:
+                    data = hdu.data
+                sub_hdul.append(type(hdu)(data=data, header=hdu.header, name=hdu.name))
+
+            header = sub_hdul["EVENTS"].header
+            header["EXPTIME"] = float(np.sum(stops - starts))
+            if expstart is not None:
+                header["EXPSTART"] = expstart + starts[0] / SECONDS_PER_DAY
+                header["EXPEND"] = expstart + stops[-1] / SECONDS_PER_DAY
+
+            output = _output_path(path, outroot, number)
+            sub_hdul.writeto(output, overwrite=overwrite)
+            outputs.append(output)
+            if verbose:
+                print(f"Wrote {last - first} events from {start} - {stop} s to {output}")
+    return outputs
+
+
+def split_by_sun_alt(path, outroot, max_sun_alt=0.0, day=False, overwrite=False, verbose=True):
+    """
+    Splits a corrtag into its stretches of orbital night (or day) as found by sun_alt_intervals from its TIMELINE extension; see split_timetag.
+
+    Returns:
+    list of str : the paths written, as in split_timetag.
+    """
+    with fits.open(path, memmap=True) as hdul:
+        if "TIMELINE" not in hdul:
+            raise ValueError(f"{path} has no TIMELINE extension, which is needed to split by SUN_ALT")
+        intervals = sun_alt_intervals(hdul["TIMELINE"].data, max_sun_alt=max_sun_alt, day=day)
+    return split_timetag(path, intervals, outroot, overwrite=overwrite, verbose=verbose)
+
+
+# %%
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Split a COS TIME-TAG file into sub-exposures by time")
+    parser.add_argument("path", help="corrtag or rawtag file")
+    parser.add_argument("--outroot", required=True, help="path and root name of the sub-exposure files")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--split", nargs="+", type=float, metavar="TIME",
+                      help="split times in seconds from the exposure start, as for costools.splittag")
+    mode.add_argument("--interval", nargs=2, type=float, action="append", metavar=("START", "STOP"),
+                      help="time interval in seconds from the exposure start; may be repeated")
+    mode.add_argument("--night", action="store_true", help="split into the stretches with SUN_ALT below --max-sun-alt")
+    mode.add_argument("--day", action="store_true", help="split into the stretches with SUN_ALT at or above --max-sun-alt")
+    parser.add_argument("--max-sun-alt", type=float, default=0.0, help="SUN_ALT dividing night from day (default: 0)")
+    parser.add_argument("--overwrite", action="store_true", help="replace existing outputs")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    if options.night or options.day:
+        split_by_sun_alt(options.path, options.outroot, options.max_sun_alt, day=options.day, overwrite=options.overwrite)
+    else:
+        intervals = intervals_from_splits(options.split) if options.split else options.interval
+        split_timetag(options.path, intervals, options.outroot, overwrite=options.overwrite)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
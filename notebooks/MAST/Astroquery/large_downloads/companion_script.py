@@ -8,10 +8,104 @@ download the files.
 # Search results are returned as an astropy table, so we also import some
 # useful table methods.
 from astroquery.mast import Observations
-from astropy.table import unique, vstack
+from astropy.table import Table, vstack
 import argparse
+import concurrent.futures
+import time
 
-def fetch_files(progID, chunk_size):
+# Product lists are requested for a few chunks of observations at once. The
+# chunk size grows while requests come back within TARGET_SECONDS, and
+# shrinks when they take longer, between 1 and MAX_CHUNK_SIZE observations.
+MAX_WORKERS = 4
+TARGET_SECONDS = 10.0
+MAX_CHUNK_SIZE = 50
+# A chunk whose request fails is tried again, in smaller chunks, this many times
+RETRIES = 3
+
+
+class UniqueProducts:
+    '''
+    Collects product tables as they arrive, keeping one row per
+    productFilename: the first row from the chunk that starts at the lowest
+    observation, whichever order the chunks arrive in.
+    '''
+
+    def __init__(self):
+        self.chosen = {}  # productFilename -> (first row of chunk, table, row)
+        self.tables = []
+        self.template = None
+
+    def add(self, products, first_row):
+        if self.template is None:
+            self.template = products[:0]
+        number = len(self.tables)
+        for i, filename in enumerate(products['productFilename']):
+            if filename not in self.chosen or first_row < self.chosen[filename][0]:
+                self.chosen[filename] = (first_row, number, i)
+        self.tables.append(products)
+
+    def table(self):
+        rows = {}
+        for _, number, i in self.chosen.values():
+            rows.setdefault(number, []).append(i)
+        pieces = [self.tables[number][sorted(keep)] for number, keep in sorted(rows.items())]
+        if not pieces:
+            # No products at all: an empty table, with the columns if known
+            return self.template if self.template is not None else Table()
+        files = vstack(pieces)
+        files.sort('productFilename')
+        return files
+
+
+def resolve_products(matched_obs, chunk_size=5, max_workers=MAX_WORKERS,
+                     target_seconds=TARGET_SECONDS, service=None):
+    '''
+    Requests the product lists of the observations in chunks, on up to
+    max_workers threads, and returns the unique products by productFilename.
+    The service is the astroquery Observations class unless a stand-in for it
+    is given.
+    '''
+    service = service or Observations
+    products = UniqueProducts()
+    pending = []  # (first row, last row, attempt) of chunks to request again
+    next_row = 0
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while next_row < len(matched_obs) or pending or running:
+            # Keep the pool busy, carving new chunks at the current size.
+            while len(running) < max_workers and (pending or next_row < len(matched_obs)):
+                if pending:
+                    first, last, attempt = pending.pop()
+                else:
+                    first, last, attempt = next_row, min(next_row + chunk_size, len(matched_obs)), 0
+                    next_row = last
+                future = executor.submit(service.get_product_list, matched_obs[first:last])
+                running[future] = (first, last, attempt, time.monotonic())
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                first, last, attempt, started = running.pop(future)
+                seconds = time.monotonic() - started
+                try:
+                    products.add(future.result(), first)
+                except Exception as err:
+                    if attempt >= RETRIES:
+                        raise
+                    print(f'Product list request for observations {first}-{last - 1} failed '
+                          f'({err}); trying again in smaller chunks.')
+                    middle = (first + last + 1) // 2
+                    pending.extend((a, b, attempt + 1) for a, b in ((first, middle), (middle, last)) if b > a)
+                    chunk_size = max(1, chunk_size // 2)
+                    continue
+                # Adapt the chunk size to how long the request took.
+                if seconds < target_seconds / 2:
+                    chunk_size = min(MAX_CHUNK_SIZE, chunk_size * 2)
+                elif seconds > target_seconds:
+                    chunk_size = max(1, chunk_size // 2)
+    return products.table()
+
+
+def fetch_files(progID, chunk_size, max_workers=MAX_WORKERS):
     # Observation search criteria. You can customize the search using the fields
     # listed and described at https://mast.stsci.edu/api/v0/_c_a_o_mfields.html
     matched_obs = Observations.query_criteria(
@@ -27,12 +121,16 @@ def fetch_files(progID, chunk_size):
         'query criteria and try again.')
         quit()
 
-    # Go through the observations in "chunks", five at a time, and request the
-    # associated data products. This is faster than doing one at a time.
-    # After getting products, keep only the unique set to remove any duplicate files.
-    chunks = [matched_obs[i:i+sz_chunk] for i in range(0,len(matched_obs), chunk_size)]
-    t = [Observations.get_product_list(obs) for obs in chunks]
-    files = unique(vstack(t), keys='productFilename')
+    # Go through the observations in "chunks", starting at chunk_size at a time,
+    # and request the associated data products, several chunks at once. This is
+    # faster than doing one at a time. Duplicate files are dropped as the
+    # product lists arrive.
+    files = resolve_products(matched_obs, chunk_size, max_workers)
+
+    # Make sure the observations have products. If not, exit the program.
+    if len(files) == 0:
+        print('The matching observations have no data products to download.')
+        quit()
 
     # If the observations are not public, you will need a valid Auth.MAST
     # token for retrieval (see: https://auth.mast.stsci.edu/info). Specify
@@ -53,7 +151,7 @@ def fetch_files(progID, chunk_size):
 
 if __name__ == '__main__':
     '''
-    Input the JWST program ID and "chunk" size (default is five; this is fastest.)
+    Input the JWST program ID and starting "chunk" size (default is five.)
     Script will return a separate bash file that uses curl to download your data.
     '''
     descr_text = 'Fetch a script for downloading data products from a JWST Program'
@@ -61,6 +159,8 @@ if __name__ == '__main__':
     parser.add_argument('-id', '--progID', type=str, default='1073',
                         help='JWST Program ID')
     parser.add_argument('-c', '--chunk_size', type=int, default=5,
-                        help='Number of Obs to process at a time')
+                        help='Number of Obs to process at a time, to begin with')
+    parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS,
+                        help='Number of product list requests to make at once')
     args = parser.parse_args()
-    fetch_files(args.progID, args.chunk_size)
+    fetch_files(args.progID, args.chunk_size, args.workers)
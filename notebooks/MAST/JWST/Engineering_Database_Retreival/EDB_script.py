@@ -5,33 +5,189 @@ includes an example file if no data is specified.
 """
 
 import argparse
+import concurrent.futures
 import csv
+import http.client
+import os
+import random
+import sqlite3
 import sys
-import urllib.error
-import urllib.request
-from datetime import datetime
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import numpy as np
+
 # default file to use if no file specified
 DEFAULT_FILE = "SA_ZADUCMDX-20220601T000000-20220601T060000.csv"
 
+# Server to download from; a local stand-in server can be used for testing
+BASE_URL = "https://mast.stsci.edu"
+# Concurrent downloads; each keeps its own connection to the server open between files
+DEFAULT_JOBS = 8
+# Attempts per file, and the first wait between them in seconds, doubled after each failure
+RETRIES = 5
+BACKOFF = 1.0
+TIMEOUT = 300
+CHUNK_SIZE = 1 << 16
+MAX_REDIRECTS = 5
+# Statuses worth retrying; any other error status fails the file at once
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The cache holds each mnemonic in chunks of this length, aligned to CHUNK_EPOCH
+CACHE_CHUNK = timedelta(days=1)
+CHUNK_EPOCH = datetime(2000, 1, 1)
+# Data more recent than this may still be arriving in the EDB, so is fetched again by the next request
+RECENT_DATA_DELAY = timedelta(minutes=15)
+CACHE_INDEX = "edb_cache.sqlite"
+MJD_EPOCH = datetime(1858, 11, 17)
+# Samples this close (in days; half a millisecond) to a time are taken to be at that time
+MJD_TOLERANCE = 0.5e-3 / 86400
+
+
+class DownloadError(Exception):
+    """A file could not be downloaded; retryable is False when trying again cannot help (i.e. 404)."""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class Downloader:
+    """
+    Downloads files over HTTP(S), reusing one keep-alive connection per server in each thread.
+
+    A file is written to <name>.part and only renamed to <name> once complete, so a name that exists is a
+    whole file. A retry resumes from the end of the .part file with an HTTP Range request. A file from an
+    earlier run is fetched again, since the archive may have more data for it now, unless resuming, when a
+    name that exists is kept and a .part file left by an interrupted run is continued.
+    """
+
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault("connections", {})
+        if (scheme, netloc) not in connections:
+            connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            connections[(scheme, netloc)] = connection_class(netloc, timeout=self.timeout)
+        return connections[(scheme, netloc)]
+
+    def _drop_connection(self, scheme, netloc):
+        connection = self._local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _request(self, url, headers):
+        """GET url, following redirects; returns the response, whose body must be read before the next request, and its url."""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            target = parts.path + (f"?{parts.query}" if parts.query else "")
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request("GET", target, headers=headers)
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException):
+                # A kept-alive connection the server has since closed; the retry opens a new one.
+                self._drop_connection(parts.scheme, parts.netloc)
+                raise
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                response.read()
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            return response, url
+        raise DownloadError(f"Too many redirects for {url}", retryable=False)
+
+    def _fetch(self, url, dest):
+        part = Path(f"{dest}.part")
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        response, response_url = self._request(url, headers)
+        try:
+            if response.status == 416 and offset:
+                # The .part file already holds the whole file.
+                response.read()
+            elif response.status in (200, 206):
+                # A server that ignores the Range header sends the whole file again.
+                mode = "ab" if response.status == 206 else "wb"
+                with open(part, mode) as stream:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        stream.write(chunk)
+                expected = response.getheader("Content-Length")
+                if expected is not None and part.stat().st_size - (offset if mode == "ab" else 0) < int(expected):
+                    raise DownloadError(f"Connection closed early downloading {url}")
+            else:
+                response.read()
+                retry_after = response.getheader("Retry-After")
+                raise DownloadError(
+                    f"HTTP {response.status} {response.reason} for {url}",
+                    retryable=response.status in RETRY_STATUSES,
+                    retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+                )
+        finally:
+            # A body left partly read, i.e. after an error, makes the connection unusable for the next request.
+            if not response.isclosed() or response.getheader("Connection", "").lower() == "close":
+                parts = urllib.parse.urlsplit(response_url)
+                self._drop_connection(parts.scheme, parts.netloc)
+        os.replace(part, dest)
+
+    def download(self, url, dest, resume=False):
+        """Downloads url to dest, retrying with exponential backoff; with resume, a dest that exists is kept."""
+        if resume and Path(dest).exists():
+            return
+        if not resume:
+            Path(f"{dest}.part").unlink(missing_ok=True)
+        for attempt in range(self.retries):
+            try:
+                self._fetch(url, dest)
+                return
+            except DownloadError as err:
+                if not err.retryable or attempt == self.retries - 1:
+                    raise
+                wait = err.retry_after
+            except (OSError, http.client.HTTPException) as err:
+                if attempt == self.retries - 1:
+                    raise DownloadError(f"{type(err).__name__}: {err} downloading {url}") from err
+                wait = None
+            if wait is None:
+                wait = self.backoff * 2 ** attempt * (1 + random.random())
+            time.sleep(wait)
+
+
+def edb_file_url(fname, prefix="", base_url=BASE_URL):
+    return f"{base_url}{prefix}/api/v0.1/Download/file?uri=mast:jwstedb/{fname}"
 
-def download_edb_datafiles(filenames, folder, prefix=""):
-    """Download filenames to directory"""
+
+def download_edb_datafiles(filenames, folder, prefix="", jobs=DEFAULT_JOBS, base_url=BASE_URL, resume=False):
+    """Download filenames to directory, `jobs` at a time; with resume, files already there are kept"""
     Path(folder).mkdir(exist_ok=True)
 
+    downloader = Downloader()
     status = 0
-    for fname in filenames:
-        print(
-            f"Downloading File: mast:jwstedb/{fname}\n",
-            f" To: {folder}/{fname}",
-        )
-        url = f"https://mast.stsci.edu{prefix}/api/v0.1/Download/file?uri=mast:jwstedb/{fname}"
-        try:
-            urllib.request.urlretrieve(url, filename=f"{folder}/{fname}")
-        except urllib.error.HTTPError:
-            print("  ***Error downloading file***")
-            status = 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for fname in filenames:
+            print(
+                f"Downloading File: mast:jwstedb/{fname}\n",
+                f" To: {folder}/{fname}",
+            )
+            url = edb_file_url(fname, prefix, base_url)
+            futures[executor.submit(downloader.download, url, f"{folder}/{fname}", resume)] = fname
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except DownloadError as err:
+                print(f"  ***Error downloading file {futures[future]}: {err}***")
+                status = 1
 
     return status
 
@@ -66,6 +222,278 @@ def parse_edb_query(csvfile):
     return filenames
 
 
+def parse_edb_filename(fname):
+    """Given an edb filename, return the dictionary of mnemonic, starttime, and endtime it was made from"""
+    mnemonic, starttime, endtime = Path(fname).name[: -len(".csv")].rsplit("-", 2)
+    return {
+        "mnemonic": mnemonic,
+        "starttime": datetime.strptime(starttime, "%Y%m%dT%H%M%S"),
+        "endtime": datetime.strptime(endtime, "%Y%m%dT%H%M%S"),
+    }
+
+
+def datetime_to_mjd(dt):
+    return (dt - MJD_EPOCH) / timedelta(days=1)
+
+
+def plan_chunks(starttime, endtime, chunk=CACHE_CHUNK):
+    """The aligned (chunk start, chunk end) time chunks covering starttime to endtime"""
+    start = CHUNK_EPOCH + (starttime - CHUNK_EPOCH) // chunk * chunk
+    chunks = [(start, start + chunk)]
+    while chunks[-1][1] < endtime:
+        chunks.append((chunks[-1][1], chunks[-1][1] + chunk))
+    return chunks
+
+
+def _read_rows(path):
+    """The header and rows of an edb csv file, with the index of its MJD column"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as csvfh:
+        reader = csv.reader(csvfh)
+        header = next(reader, None)
+        rows = list(reader)
+    return header, (header.index("MJD") if header else None), rows
+
+
+class EDBCache:
+    """
+    A local cache of edb data, held per mnemonic in time chunks (a day by default) indexed in SQLite.
+
+    Each chunk file holds the data from the start of its chunk up to the `covered_end` recorded in the
+    index, so bringing a chunk up to date only ever fetches the time after `covered_end`, and re-querying
+    a sliding window only fetches the time the window has moved on by. Rows after `covered_end`, which
+    are too recent to be complete (see RECENT_DATA_DELAY), are replaced when the chunk is next extended.
+    """
+
+    def __init__(self, cache_dir, chunk=CACHE_CHUNK):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.chunk = chunk
+        self.connection = sqlite3.connect(str(self.cache_dir / CACHE_INDEX))
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (mnemonic TEXT, chunk_start TEXT, covered_end TEXT, "
+                "last_mjd REAL, path TEXT, PRIMARY KEY (mnemonic, chunk_start))"
+            )
+            self.connection.execute(
+                "INSERT OR IGNORE INTO settings VALUES ('chunk_seconds', ?)", (str(chunk.total_seconds()),)
+            )
+        (stored,) = self.connection.execute("SELECT value FROM settings WHERE name = 'chunk_seconds'").fetchone()
+        if float(stored) != chunk.total_seconds():
+            raise ValueError(f"The cache in {cache_dir} holds chunks of {float(stored)} s, not {chunk.total_seconds()} s")
+
+    def close(self):
+        self.connection.close()
+
+    def _chunk(self, mnemonic, chunk_start):
+        """The covered end, last MJD and path of a cached chunk, or None if it is not cached"""
+        row = self.connection.execute(
+            "SELECT covered_end, last_mjd, path FROM chunks WHERE mnemonic = ? AND chunk_start = ?",
+            (mnemonic, _convert_datetime_to_compact_iso(chunk_start)),
+        ).fetchone()
+        if row is None:
+            return None
+        return datetime.strptime(row[0], "%Y%m%dT%H%M%S"), row[1], row[2]
+
+    def plan(self, requests):
+        """
+        The pieces of data missing from the cache for the requests: a list of dictionaries with mnemonic,
+        starttime and endtime, plus the chunk_start of the chunk each extends. Overlapping requests share pieces.
+        """
+        needed = {}
+        for req in requests:
+            for chunk_start, chunk_end in plan_chunks(req["starttime"], req["endtime"], self.chunk):
+                key = (req["mnemonic"], chunk_start)
+                needed[key] = max(needed.get(key, chunk_start), min(chunk_end, req["endtime"]))
+
+        pieces = []
+        for (mnemonic, chunk_start), endtime in sorted(needed.items()):
+            cached = self._chunk(mnemonic, chunk_start)
+            starttime = cached[0] if cached else chunk_start
+            if starttime < endtime:
+                pieces.append(
+                    {"mnemonic": mnemonic, "starttime": starttime, "endtime": endtime, "chunk_start": chunk_start}
+                )
+        return pieces
+
+    def add(self, piece, path, now=None):
+        """Adds the data of a downloaded piece, as planned by plan, to its chunk"""
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        mnemonic, chunk_start = piece["mnemonic"], piece["chunk_start"]
+        piece_start = datetime_to_mjd(piece["starttime"]) - MJD_TOLERANCE
+        chunk_end = datetime_to_mjd(chunk_start + self.chunk) - MJD_TOLERANCE
+        header, mjd_column, rows = _read_rows(path)
+        rows = [row for row in rows if piece_start <= float(row[mjd_column]) < chunk_end] if header else []
+
+        cached = self._chunk(mnemonic, chunk_start)
+        if cached is None:
+            chunk_path = self.cache_dir / mnemonic / f"{mnemonic}-{_convert_datetime_to_compact_iso(chunk_start)}.csv"
+            chunk_path.parent.mkdir(exist_ok=True)
+            last_mjd = None
+            mode = "w"
+        else:
+            chunk_path, last_mjd = Path(cached[2]), cached[1]
+            mode = "a"
+            if last_mjd is None or last_mjd >= piece_start:
+                # Replace the rows that were too recent to be complete when fetched.
+                _, kept_mjd_column, kept = _read_rows(chunk_path)
+                rows = [row for row in kept if float(row[kept_mjd_column]) < piece_start] + rows
+                mode = "w"
+        with open(chunk_path, mode, encoding="utf-8", newline="") as csvfh:
+            writer = csv.writer(csvfh)
+            if mode == "w" and header:
+                writer.writerow(header)
+            writer.writerows(rows)
+        if rows:
+            last_mjd = float(rows[-1][mjd_column])
+
+        covered_end = max(piece["starttime"], min(piece["endtime"], now - RECENT_DATA_DELAY))
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+                (
+                    mnemonic,
+                    _convert_datetime_to_compact_iso(chunk_start),
+                    _convert_datetime_to_compact_iso(covered_end.replace(microsecond=0)),
+                    last_mjd,
+                    str(chunk_path),
+                ),
+            )
+
+    def serve(self, req, folder):
+        """Writes the data of a request, from its cached chunks, to the file it would have been downloaded to"""
+        start = datetime_to_mjd(req["starttime"]) - MJD_TOLERANCE
+        end = datetime_to_mjd(req["endtime"]) + MJD_TOLERANCE
+        out_path = Path(folder) / parse_mnemonic_starttime_endtime(req)
+        header = None
+        with open(out_path, "w", encoding="utf-8", newline="") as csvfh:
+            writer = csv.writer(csvfh)
+            for chunk_start, _ in plan_chunks(req["starttime"], req["endtime"], self.chunk):
+                cached = self._chunk(req["mnemonic"], chunk_start)
+                if cached is None:
+                    continue
+                chunk_header, mjd_column, rows = _read_rows(cached[2])
+                if chunk_header is None:
+                    continue
+                if header is None:
+                    header = chunk_header
+                    writer.writerow(header)
+                writer.writerows(row for row in rows if start <= float(row[mjd_column]) <= end)
+        return out_path
+
+
+def download_edb_datafiles_cached(
+    requests, folder, cache_dir, prefix="", jobs=DEFAULT_JOBS, base_url=BASE_URL, resume=False
+):
+    """Download requests of mnemonic/starttime/endtime to directory, fetching only the data missing from the cache"""
+    Path(folder).mkdir(exist_ok=True)
+    cache = EDBCache(cache_dir)
+    try:
+        pieces = cache.plan(requests)
+        incoming = Path(cache_dir) / "incoming"
+        filenames = {parse_mnemonic_starttime_endtime(piece): piece for piece in pieces}
+        print(f"{len(filenames)} pieces of data are missing from the cache in {cache_dir}")
+        status = download_edb_datafiles(filenames, incoming, prefix, jobs=jobs, base_url=base_url, resume=resume)
+        for fname, piece in filenames.items():
+            path = incoming / fname
+            if path.exists():
+                cache.add(piece, path)
+                path.unlink()
+
+        for req in requests:
+            print(f"Writing {req['mnemonic']} from {req['starttime']} to {req['endtime']} to {cache.serve(req, folder)}")
+    finally:
+        cache.close()
+    return status
+
+
+class EDBStore:
+    """
+    Edb data stored as numpy arrays of MJD and euvalue, partitioned by mnemonic and day (see CACHE_CHUNK).
+
+    Each partition is a pair of .npy files, <mnemonic>/<chunk start>.mjd.npy and .euvalue.npy, sorted by
+    MJD. Loading a time range memory-maps only the partitions it overlaps, so does not parse any text.
+    """
+
+    def __init__(self, store_dir, chunk=CACHE_CHUNK):
+        self.store_dir = Path(store_dir)
+        self.chunk = chunk
+
+    def _partition(self, mnemonic, chunk_start):
+        stem = self.store_dir / mnemonic / _convert_datetime_to_compact_iso(chunk_start)
+        return Path(f"{stem}.mjd.npy"), Path(f"{stem}.euvalue.npy")
+
+    def _read_partition(self, mnemonic, chunk_start):
+        mjd_path, value_path = self._partition(mnemonic, chunk_start)
+        if not mjd_path.exists():
+            return None
+        return np.load(mjd_path, mmap_mode="r"), np.load(value_path, mmap_mode="r")
+
+    def ingest(self, path, mnemonic=None):
+        """
+        Adds the data of an edb csv file to the store, replacing any stored samples at the same MJDs.
+        The mnemonic is taken from the file name if not given.
+        """
+        mnemonic = mnemonic or parse_edb_filename(path)["mnemonic"]
+        header, mjd_column, rows = _read_rows(path)
+        if not rows:
+            return 0
+        value_column = header.index("euvalue")
+        mjd = np.fromiter((float(row[mjd_column]) for row in rows), dtype=float, count=len(rows))
+        try:
+            values = np.fromiter((float(row[value_column]) for row in rows), dtype=float, count=len(rows))
+        except ValueError:
+            values = np.array([row[value_column] for row in rows])  # A mnemonic of text states
+
+        chunk_days = self.chunk / timedelta(days=1)
+        first_mjd = datetime_to_mjd(CHUNK_EPOCH)
+        partition_of = np.floor((mjd - first_mjd) / chunk_days).astype(np.int64)
+        for partition in np.unique(partition_of):
+            chunk_start = CHUNK_EPOCH + int(partition) * self.chunk
+            selected = partition_of == partition
+            new_mjd, new_values = mjd[selected], values[selected]
+            stored = self._read_partition(mnemonic, chunk_start)
+            if stored is not None:
+                # New samples come first, so they are the ones np.unique keeps at repeated MJDs.
+                new_mjd = np.concatenate([new_mjd, stored[0]])
+                new_values = np.concatenate([new_values, stored[1]])
+            new_mjd, first = np.unique(new_mjd, return_index=True)
+            new_values = new_values[first]
+
+            mjd_path, value_path = self._partition(mnemonic, chunk_start)
+            mjd_path.parent.mkdir(parents=True, exist_ok=True)
+            for array, array_path in ((new_mjd, mjd_path), (new_values, value_path)):
+                with open(f"{array_path}.tmp", "wb") as fh:
+                    np.save(fh, array)
+                os.replace(f"{array_path}.tmp", array_path)
+        return len(mjd)
+
+    def load(self, mnemonic, start, end):
+        """
+        The samples of a mnemonic from start to end (datetimes or MJDs), inclusive.
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): MJD and euvalue of the samples, sorted by MJD
+        """
+        start_time = start if isinstance(start, datetime) else MJD_EPOCH + timedelta(days=start)
+        end_time = end if isinstance(end, datetime) else MJD_EPOCH + timedelta(days=end)
+        start_mjd = datetime_to_mjd(start) if isinstance(start, datetime) else start
+        end_mjd = datetime_to_mjd(end) if isinstance(end, datetime) else end
+
+        mjds, values = [], []
+        for chunk_start, _ in plan_chunks(start_time, end_time, self.chunk):
+            stored = self._read_partition(mnemonic, chunk_start)
+            if stored is None:
+                continue
+            low = np.searchsorted(stored[0], start_mjd, side="left")
+            high = np.searchsorted(stored[0], end_mjd, side="right")
+            mjds.append(stored[0][low:high])
+            values.append(stored[1][low:high])
+        if not mjds:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(mjds), np.concatenate(values)
+
+
 def download_edb_datafiles_by_mnemonic_starttime_endtime(requests, folder):
     """Download datafiles by mnemonic/starttime/endtime to directory
 
@@ -103,6 +531,23 @@ def parse_args(args):
     parser.add_argument(
         "-p", "--prefix", type=str, default="", help="Prefix path to use (example: '/jwst')"
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=DEFAULT_JOBS, help="Number of files to download at once"
+    )
+    parser.add_argument(
+        "--base-url", type=str, default=BASE_URL, help=f"Server to download from (default: {BASE_URL})"
+    )
+    parser.add_argument(
+        "-s", "--store", type=str, default=None, help="Folder of the numpy store to add the downloaded data to"
+    )
+    parser.add_argument(
+        "-c", "--cache", type=str, default=None, help="Cache folder; only data missing from it is downloaded"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep files already downloaded and continue interrupted downloads, rather than fetching them again",
+    )
     parser.add_argument(
         "-q",
         "--query",
@@ -118,6 +563,11 @@ def parse_args(args):
 
     folder = args.folder
     prefix = args.prefix
+    jobs = args.jobs
+    base_url = args.base_url.rstrip("/")
+    cache = args.cache
+    store = args.store
+    resume = args.resume
 
     csvfile = args.query
     if csvfile:
@@ -130,13 +580,25 @@ def parse_args(args):
         print(f"No files specified, using default file: {DEFAULT_FILE}")
         filenames = {DEFAULT_FILE}
 
-    return filenames, folder, prefix
+    return filenames, folder, prefix, jobs, base_url, cache, store, resume
 
 
 def main(args=None):
     """Collect args from user input, give them to the download function"""
-    filenames, folder, prefix = parse_args(args)
-    return download_edb_datafiles(filenames, folder, prefix)
+    filenames, folder, prefix, jobs, base_url, cache, store, resume = parse_args(args)
+    if cache:
+        requests = [parse_edb_filename(fname) for fname in sorted(filenames)]
+        status = download_edb_datafiles_cached(
+            requests, folder, cache, prefix, jobs=jobs, base_url=base_url, resume=resume
+        )
+    else:
+        status = download_edb_datafiles(filenames, folder, prefix, jobs=jobs, base_url=base_url, resume=resume)
+    if store:
+        edb_store = EDBStore(store)
+        for fname in sorted(filenames):
+            if Path(folder, fname).exists():
+                print(f"Added {edb_store.ingest(Path(folder, fname))} samples of {fname} to {store}")
+    return status
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+"""
+Vectorized version of `find_breaks` from EDB_Retrieval.ipynb, which splits a pair of x/y edb
+timeseries into the stretches where they change, breaking them up at runs of unchanging values.
+
+Rather than scanning the samples in a Python loop, the runs of unchanged samples are found with
+run-length encoding of the changes between samples, and the segments are returned as start and stop
+indices into the aligned arrays, so each segment is a slice (a view) rather than a copied DataFrame.
+
+Run as a script to benchmark it against the loop:
+
+    python edb_breaks.py 1e6 1e7 1e8
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def align_xy(x_mjd, y_mjd):
+    """
+    Match the samples of two timeseries at the same MJDs, as an inner merge on MJD.
+
+    Parameters
+    ----------
+    x_mjd, y_mjd : numpy.ndarray
+        Sorted MJDs of the x and y samples.
+
+    Returns
+    -------
+    x_index, y_index : numpy.ndarray or slice
+        Indices of the x and y samples at the MJDs in both; slice(None) for all of them when
+        the MJDs are the same, so that indexing with them gives views.
+    """
+    if len(x_mjd) == len(y_mjd) and np.array_equal(x_mjd, y_mjd):
+        return slice(None), slice(None)
+    if len(y_mjd) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    y_index = np.minimum(np.searchsorted(y_mjd, x_mjd), len(y_mjd) - 1)
+    matched = y_mjd[y_index] == x_mjd
+    return np.nonzero(matched)[0], y_index[matched]
+
+
+def segment_bounds(x_vals, y_vals, max_flats=5):
+    """
+    Find the segments of aligned x/y values that are not broken up by runs of unchanging values.
+
+    Parameters
+    ----------
+    x_vals, y_vals : numpy.ndarray
+        X and Y values at the same times.
+    max_flats : int, default=5
+        Runs of this many or more steps where neither value changes break up the timeseries.
+
+    Returns
+    -------
+    starts, stops : numpy.ndarray
+        Start and stop index of each segment of more than one sample; segment i is
+        x_vals[starts[i]:stops[i]]. As in `find_breaks`, a segment ends before the first sample of
+        a flat run and the next one starts at the first sample that differs from it.
+    """
+    n_samples = len(x_vals)
+    if n_samples < 2:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    # flat[k] is True when neither value changes from sample k to k + 1.
+    flat = x_vals[1:] == x_vals[:-1]
+    flat &= y_vals[1:] == y_vals[:-1]
+
+    edges = np.diff(np.concatenate(([0], flat.view(np.int8), [0])))
+    run_starts = np.nonzero(edges == 1)[0]
+    run_stops = np.nonzero(edges == -1)[0]
+    long_runs = run_stops - run_starts >= max_flats
+    run_starts, run_stops = run_starts[long_runs], run_stops[long_runs]
+
+    starts = np.concatenate(([0], run_stops + 1))
+    stops = np.concatenate((run_starts, [n_samples]))
+    if len(run_stops) and run_stops[-1] + 1 >= n_samples:
+        # The timeseries ends flat, so there is no segment after the last run.
+        starts, stops = starts[:-1], stops[:-1]
+    keep = stops - starts > 1
+    return starts[keep], stops[keep]
+
+
+def find_breaks(x_data, y_data, max_flats=5):
+    """
+    Drop-in for `find_breaks` in EDB_Retrieval.ipynb, built on `align_xy` and `segment_bounds`.
+
+    Parameters
+    ----------
+    x_data : pandas.DataFrame
+        X-axis timeseries data.
+    y_data : pandas.DataFrame
+        Y-axis timeseries data.
+    max_flats : int, default=5
+        After this many data points with unchanging values, timeseries data will be broken up.
+
+    Returns
+    -------
+    list of pandas.DataFrame
+        Each DataFrame contains a continuous set of changing EDB timeseries data with X/Y-paired values,
+        as a slice of a single merged DataFrame.
+    """
+    x_index, y_index = align_xy(x_data["MJD"].values, y_data["MJD"].values)
+    xy_frame = pd.DataFrame(
+        {
+            "MJD": x_data["MJD"].values[x_index],
+            "timestamp": x_data["theTime"].values[x_index],
+            "x_value": x_data["euvalue"].values[x_index],
+            "y_value": y_data["euvalue"].values[y_index],
+        }
+    )
+    starts, stops = segment_bounds(xy_frame["x_value"].values, xy_frame["y_value"].values, max_flats)
+    print("returning {} timeseries".format(len(starts)))
+    return [xy_frame[start:stop] for start, stop in zip(starts, stops)]
+
+
+def _loop_bounds(x_vals, y_vals, max_flats=5):
+    """The sample-by-sample scan of `find_breaks`, for comparison in the benchmark"""
+    results = []
+    m = 0
+    flat = 0
+    recording = True
+    for n in range(1, len(x_vals)):
+        if x_vals[n - 1] == x_vals[n] and y_vals[n - 1] == y_vals[n]:
+            flat += 1
+            if recording and flat >= max_flats:
+                if (n - max_flats) - m > 1:
+                    results.append((m, n - max_flats))
+                recording = False
+        else:
+            flat = 0
+            if not recording:
+                m = n
+                recording = True
+    if recording and len(x_vals) - m > 1:
+        results.append((m, len(x_vals)))
+    return results
+
+
+def _simulated_fsm(n_samples, seed=0):
+    """X/Y values that move in steps between stretches where they are held still, like the FSM angles"""
+    rng = np.random.default_rng(seed)
+    held = np.repeat(rng.random(n_samples // 50 + 1) < 0.3, 50)[:n_samples]
+    x_vals = np.cumsum(np.where(held, 0.0, rng.standard_normal(n_samples)))
+    y_vals = np.cumsum(np.where(held, 0.0, rng.standard_normal(n_samples)))
+    return x_vals, y_vals
+
+
+def benchmark(sizes, loop_max=1e6, max_flats=5):
+    for size in sizes:
+        n_samples = int(size)
+        x_vals, y_vals = _simulated_fsm(n_samples)
+        mjd = 59000 + np.arange(n_samples) / 86400
+
+        start = time.perf_counter()
+        x_index, y_index = align_xy(mjd, mjd)
+        starts, stops = segment_bounds(x_vals[x_index], y_vals[y_index], max_flats)
+        vectorized = time.perf_counter() - start
+        line = f"{n_samples:>11,d} samples: {len(starts):>9,d} segments in {vectorized:8.3f} s vectorized"
+
+        if n_samples <= loop_max:
+            start = time.perf_counter()
+            expected = _loop_bounds(x_vals, y_vals, max_flats)
+            loop = time.perf_counter() - start
+            if expected != list(zip(starts.tolist(), stops.tolist())):
+                raise AssertionError(f"The segments of {n_samples} samples differ from the loop's")
+            line += f", {loop:8.3f} s in a loop ({loop / vectorized:.0f}x)"
+        print(line)
+        del x_vals, y_vals, mjd
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized find_breaks against the loop")
+    parser.add_argument("sizes", nargs="*", type=float, default=[1e6, 1e7, 1e8], help="Numbers of samples")
+    parser.add_argument("--loop-max", type=float, default=1e6, help="Largest size to also time the loop at")
+    parser.add_argument("--max-flats", type=int, default=5, help="max_flats of find_breaks")
+    args = parser.parse_args(args)
+    benchmark(args.sizes, args.loop_max, args.max_flats)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())